@@ -5,8 +5,17 @@ The module 'helpers.py' contains the classes and functions used in the script OL
 """
 
 import collections
+from operator import itemgetter
 from Bio.Seq import Seq
-from main import STOP, input_seqName, seed_size, min_overlap, list_of_abundance_min, max_length, max_subs, readList
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from main import START, STOP, input_seqName, seed_size, seed_masks, seed_fallback, min_overlap, list_of_abundance_min, max_length, max_subs, reach_hops, overlap_cache_size, readList, readAbundance
 
 
 #----------------------------------------------------
@@ -110,11 +119,362 @@ class Graph:
 
 
 
+#----------------------------------------------------
+# Assembly class
+#----------------------------------------------------
+# Number of bp of the end of the assembly's sequence stored in an Assembly object (must be larger than the reads, to search for overlapping reads).
+TAIL_SIZE = max(70, 2 * max((len(read) for read in readList), default=0))
+
+class Assembly:
+    """The class 'Assembly' contains all the attributes, properties and methods to create an Assembly object.
+
+    The class 'Assembly' initializes an Assembly object, e.g. an assembly's sequence under construction represented as a path of segments of reads.
+    Each Assembly object is its parent Assembly object extended by one segment: [position of the read in readList, offset of the segment in the read, length of the segment],
+    so that extending an assembly doesn't copy its whole sequence. Only the last 'TAIL_SIZE' bp of the sequence (tail) are stored, the full sequence is built when a solution is found.
+    """
+    # Constructor.
+    def __init__(self, pos_read, segment, offset=0, parent=None):
+        self._parent = parent
+        self._segment = [pos_read, offset, len(segment)]
+        if parent is None:
+            self._length = len(segment)
+            self._tail = segment[-TAIL_SIZE:]
+        else:
+            self._length = len(parent) + len(segment)
+            self._tail = (parent.tail + segment)[-TAIL_SIZE:]
+
+    # Accessors.
+    def _get_parent(self):
+        '''Method to be call when we want to access the attribute "parent"'''
+        return self._parent
+    def _get_segment(self):
+        '''Method to be call when we want to access the attribute "segment"'''
+        return self._segment
+    def _get_tail(self):
+        '''Method to be call when we want to access the attribute "tail"'''
+        return self._tail
+
+    # Properties.
+    parent = property(_get_parent)
+    segment = property(_get_segment)
+    tail = property(_get_tail)
+
+    # Method "__len__".
+    def __len__(self):
+        return self._length
+
+    # Method "extend".
+    def extend(self, pos_read, offset, extension):
+        '''Method to return a new Assembly object, e.g. the current assembly extended by the extension (starting at 'offset' in the read 'pos_read')'''
+        return Assembly(pos_read, extension, offset, self)
+
+    # Method "sequence".
+    def sequence(self):
+        '''Method to build the full sequence of the assembly, from the segments of the path'''
+        segments = []
+        node = self
+        while node is not None:
+            segments.append(node.segment)
+            node = node.parent
+        return "".join(get_read_sequence(pos_read)[offset:offset+length] for (pos_read, offset, length) in reversed(segments))
+
+    # Method "__repr__".
+    def __repr__(self):
+        return "Assembly: length ({}), last segment ({})".format(self._length, self._segment)
+
+
+#----------------------------------------------------
+# OverlapCache class
+#----------------------------------------------------
+class OverlapCache:
+    """The class 'OverlapCache' contains all the attributes and methods to create an OverlapCache object.
+
+    The class 'OverlapCache' initializes an OverlapCache object, e.g. a bounded LRU cache of the verified overlaps between two reads, shared by all branches of the extension.
+    An ordered dictionary is used: key = (position of the anchor read in readList, position of the putative read in readList, offset of the overlap in the anchor read)
+    (positions as '-pos' for the reverse complement of the reads) ; value = number of substitutions in the overlap (-1 if the reads don't overlap)
+    """
+    # Constructor.
+    def __init__(self, max_size):
+        self._cache = collections.OrderedDict()
+        self._max_size = max_size
+        self._hits = 0
+        self._misses = 0
+
+    # Accessors.
+    def _get_max_size(self):
+        '''Method to be call when we want to access the attribute "max_size"'''
+        return self._max_size
+
+    # Properties.
+    max_size = property(_get_max_size)
+
+    # Method "get".
+    def get(self, key):
+        '''Method to return the number of substitutions of the overlap 'key' (-1 if no overlap), or None if the overlap was not verified yet'''
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self._hits += 1
+            return self._cache[key]
+        self._misses += 1
+        return None
+
+    # Method "put".
+    def put(self, key, nb_substitutions):
+        '''Method to store the number of substitutions of the overlap 'key' (-1 if no overlap), and remove the least recently used overlap if the cache is full'''
+        self._cache[key] = nb_substitutions
+        self._cache.move_to_end(key)
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    # Method "stats".
+    def stats(self):
+        '''Method to return the hit rate of the cache, to help sizing it'''
+        lookups = self._hits + self._misses
+        hit_rate = 100.0 * self._hits / lookups if lookups else 0.0
+        return "Overlap cache: {} hits out of {} lookups ({:.1f}%), {} overlaps stored (max {})".format(self._hits, lookups, hit_rate, len(self._cache), self._max_size)
+
+    # Method "__repr__".
+    def __repr__(self):
+        return self.stats()
+
+
+# Cache of the verified overlaps between reads, used by 'verify_overlapping_reads()'.
+overlapCache = OverlapCache(overlap_cache_size)
+
+
+#----------------------------------------------------
+# AnchorMatcher class
+#----------------------------------------------------
+class AnchorMatcher:
+    """The class 'AnchorMatcher' contains all the attributes and methods to search several anchor sequences (e.g. kmers START and STOP) in a single pass over a read.
+
+    The class 'AnchorMatcher' initializes an AnchorMatcher object.
+    Each anchor is searched along with its reverse complement in the read only, so that the reverse complement of the read doesn't need to be scanned.
+    An Aho-Corasick automaton is used if the module 'ahocorasick' (pyahocorasick) is installed, otherwise each anchor and its reverse complement are searched with 'str.find' in the read.
+    """
+    # Constructor.
+    def __init__(self, anchors):
+        # Dictionary containing the pattern's sequence as key, and the list of [anchor's name, strand] it corresponds to as value.
+        self._patterns = {}
+        # List of the anchors, referenced as [anchor's name, anchor's sequence, reverse complement of the anchor's sequence].
+        self._anchors = []
+        for (name, anchor) in anchors.items():
+            anchor_rc = str(Seq(anchor).reverse_complement())
+            self._patterns.setdefault(anchor, []).append([name, "+"])
+            self._patterns.setdefault(anchor_rc, []).append([name, "-"])
+            self._anchors.append([name, anchor, anchor_rc])
+        self._automaton = None
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for pattern in self._patterns:
+                self._automaton.add_word(pattern, pattern)
+            self._automaton.make_automaton()
+
+    # Method "iter_matches".
+    def iter_matches(self, read):
+        '''Method to iterate over all the occurrences of the patterns in the read with the Aho-Corasick automaton, as [index of beginning of pattern, pattern's sequence]'''
+        for (end_index, pattern) in self._automaton.iter(read):
+            yield [end_index - len(pattern) + 1, pattern]
+
+    # Method "find_anchors".
+    def find_anchors(self, read):
+        '''Method to return a dictionary containing the anchor's name as key, and [strand, index of beginning of the anchor] as value, for each anchor found in the read
+        (strand "+": first occurrence of the anchor in the read / strand "-": first occurrence of the anchor in the reverse complement of the read, only if absent from the read)'''
+        found = {}
+        # Without Aho-Corasick automaton: first occurrence of the anchor in the read, otherwise last occurrence of its reverse complement (e.g. first occurrence in the reverse complement of the read).
+        if self._automaton is None:
+            for (name, anchor, anchor_rc) in self._anchors:
+                index = read.find(anchor)
+                if index != -1:
+                    found[name] = ["+", index]
+                    continue
+                index = read.rfind(anchor_rc)
+                if index != -1:
+                    found[name] = ["-", len(read) - index - len(anchor_rc)]
+            return found
+
+        for (index, pattern) in self.iter_matches(read):
+            for (name, strand) in self._patterns[pattern]:
+                if strand == "+":
+                    if name not in found or found[name][0] == "-" or index < found[name][1]:
+                        found[name] = ["+", index]
+                else:
+                    index_rc = len(read) - index - len(pattern)
+                    if name not in found or (found[name][0] == "-" and index_rc < found[name][1]):
+                        found[name] = ["-", index_rc]
+        return found
+
+    # Method "__repr__".
+    def __repr__(self):
+        return "Anchors: {}".format(self._patterns)
+
+
+#----------------------------------------------------
+# find_anchor_reads function
+#----------------------------------------------------
+def find_anchor_reads(reads, anchors):
+    """To find, in a single pass over the reads, all reads containing the whole sequence of each anchor (e.g. kmers START and STOP of one or several gaps).
+
+    Args:
+        - reads: list
+            list of all reads' sequences (e.g. readList)
+        - anchors: dict
+            dictionary of the anchors to search: key = anchor's name ; value = anchor's sequence
+
+    Returns:
+        - readWithAnchor: dict
+            dictionary of the reads containing each anchor: key = anchor's name ; value = list of all reads containing the full sequence of the anchor (or of its reverse complement),
+            referenced as [position of the read in reads ('-pos' if the anchor is in the reverse complement of the read), index of beginning of the anchor's subsequence]
+    """
+    matcher = AnchorMatcher(anchors)
+    readWithAnchor = {name: [] for name in anchors}
+    for (pos_read, read) in enumerate(reads):
+        for (name, (strand, index)) in matcher.find_anchors(read).items():
+            readWithAnchor[name].append([str(pos_read) if strand == "+" else "-"+str(pos_read), index])
+    return readWithAnchor
+
+
+#----------------------------------------------------
+# ReadSuffixArray class
+#----------------------------------------------------
+class ReadSuffixArray:
+    """The class 'ReadSuffixArray' contains all the attributes and methods to create a ReadSuffixArray object, e.g. an alternative to 'seedDict' for searching the overlapping reads.
+
+    The class 'ReadSuffixArray' initializes a ReadSuffixArray object, e.g. the sorted array of the reads' sequences and of their reverse complement
+    (the only suffixes of the reads searched, as the overlapping reads must begin with the query sequence), which gives directly the reads whose sequence begins with a query sequence.
+    The sequences are sorted with NumPy by an integer key encoding their first characters, the ties being sorted by their whole sequence:
+    a query is searched with 'np.searchsorted' on these keys, the comparisons of strings being restricted to the sequences sharing the query's encoded prefix.
+    """
+    # Constructor.
+    def __init__(self, reads):
+        if np is None:
+            raise ImportError("NumPy is required for the suffix array of the reads")
+        # Positions of the reads in readList ('-pos' for the reverse complement of the reads), and their sequences.
+        self._ids = []
+        self._sequences = []
+        for (pos_read, read) in enumerate(reads):
+            self._ids.extend([str(pos_read), "-"+str(pos_read)])
+            self._sequences.extend([read, str(Seq(read).reverse_complement())])
+        self._encode_keys()
+        self._order = self._sort()
+        self._keys = self._keys[self._order]
+
+    # Accessors.
+    def _get_size(self):
+        '''Method to be call when we want to access the attribute "size"'''
+        return len(self._sequences)
+
+    # Properties.
+    size = property(_get_size)
+
+    # Method "_encode_keys".
+    def _encode_keys(self):
+        '''Method to encode the first characters of each sequence as an integer key (63 bits), ordered as the sequences: each character is coded by its rank in the alphabet of the reads (+1, 0 past the end of the sequence)'''
+        alphabet = sorted(set().union(*[set(seq) for seq in self._sequences]))
+        self._codes = {char: code+1 for (code, char) in enumerate(alphabet)}
+        self._bits = max(1, len(alphabet).bit_length())
+        self._key_length = 63 // self._bits
+        # Small alphabet (e.g. 'ACGTN'): a key is parsed at once from the characters translated into digits of base 2**bits.
+        self._digits = str.maketrans({char: str(code) for (char, code) in self._codes.items()}) if self._bits <= 3 else None
+        lookup = np.zeros(256, dtype=np.uint64)
+        for (char, code) in self._codes.items():
+            lookup[ord(char)] = code
+        k = self._key_length
+        prefixes = np.frombuffer("".join(seq[:k].ljust(k, "\0") for seq in self._sequences).encode(), dtype=np.uint8).reshape(-1, k)
+        self._keys = np.zeros(len(self._sequences), dtype=np.uint64)
+        for j in range(k):
+            self._keys = (self._keys << np.uint64(self._bits)) | lookup[prefixes[:, j]]
+
+    # Method "_sort".
+    def _sort(self):
+        '''Method to return the order of the sequences: sorted by their key, then by their whole sequence for the sequences sharing the same key'''
+        order = np.argsort(self._keys, kind="stable")
+        sorted_keys = self._keys[order]
+        ties = np.flatnonzero(sorted_keys[1:] == sorted_keys[:-1])
+        start = None
+        for (i, tie) in enumerate(ties):
+            if start is None:
+                start = tie
+            # End of a run of sequences sharing the same key.
+            if i == len(ties)-1 or ties[i+1] != tie+1:
+                order[start:tie+2] = sorted(order[start:tie+2].tolist(), key=self._sequences.__getitem__)
+                start = None
+        return order
+
+    # Method "_get_range".
+    def _get_range(self, query):
+        '''Method to return the interval [lower bound, upper bound[ of the sorted sequences that begin with the query: by 'np.searchsorted' on the keys of their encoded prefix,
+        then by binary search on their sequence if the query is longer than the encoded prefix'''
+        k = min(len(query), self._key_length)
+        if self._digits is not None:
+            try:
+                key = int(query[:k].translate(self._digits), 1 << self._bits) if k > 0 else 0
+            except ValueError:
+                return 0, 0
+        else:
+            key = 0
+            for char in query[:k]:
+                if char not in self._codes:
+                    return 0, 0
+                key = (key << self._bits) | self._codes[char]
+        shift = self._bits * (self._key_length - k)
+        lo = int(self._keys.searchsorted(np.uint64(key << shift), side="left"))
+        hi = int(self._keys.searchsorted(np.uint64(((key+1) << shift) - 1), side="right"))
+        if len(query) <= self._key_length or lo == hi:
+            return lo, hi
+
+        sequences, order, m = self._sequences, self._order, len(query)
+        upper = hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sequences[order[mid]][:m] < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        lower = lo
+        hi = upper
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sequences[order[mid]][:m] <= query:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lower, lo
+
+    # Method "find_reads".
+    def find_reads(self, query):
+        '''Method to return the list of the positions of the reads (in readList, '-pos' for the reverse complement of the reads) whose sequence begins with the query'''
+        (lower, upper) = self._get_range(query)
+        return [self._ids[r] for r in sorted(self._order[lower:upper].tolist())]
+
+    # Method "__repr__".
+    def __repr__(self):
+        return "ReadSuffixArray: {} reads, {} sequences".format(len(self._ids) // 2, len(self._sequences))
+
+
+#----------------------------------------------------
+# get_seed function
+#----------------------------------------------------
+# Seed masks used for indexing the reads, along with the length of their exact prefix (e.g. the bases before their first don't care position).
+seedMasks = [(mask, mask.index("0") if "0" in mask else len(mask)) for mask in seed_masks]
+
+# Tiers of seeds used for searching the overlapping reads, from the largest seeds to the smallest ones, referenced as [seed size, list of seed masks of the tier]:
+# the seeds of a tier are used only if the seeds of the previous tiers give no overlapping read.
+seedTiers = [[seed_size, seedMasks]] + [[size, [("1"*size, size)]] for size in seed_fallback]
+
+def get_seed(seq, mask):
+    """To get the seed of a sequence with a seed mask (string of '1' for the care positions and '0' for the don't care positions):
+    the bases at the don't care positions are replaced by '-' (the seed of a contiguous mask is the prefix of the sequence)."""
+    if "0" not in mask:
+        return seq[:len(mask)]
+    return "".join(nuc if care == "1" else "-" for (nuc, care) in zip(seq, mask))
+
+
 #----------------------------------------------------
 # index_read function
 #----------------------------------------------------
 def index_read(read, i, read_rc, seedDict):
-    """To index a read by its seed.
+    """To index a read by its seed(s) (one seed per seed mask of 'seedMasks').
     It updates a dictionary 'seedDict': key = seed's sequence ; value = list of positions of reads having this seed in readList
 
     Args:
@@ -131,148 +491,324 @@ def index_read(read, i, read_rc, seedDict):
         - seedDict: dict
             dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
     """
-    # Index read by its seed.
-    seed = read[:seed_size]
-    if seed in seedDict:
-        seedDict[seed].append(str(i))
-    else:
-        seedDict[seed] = [str(i)]
+    for (mask, len_exact) in [mask for (size, masks) in seedTiers for mask in masks]:
 
-    # Index reverse complement of read by its seed as well.
-    seed = read_rc[:seed_size]
-    if seed in seedDict:
-        seedDict[seed].append("-"+str(i))
+        # Index read by its seed.
+        seed = get_seed(read, mask)
+        if seed in seedDict:
+            seedDict[seed].append(str(i))
+        else:
+            seedDict[seed] = [str(i)]
+
+        # Index reverse complement of read by its seed as well.
+        seed = get_seed(read_rc, mask)
+        if seed in seedDict:
+            seedDict[seed].append("-"+str(i))
+        else:
+            seedDict[seed] = ["-"+str(i)]
+
+
+#----------------------------------------------------
+# get_read_sequence function
+#----------------------------------------------------
+def get_read_sequence(pos_read):
+    """To get the sequence of a read from its position in readList ('-pos' if reverse complement of the read).
+
+    Args:
+        - pos_read: str
+            position of the read in readList (list containing all reads' sequences), '-pos' if reverse complement of the read
+
+    Returns:
+        - read: str
+            sequence of the read (or of its reverse complement)
+    """
+    if '-' in str(pos_read):
+        return str(Seq(readList[int(pos_read.split('-')[1])]).reverse_complement())
     else:
-        seedDict[seed] = ["-"+str(i)]
+        return readList[int(pos_read)]
+
+
+#----------------------------------------------------
+# mask_frequent_seeds function
+#----------------------------------------------------
+# Set of the seeds having too many reads in seedDict (e.g. seeds from low-complexity or repeated sequences), only used as a fallback by 'find_overlapping_reads()'.
+maskedSeeds = set()
+
+def mask_frequent_seeds(seedDict, max_seed_freq):
+    """To mark the seeds of 'seedDict' indexing more than 'max_seed_freq' reads, and update the set 'maskedSeeds'.
+
+    Args:
+        - seedDict: dict
+            dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
+        - max_seed_freq: int
+            maximal number of reads per seed (if 0, it is set automatically to 10 times the median number of reads per seed)
+
+    Returns:
+        - max_seed_freq: int
+            maximal number of reads per seed used
+    """
+    if max_seed_freq == 0:
+        nb_reads_per_seed = sorted(len(putative_reads) for putative_reads in seedDict.values())
+        max_seed_freq = 10 * nb_reads_per_seed[len(nb_reads_per_seed) // 2] if nb_reads_per_seed else 0
+
+    maskedSeeds.clear()
+    for (seed, putative_reads) in seedDict.items():
+        if len(putative_reads) > max_seed_freq:
+            maskedSeeds.add(seed)
+
+    return max_seed_freq
+
+
+#----------------------------------------------------
+# verify_overlapping_reads function
+#----------------------------------------------------
+def verify_overlapping_reads(assembly, i, putative_reads, anchor_read=None, anchor_offset=0, len_exact=seed_size):
+    """
+    To verify the overlap between the current assembly's sequence S and the putative reads having their seed at position i of S
+    If the end of S is the sequence of the anchor read, the overlaps are read-to-read overlaps and are looked up in (and stored into) 'overlapCache'
+
+    Args:
+        - assembly: str
+            current assembly's sequence
+        - i: int
+            position of the seed onto the current assembly's sequence
+        - putative_reads: list
+            list of positions of the reads having this seed in readList
+        - anchor_read: str
+            position in readList of the read ending the current assembly's sequence (None if the end of the assembly's sequence is not a read)
+        - anchor_offset: int
+            position of the seed onto the anchor read
+        - len_exact: int
+            length of the exact match at the beginning of the seed (e.g. the bases before the first don't care position of the seed mask)
+
+    Returns:
+        - overlapping_reads: list
+            list containing the overlapping reads' sequences, referenced as [read's sequence, index of beginning of overlap, position of the read in readList]
+    """
+    overlapping_reads = []
+
+    # For each putative read, search for an overlap between the current assembly's sequence and the putative read.
+    for put_read in putative_reads:
+
+        # Overlap already verified (the sequence of the read is only needed if the overlap was found).
+        if anchor_read is not None:
+            nb_substitutions = overlapCache.get((anchor_read, put_read, anchor_offset))
+            if nb_substitutions is not None:
+                if nb_substitutions >= 0:
+                    overlapping_reads.append([get_read_sequence(put_read), i, put_read])
+                continue
+
+        # Get the sequence of the read.
+        read = get_read_sequence(put_read)
+
+        nb_substitutions = 0
+        l = i + len_exact
+        j = len_exact
+        length_overlap = 0
+
+        while l < len(assembly) and j < len(read):
+            # Match.
+            if assembly[l] == read[j]:
+                l += 1
+                j += 1
+                length_overlap += 1
+            # Mismatch (error in reads: we allow [max_subs] substitutions maximum).
+            elif nb_substitutions < max_subs:
+                l += 1
+                j += 1
+                length_overlap += 1
+                nb_substitutions += 1
+            else:
+                break
+
+        # Overlap found.
+        if l == len(assembly):
+            overlapping_reads.append([read, i, put_read])
+        else:
+            nb_substitutions = -1
+
+        # Save the overlap in the cache.
+        if anchor_read is not None:
+            overlapCache.put((anchor_read, put_read, anchor_offset), nb_substitutions)
+
+    return overlapping_reads
 
 
 #----------------------------------------------------
 # find_overlapping_reads function
 #----------------------------------------------------
-def find_overlapping_reads(assembly, len_read, seedDict):
+def find_overlapping_reads(assembly, len_read, seedDict, anchor_read=None):
     """
     To find the reads overlapping with the current assembly's sequence S
     The list 'overlapping_reads' it returns is sorted automatically by smallest i, e.g. by largest overlap
+    If 'seedDict' is the suffix array of the reads (see the class 'ReadSuffixArray'), the search is performed by 'search_suffix_array()'
+    NB: the tiers of seeds of 'seedTiers' are used in turn (largest seeds first), until one of them gives overlapping reads
+        the seeds of 'maskedSeeds' are skipped, unless no other seed of the tier gives a putative read
+        a putative read found by several seeds at the same position is verified only once
 
     Args:
         - assembly: str
             current assembly's sequence
         - len_read: int
             length of the read from which we want to extend
-        - seedDict: dict
-            dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
+        - seedDict: dict / ReadSuffixArray
+            dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList (or suffix array of the reads)
+        - anchor_read: str
+            position in readList of the last read of the current assembly (optional), used to look up the overlaps in 'overlapCache'
 
     Returns:
         - overlapping_reads: list
-            list containing all the overlapping reads' sequences, along with the index of the beginning of the overlap,
-            referenced as [read's sequence, index of beginning of overlap]
+            list containing all the overlapping reads' sequences, along with the index of the beginning of the overlap and the position of the read in readList,
+            referenced as [read's sequence, index of beginning of overlap, position of the read in readList]
     """
     overlapping_reads = []
+    verified = set()
 
-    # Get the putative reads (e.g. reads having a seed onto the current assembly's sequence).
-    for i in range(len(assembly)-len_read+1, len(assembly)-min_overlap-seed_size):
-        seed = assembly[i:i+seed_size]
-        if seed in seedDict:
-            putative_reads = seedDict[seed]
-
-            # For each putative read, search for an overlap between the current assembly's sequence and the putative read.
-            for put_read in putative_reads:
-                nb_substitutions = 0
-                l = i + seed_size
-                j = seed_size
-                length_overlap = 0
-
-                # Get the sequence of the read.
-                if '-' in str(put_read):
-                    read = str(Seq(readList[int(put_read.split('-')[1])]).reverse_complement())
-                else:
-                    read = readList[int(put_read)]
-
-                while l < len(assembly) and j < len(read):
-                    # Match.
-                    if assembly[l] == read[j]:
-                        l += 1
-                        j += 1
-                        length_overlap += 1
-                    # Mismatch (error in reads: we allow [max_subs] substitutions maximum).
-                    elif nb_substitutions < max_subs:
-                        l += 1
-                        j += 1
-                        length_overlap += 1
-                        nb_substitutions += 1
-                    else:
-                        break
+    # The cached overlaps are read-to-read overlaps: use them only if the current assembly's sequence ends with the whole anchor read.
+    if anchor_read is not None:
+        if overlapCache.max_size <= 0 or len_read > len(assembly) or not assembly.endswith(get_read_sequence(anchor_read)):
+            anchor_read = None
+
+    # Suffix array backend.
+    if isinstance(seedDict, ReadSuffixArray):
+        return search_suffix_array(assembly, len_read, seedDict, anchor_read)
+
+    for (size, masks) in seedTiers:
+        masked_positions = []
+        putative_reads_found = False
 
-                # Overlap found.
-                if l == len(assembly):
-                    overlapping_reads.append([read, i])
+        # Get the putative reads (e.g. reads having a seed onto the current assembly's sequence).
+        for i in range(len(assembly)-len_read+1, len(assembly)-min_overlap-size):
+            for (mask, len_exact) in masks:
+                seed = get_seed(assembly[i:i+len(mask)], mask)
+                if seed in seedDict:
+                    # Skip the high-frequency seeds.
+                    if seed in maskedSeeds:
+                        masked_positions.append((i, seed, len_exact))
+                        continue
+                    putative_reads_found = True
+                    putative_reads = [put_read for put_read in seedDict[seed] if (put_read, i) not in verified]
+                    verified.update((put_read, i) for put_read in putative_reads)
+                    overlapping_reads.extend(verify_overlapping_reads(assembly, i, putative_reads, anchor_read, i-len(assembly)+len_read, len_exact))
+
+        # Fall back to the high-frequency seeds if no other seed gives a putative read.
+        if not putative_reads_found:
+            for (i, seed, len_exact) in masked_positions:
+                putative_reads = [put_read for put_read in seedDict[seed] if (put_read, i) not in verified]
+                verified.update((put_read, i) for put_read in putative_reads)
+                overlapping_reads.extend(verify_overlapping_reads(assembly, i, putative_reads, anchor_read, i-len(assembly)+len_read, len_exact))
+
+        # Fall back to the smaller seeds only if no overlapping read is found.
+        if overlapping_reads:
+            break
 
     return overlapping_reads
 
 
 #----------------------------------------------------
-# extend function
+# search_suffix_array function
 #----------------------------------------------------
-def extend(assembly, len_read, seedDict, assemblyHash):
+def search_suffix_array(assembly, len_read, suffixArray, anchor_read=None):
     """
-    To extend a read's sequence with overlapping reads
-    The Boolean value it returns represents the success of the gap-filling
-    NB: extGroup is a dictionary containing the extension's sequence as key, and the reads sharing this extension as value
-        (value format: [read's sequence, index of beginning of overlap])
-    If we use the 'graph' module: def extend(S, read, a, seedDict, graph):
+    To find the reads overlapping with the current assembly's sequence S, using the suffix array of the reads
+    Without substitution allowed (max_subs = 0), the overlapping reads are directly the reads whose sequence begins with the suffix of S starting at i;
+    otherwise, the putative reads are the reads whose sequence begins with the 'seed_size' bp of S starting at i, and their overlap with S is verified
 
     Args:
         - assembly: str
             current assembly's sequence
         - len_read: int
             length of the read from which we want to extend
+        - suffixArray: ReadSuffixArray
+            suffix array of the reads
+        - anchor_read: str
+            position in readList of the read ending the current assembly's sequence (None if the end of the assembly's sequence is not a read), used to look up the overlaps in 'overlapCache'
+
+    Returns:
+        - overlapping_reads: list
+            list containing all the overlapping reads' sequences, referenced as [read's sequence, index of beginning of overlap, position of the read in readList]
+    """
+    overlapping_reads = []
+    for i in range(len(assembly)-len_read+1, len(assembly)-min_overlap-seed_size):
+        if max_subs == 0:
+            overlapping_reads.extend([get_read_sequence(put_read), i, put_read] for put_read in suffixArray.find_reads(assembly[i:]))
+        else:
+            overlapping_reads.extend(verify_overlapping_reads(assembly, i, suffixArray.find_reads(assembly[i:i+seed_size]), anchor_read, i-len(assembly)+len_read))
+    return overlapping_reads
+
+
+#----------------------------------------------------
+# compute_stop_proximity function
+#----------------------------------------------------
+def compute_stop_proximity(stop_reads, seedDict, max_hops):
+    """
+    To compute, for the reads located at most 'max_hops' overlaps upstream of the reads containing the kmer STOP, a lower bound of the number of bp
+    to append to the assembly after the read before reaching a read containing the kmer STOP
+    The reads overlapping upstream of a read X are the reverse complement of the reads overlapping with the reverse complement of X (using the seed index)
+
+    Args:
+        - stop_reads: list
+            list of the positions of the reads containing the whole kmer STOP's sequence in readList ('-pos' if reverse complement of the read)
         - seedDict: dict
             dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
-        - assemblyHash = hashtable/dict
-            hashtable/dictionary indicating if the search for overlapping reads has already been performed on the corresponding sequence (key):
-            key = the last 70 bp of the current assembly's sequence ; value = Boolean value (0: overlapping reads search not performed / 1: overlapping reads search performed)
+        - max_hops: int
+            maximum number of overlaps between a read and a read containing the kmer STOP
 
     Returns:
-        str, Boolean
-            - the gap-filled sequence (assembly) and a Boolean variable equal to True if a solution is found (e.g. we arrived to STOP kmer)
-            OR
-            - the current assembly's sequence updated and a Boolean variable equal to False if no solution is found but we extended a little bit the 
-              current assembly's sequence (e.g. we didn't arrive to STOP kmer)
-            OR
-            - the reason why the gap-filling failed and a Boolean variable equal to False if no solution is found and we didn't extended the current assembly's sequence
+        - stopDistDict: dict
+            dictionary of the reads close to the kmer STOP: key = position of the read in readList ('-pos' if reverse complement of the read) ;
+            value = minimal number of bp to append after this read before appending a read containing the kmer STOP
     """
-    tmp_solutions = "tmp_solutions.fasta"
+    stopDistDict = {}
+    for pos_read in stop_reads:
+        stopDistDict[pos_read] = 0
 
-    # Base cases.
-    if STOP in assembly[-len_read:]:
-        '''
-        graph.add_node(stop)
-        graph.add_edge((read, stop, 0))
-        '''
-        return assembly, True
+    # Relax the distances hop by hop, only from the reads whose distance was updated at the previous hop.
+    current_reads = list(stopDistDict.keys())
+    for hop in range(max_hops):
+        updated_reads = []
+        for pos_read in current_reads:
+            read = get_read_sequence(pos_read)
+            read_rc = str(Seq(read).reverse_complement())
+            read_rc_pos = pos_read[1:] if pos_read.startswith('-') else "-" + pos_read
+            for (put_read_seq, index, put_read) in find_overlapping_reads(read_rc, len(read), seedDict, read_rc_pos):
+                # Upstream read (orientation of the assembly) and number of bp appended when going from this read to the current read.
+                up_read = put_read[1:] if put_read.startswith('-') else "-" + put_read
+                dist = 0 if hop == 0 else index + stopDistDict[pos_read]
+                if up_read not in stopDistDict or dist < stopDistDict[up_read]:
+                    stopDistDict[up_read] = dist
+                    updated_reads.append(up_read)
+        current_reads = updated_reads
 
-    if len(assembly) > max_length:
-        return "\n|S| > max_length", False
+    return stopDistDict
 
-    if len(assembly) >= 70:
-        # Check that we didn't already search for overlapping reads on this region (e.g. on the last 70 bp of the current assembly's sequence).
-        if assemblyHash[assembly[-70:]] == 1:
-            return "\nPath already explored: No solution", False
-            
-    # Search for reads overlapping with the current assembly's sequence.
-    overlapping_reads = find_overlapping_reads(assembly, len_read, seedDict)
-    if not overlapping_reads:
-        with open(tmp_solutions, "a") as tmp_file:
-            tmp_file.write(">" + input_seqName + " _ No_read_overlapping")
-            tmp_file.write("\n"+str(assembly)+"\n")
-        return "\nNo overlapping reads", False
 
+#----------------------------------------------------
+# get_extension_groups function
+#----------------------------------------------------
+def get_extension_groups(assembly, overlapping_reads):
+    """
+    To group the reads overlapping with the current assembly's sequence by their extension
+    NB: extGroup is a dictionary containing the extension's sequence as key, and the reads sharing this extension as value
+        (value format: [read's sequence, index of beginning of overlap, position of the read in readList])
+
+    Args:
+        - assembly: str
+            current assembly's sequence
+        - overlapping_reads: list
+            list containing all the overlapping reads' sequences, along with the index of the beginning of the overlap and the position of the read in readList,
+            referenced as [read's sequence, index of beginning of overlap, position of the read in readList]
+
+    Returns:
+        - extGroup: dict
+            dictionary of the overlapping reads grouped by their extension, sorted by the smallest extension
+    """
     # Group the overlapping reads by their extension.
     extGroup = {}
 
     # Populate extGroup.
     '''NB: overlapping_reads list sorted automatically by smallest i, e.g. by largest overlap'''
-    for (read_seq, index) in overlapping_reads:
+    for (read_seq, index, pos_read) in overlapping_reads:
 
         # If no extension, don't add it to extGroup.
         if read_seq[len(assembly)-index:] == "":
@@ -280,7 +816,7 @@ def extend(assembly, len_read, seedDict, assemblyHash):
 
         # Add first extension to extGroup.
         if len(extGroup) == 0:
-            extGroup[read_seq[len(assembly)-index:]] = [[read_seq, index]]
+            extGroup[read_seq[len(assembly)-index:]] = [[read_seq, index, pos_read]]
 
         # Add all extensions to extGroup.
         elif len(extGroup) > 0:
@@ -292,7 +828,7 @@ def extend(assembly, len_read, seedDict, assemblyHash):
                     if read_seq[len(assembly)-index:] == extension[:len(read_seq[len(assembly)-index:])]:
                         new_extension = read_seq[len(assembly)-index:]
                         extGroup[new_extension] = extGroup[extension]
-                        extGroup[new_extension].append([read_seq, index])
+                        extGroup[new_extension].append([read_seq, index, pos_read])
                         del extGroup[extension]
                         added_to_extGroup = True
                         break
@@ -306,7 +842,7 @@ def extend(assembly, len_read, seedDict, assemblyHash):
                                 break
                         new_extension = extension[:i]
                         extGroup[new_extension] = extGroup[extension]
-                        extGroup[new_extension].append([read_seq, index])
+                        extGroup[new_extension].append([read_seq, index, pos_read])
                         del extGroup[extension]
                         added_to_extGroup = True
                         break
@@ -318,7 +854,7 @@ def extend(assembly, len_read, seedDict, assemblyHash):
                 else:
                     # Current extension already in extGroup.
                     if read_seq[len(assembly)-index:len(assembly)-index+len(extension)] == extension:
-                        extGroup[extension].append([read_seq, index])
+                        extGroup[extension].append([read_seq, index, pos_read])
                         added_to_extGroup = True
                         break
                     # Current extension is partially in extGroup.
@@ -331,7 +867,7 @@ def extend(assembly, len_read, seedDict, assemblyHash):
                                 break
                         new_extension = extension[:i]
                         extGroup[new_extension] = extGroup[extension]
-                        extGroup[new_extension].append([read_seq, index])
+                        extGroup[new_extension].append([read_seq, index, pos_read])
                         del extGroup[extension]
                         added_to_extGroup = True
                         break
@@ -341,19 +877,46 @@ def extend(assembly, len_read, seedDict, assemblyHash):
                         
             # Current extension not already in extGroup.
             if not added_to_extGroup:
-                extGroup[read_seq[len(assembly)-index:]] = [[read_seq, index]]
+                extGroup[read_seq[len(assembly)-index:]] = [[read_seq, index, pos_read]]
 
         # Sort extGroup by the smallest extension.
         extGroup = collections.OrderedDict(sorted(extGroup.items(), key=lambda t: len(t[0])))
 
-    # Update 'assemblyHash' to indicate that we performed the search for overlapping reads on this region (e.g. on the last 70 bp of the current assembly's sequence).
-    assemblyHash[assembly[-70:]] = 1
+    return extGroup
+
+
+#----------------------------------------------------
+# get_group_abundance function
+#----------------------------------------------------
+def get_group_abundance(reads):
+    """To get the number of reads of the dataset sharing an extension (sum of the abundances of the reads of the extension group, see 'readAbundance')."""
+    return sum(readAbundance[abs(int(pos_read))] for (read_seq, index, pos_read) in reads)
+
+
+#----------------------------------------------------
+# filter_extension_groups function
+#----------------------------------------------------
+def filter_extension_groups(extGroup):
+    """
+    To filter the extension groups by the number of reads sharing an extension (argument 'abundance_min')
+    The values of abundance_min are tried in turn, until at least one extension group remains
+
+    Args:
+        - extGroup: dict
+            dictionary of the overlapping reads grouped by their extension
+
+    Returns:
+        - extGroup_filtered: dict
+            dictionary of the extension groups kept, sorted by the extension whose read has the largest overlap with the current assembly's sequence (smallest i)
+            (empty if no extension group is shared by enough reads)
+    """
+    extGroup_filtered = {}
 
     # Filter extGroup by the number of reads sharing an extension (argument 'abundance_min').
     for abundance_min in list_of_abundance_min:
         extGroup_filtered = extGroup.copy()
         for extension in list(extGroup_filtered.keys()):
-            if len(extGroup_filtered[extension]) < abundance_min:
+            if get_group_abundance(extGroup_filtered[extension]) < abundance_min:
                 del extGroup_filtered[extension]
         
         # Iterate over the values of abundance_min only if number of reads sharing an extension < 'abundance_min'.
@@ -362,16 +925,178 @@ def extend(assembly, len_read, seedDict, assemblyHash):
         else:
             break
 
+    # Sort extGroup by the extension whose read has the largest overlap with the current assembly's sequence (smallest i).
+    '''NB: values of extGroup sorted by reads having the larger overlap'''
+    return collections.OrderedDict(sorted(extGroup_filtered.items(), key=lambda  t: t[1][0][1]))
+
+
+#----------------------------------------------------
+# rank_extension_groups function
+#----------------------------------------------------
+def rank_extension_groups(assembly, extGroup_filtered, stopDistDict, max_hops):
+    """
+    To rank the extension groups by their proximity to the kmer STOP (A*-like ordering), and to remove the ones that cannot reach the kmer STOP within 'max_length'
+    The groups are ranked by the distance to the kmer STOP of their reads present in 'stopDistDict' (number of bp, not clamped), the groups whose reads are all absent from it being ranked last
+    The reads absent from 'stopDistDict' are at more than 'max_hops' overlaps from the kmer STOP, so at least 'max_hops' bp away from it: the distances are clamped to 'max_hops'
+    only for the lower bound of the final assembly's length used to remove the groups, which remains admissible
+
+    Args:
+        - assembly: str
+            current assembly's sequence
+        - extGroup_filtered: dict
+            dictionary of the extension groups, sorted by the extension whose read has the largest overlap with the current assembly's sequence
+        - stopDistDict: dict
+            dictionary of the reads close to the kmer STOP: key = position of the read in readList ; value = minimal number of bp to append after this read before reaching the kmer STOP
+        - max_hops: int
+            maximum number of overlaps used to compute 'stopDistDict'
+
+    Returns:
+        - extGroup_ranked: dict
+            dictionary of the extension groups that can reach the kmer STOP, sorted by the estimated length of the final assembly (reads close to the kmer STOP first, then by the largest overlap)
+    """
+    ranked_groups = []
+    for extension, reads in extGroup_filtered.items():
+        # Lower bound of the length of the assembly before reaching a read containing the kmer STOP.
+        min_dist = min(min(stopDistDict.get(pos_read, max_hops), max_hops) for (read_seq, index, pos_read) in reads)
+        bound = len(assembly) + len(extension) + min_dist
+        if bound <= max_length:
+            # Rank: distance to the kmer STOP of the closest read of the group (unclamped), the groups with no read in 'stopDistDict' last.
+            dists = [stopDistDict[pos_read] for (read_seq, index, pos_read) in reads if pos_read in stopDistDict]
+            rank = (0, len(extension) + min(dists)) if dists else (1, len(extension))
+            ranked_groups.append((rank, reads[0][1], extension, reads))
+
+    return collections.OrderedDict((extension, reads) for (rank, index, extension, reads) in sorted(ranked_groups, key=itemgetter(0, 1)))
+
+
+#----------------------------------------------------
+# kmer_in_extension function
+#----------------------------------------------------
+def kmer_in_extension(assembly, kmer, len_extension):
+    """To check if the kmer ends in the last 'len_extension' bp of the assembly's sequence.
+    As the previous bp were already checked at the previous extension steps, only the extension and the (len(kmer)-1) bp preceding it are searched (without copying them).
+
+    Args:
+        - assembly: str
+            current assembly's sequence
+        - kmer: str
+            sequence of the kmer to search (e.g. the kmer STOP)
+        - len_extension: int
+            number of bp appended to the assembly's sequence since the last search
+
+    Returns:
+        - Boolean
+            True if the kmer ends in the last 'len_extension' bp of the assembly's sequence
+    """
+    return assembly.find(kmer, max(0, len(assembly)-len_extension-len(kmer)+1)) != -1
+
+
+#----------------------------------------------------
+# extend function
+#----------------------------------------------------
+# Number of times the search was cut by 'max_length' (assembly too long, extension group unable to reach the kmer STOP within 'max_length', or region already explored and cut):
+# a region whose search did not increment it is a dead end whatever the length budget, and is saved in 'assemblyHash' with an unbounded budget.
+lengthCuts = [0]
+
+def extend(assembly, len_read, seedDict, assemblyHash, stopDistDict=None, len_extension=None):
+    """
+    To extend a read's sequence with overlapping reads
+    The Boolean value it returns represents the success of the gap-filling
+    NB: extGroup is a dictionary containing the extension's sequence as key, and the reads sharing this extension as value
+        (value format: [read's sequence, index of beginning of overlap, position of the read in readList])
+    If we use the 'graph' module: def extend(S, read, a, seedDict, graph):
+
+    Args:
+        - assembly: Assembly
+            current assembly (path of segments of reads, see the class 'Assembly')
+        - len_read: int
+            length of the read from which we want to extend
+        - seedDict: dict
+            dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
+        - assemblyHash = hashtable/dict
+            hashtable/dictionary indicating if the search for overlapping reads has already been performed on the corresponding sequence (key), and with which length budget:
+            key = the last 70 bp of the current assembly's sequence ; value = largest remaining length budget (max_length - assembly's length) with which the search was performed
+            (infinite if the search from this region failed without being cut by 'max_length', e.g. a larger budget cannot lead to a solution)
+        - stopDistDict: dict
+            dictionary of the reads close to the kmer STOP (see 'compute_stop_proximity()'), used to rank and prune the extension groups (optional)
+        - len_extension: int
+            length of the last extension appended to the assembly's sequence, e.g. the only part in which to search for the kmer STOP (default: 'len_read')
+
+    Returns:
+        str, Boolean
+            - the gap-filled sequence (assembly) and a Boolean variable equal to True if a solution is found (e.g. we arrived to STOP kmer)
+            OR
+            - the current assembly's sequence updated and a Boolean variable equal to False if no solution is found but we extended a little bit the 
+              current assembly's sequence (e.g. we didn't arrive to STOP kmer)
+            OR
+            - the reason why the gap-filling failed and a Boolean variable equal to False if no solution is found and we didn't extended the current assembly's sequence
+    """
+    tmp_solutions = "tmp_solutions.fasta"
+
+    # The overlapping reads are searched on the end of the assembly's sequence only.
+    tail = assembly.tail
+
+    # Base cases.
+    if len_extension is None:
+        len_extension = len_read
+    if kmer_in_extension(tail, STOP, len_extension):
+        '''
+        graph.add_node(stop)
+        graph.add_edge((read, stop, 0))
+        '''
+        return assembly.sequence(), True
+
+    if len(assembly) > max_length:
+        lengthCuts[0] += 1
+        return "\n|S| > max_length", False
+
+    # Remaining length budget of the current assembly.
+    budget = max_length - len(assembly)
+    nb_cuts = lengthCuts[0]
+
+    if len(assembly) >= 70:
+        # Check that we didn't already search for overlapping reads on this region (e.g. on the last 70 bp of the current assembly's sequence) with a larger or equal length budget.
+        if tail[-70:] in assemblyHash and assemblyHash[tail[-70:]] >= budget:
+            if assemblyHash[tail[-70:]] != float("inf"):
+                lengthCuts[0] += 1
+            return "\nPath already explored: No solution", False
+
+        # Update 'assemblyHash' to indicate that we perform the search for overlapping reads on this region with the current length budget.
+        '''NB: a path coming back to this region from the current assembly has a smaller budget, so it is pruned'''
+        assemblyHash[tail[-70:]] = budget
+
+    # Search for reads overlapping with the current assembly's sequence.
+    overlapping_reads = find_overlapping_reads(tail, len_read, seedDict, assembly.segment[0])
+    if not overlapping_reads:
+        with open(tmp_solutions, "a") as tmp_file:
+            tmp_file.write(">" + input_seqName + " _ No_read_overlapping")
+            tmp_file.write("\n"+assembly.sequence()+"\n")
+        if len(assembly) >= 70:
+            assemblyHash[tail[-70:]] = float("inf")
+        return "\nNo overlapping reads", False
+
+    # Group the overlapping reads by their extension.
+    extGroup = get_extension_groups(tail, overlapping_reads)
+
+    # Filter extGroup by the number of reads sharing an extension (argument 'abundance_min').
+    extGroup_filtered = filter_extension_groups(extGroup)
+
     # If number of reads sharing an extension < minimal 'abundance_min' provided, stop the extension.
     if not extGroup_filtered:
         with open(tmp_solutions, "a") as tmp_file:
             tmp_file.write(">" + input_seqName + " _ No_extGroup")
-            tmp_file.write("\n"+str(assembly)+"\n")
+            tmp_file.write("\n"+assembly.sequence()+"\n")
+        if len(assembly) >= 70:
+            assemblyHash[tail[-70:]] = float("inf")
         return "\nNo extension", False
 
-    # Sort extGroup by the extension whose read has the largest overlap with the current assembly's sequence (smallest i). 
-    '''NB: values of extGroup sorted by reads having the larger overlap'''
-    extGroup_filtered = collections.OrderedDict(sorted(extGroup_filtered.items(), key=lambda  t: t[1][0][1]))
+    # Rank the extension groups by their proximity to the kmer STOP, and remove the ones that cannot reach it within 'max_length'.
+    if stopDistDict is not None:
+        extGroup_ranked = rank_extension_groups(assembly, extGroup_filtered, stopDistDict, reach_hops)
+        if len(extGroup_ranked) < len(extGroup_filtered):
+            lengthCuts[0] += 1
+        extGroup_filtered = extGroup_ranked
+        if not extGroup_filtered:
+            return "\nNo extension reaching the kmer STOP within max_length", False
 
     # Create graph "a la volee".
     '''
@@ -380,17 +1105,373 @@ def extend(assembly, len_read, seedDict, assemblyHash):
 
     # Iterative extension of the assembly's sequence S.
     for extension in extGroup_filtered:
+
+        # Extend the assembly with the segment of the read having the largest overlap.
+        (read_seq, index, pos_read) = extGroup_filtered[extension][0]
+        new_assembly = assembly.extend(pos_read, len(tail)-index, extension)
         
-        # Update 'assemblyHash' with the new region for which we will search for overlapping reads (with value '0' if search not already performed, or with value '1' if search already performed).
-        if (assembly+extension)[-70:] in assemblyHash.keys():
-            assemblyHash[(assembly+extension)[-70:]] = 1
-        else:
-            assemblyHash[(assembly+extension)[-70:]] = 0
-        
-        res, success = extend(assembly+extension, len(extGroup_filtered[extension][0][0]), seedDict, assemblyHash)
+        res, success = extend(new_assembly, len(read_seq), seedDict, assemblyHash, stopDistDict, len(extension))
         '''
         res, success = extend(assembly+extension, extGroup_filtered[extension][0][0], seedDict, graph)
         '''
         if success:
             return res, True
+
+    # Dead end whatever the length budget: no path from this region was cut by 'max_length'.
+    if len(assembly) >= 70 and lengthCuts[0] == nb_cuts:
+        assemblyHash[tail[-70:]] = float("inf")
     return res, False
+
+
+#----------------------------------------------------
+# extend_solutions function
+#----------------------------------------------------
+def extend_solutions(assembly, len_read, seedDict, assemblyHash, nb_solutions, stopDistDict=None, len_extension=None):
+    """
+    To extend a read's sequence with overlapping reads, collecting up to 'nb_solutions' distinct solutions (e.g. paths arriving to the kmer STOP) instead of the first one
+    The completions found from a region (e.g. the last 70 bp of the assembly's sequence) are saved in 'assemblyHash', and reused when another path arrives to this region:
+    the region is explored again only if its search was cut by 'max_length' and the new path has a larger length budget (the completions found with a smaller budget stay valid),
+    and the completions of a region whose search depended on a region still being explored (e.g. a cycle) are not saved, as they may be incomplete
+    NB: a completion is referenced as [extensions' chain, length budget needed, length], where the extensions' chain is a nested list [extension, next extensions' chain]
+        (None after the last extension), so that the completions are shared between paths without copying their sequence (see 'get_completion_sequence()')
+
+    Args:
+        - assembly: Assembly
+            current assembly (path of segments of reads, see the class 'Assembly')
+        - len_read: int
+            length of the read from which we want to extend
+        - seedDict: dict
+            dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
+        - assemblyHash = hashtable/dict
+            hashtable/dictionary of the regions already explored: key = the last 70 bp of the current assembly's sequence ;
+            value = [largest remaining length budget (max_length - assembly's length) with which the region was explored, list of the completions found from this region (None while it is explored),
+            Boolean indicating if the search from this region was cut by 'max_length']
+        - nb_solutions: int
+            maximal number of solutions to collect
+        - stopDistDict: dict
+            dictionary of the reads close to the kmer STOP (see 'compute_stop_proximity()'), used to rank and prune the extension groups (optional)
+        - len_extension: int
+            length of the last extension appended to the assembly's sequence, e.g. the only part in which to search for the kmer STOP (default: 'len_read')
+
+    Returns:
+        - completions: list
+            list of the completions (at most 'nb_solutions') of the current assembly arriving to the kmer STOP, in the order of the extension groups
+        - cut: Boolean
+            True if the search was cut by 'max_length' (e.g. a larger length budget may give other completions)
+        - pending: int
+            length of the shortest assembly whose region was still being explored when the search arrived to it (None if no such region was met), 
+            e.g. the completions are final only if it is not smaller than the length of the current assembly
+    """
+    tail = assembly.tail
+
+    # Base cases.
+    if len_extension is None:
+        len_extension = len_read
+    if kmer_in_extension(tail, STOP, len_extension):
+        return [[None, 0, 0]], False, None
+
+    if len(assembly) > max_length:
+        return [], True, None
+
+    # Remaining length budget of the current assembly.
+    budget = max_length - len(assembly)
+
+    if len(assembly) >= 70 and tail[-70:] in assemblyHash:
+        (explored_budget, explored_completions, explored_cut) = assemblyHash[tail[-70:]]
+        # Region being explored (the current path comes back to it): its completions are not known yet.
+        if explored_completions is None:
+            return [], False, max_length - explored_budget
+        # Region already explored without being cut by 'max_length', or with a larger or equal length budget: reuse the completions found (the ones fitting in the current budget).
+        if not explored_cut or explored_budget >= budget:
+            completions = [completion for completion in explored_completions if completion[1] <= budget]
+            return completions, explored_cut or len(completions) < len(explored_completions), None
+
+    if len(assembly) >= 70:
+        assemblyHash[tail[-70:]] = [budget, None, False]
+
+    # Search for reads overlapping with the current assembly's sequence, and group them by their extension.
+    cut = False
+    pending = None
+    completions = []
+    overlapping_reads = find_overlapping_reads(tail, len_read, seedDict, assembly.segment[0])
+    extGroup_filtered = filter_extension_groups(get_extension_groups(tail, overlapping_reads)) if overlapping_reads else {}
+    if stopDistDict is not None and extGroup_filtered:
+        extGroup_ranked = rank_extension_groups(assembly, extGroup_filtered, stopDistDict, reach_hops)
+        cut = len(extGroup_ranked) < len(extGroup_filtered)
+        extGroup_filtered = extGroup_ranked
+
+    # Iterative extension of the assembly's sequence S, until 'nb_solutions' completions are found.
+    for extension in extGroup_filtered:
+        (read_seq, index, pos_read) = extGroup_filtered[extension][0]
+        new_assembly = assembly.extend(pos_read, len(tail)-index, extension)
+
+        (chains, chain_cut, chain_pending) = extend_solutions(new_assembly, len(read_seq), seedDict, assemblyHash, nb_solutions, stopDistDict, len(extension))
+        cut = cut or chain_cut
+        if chain_pending is not None and (pending is None or chain_pending < pending):
+            pending = chain_pending
+        for (chain, chain_budget, chain_length) in chains:
+            # Length budget needed: the new assembly must not be longer than 'max_length', unless it contains the kmer STOP.
+            needed_budget = len(extension) + chain_budget if chain is not None else 0
+            completions.append([[extension, chain], needed_budget, len(extension) + chain_length])
+
+        if len(completions) >= nb_solutions:
+            completions = completions[:nb_solutions]
+            break
+
+    # Save the completions found from this region, unless they depend on a region (other than this one) still being explored.
+    if pending is not None and pending >= len(assembly):
+        pending = None
+    if len(assembly) >= 70:
+        if pending is None:
+            assemblyHash[tail[-70:]] = [budget, completions, cut]
+        else:
+            del assemblyHash[tail[-70:]]
+
+    return completions, cut, pending
+
+
+#----------------------------------------------------
+# get_completion_sequence function
+#----------------------------------------------------
+def get_completion_sequence(chain):
+    """To get the sequence of a completion from its extensions' chain (nested list [extension, next extensions' chain], see 'extend_solutions()')."""
+    extensions = []
+    while chain is not None:
+        extensions.append(chain[0])
+        chain = chain[1]
+    return "".join(extensions)
+
+
+#----------------------------------------------------
+# get_read_coverage function
+#----------------------------------------------------
+def get_read_coverage(seq):
+    """
+    To get the read coverage of each position of a gap-filled sequence, by placing the reads of 'readList' (and their reverse complement) on it with 'max_subs' substitutions maximum
+    The candidate placements of a read are given by its kmers of size 'seed_size' (sampled every 'seed_size' bp) found in the sequence, and a placement is kept if the read overlaps
+    the sequence on at least 'min_overlap' bp ; a read placed on the sequence only covers the positions where it agrees with the sequence, so that a sequencing error of the
+    gap-filled sequence is covered by the reads sharing this error only
+
+    Args:
+        - seq: str
+            gap-filled sequence
+
+    Returns:
+        - coverage: list
+            number of reads (weighted by the reads' abundance, see 'readAbundance') placed on the sequence and agreeing with it, for each position of the sequence
+    """
+    # Index the kmers of the gap-filled sequence.
+    kmerPositions = {}
+    for i in range(len(seq)-seed_size+1):
+        kmerPositions.setdefault(seq[i:i+seed_size], []).append(i)
+
+    coverage = [0] * len(seq)
+    for (read, abundance) in zip(readList, readAbundance):
+        for read_seq in (read, str(Seq(read).reverse_complement())):
+            # Candidate placements of the read (offset of its first base on the sequence).
+            offsets = set()
+            for j in range(0, len(read_seq)-seed_size+1, seed_size):
+                for i in kmerPositions.get(read_seq[j:j+seed_size], []):
+                    offsets.add(i-j)
+
+            for offset in offsets:
+                start = max(0, offset)
+                end = min(len(seq), offset+len(read_seq))
+                if end - start < min_overlap:
+                    continue
+                agree = [seq[p] == read_seq[p-offset] for p in range(start, end)]
+                if agree.count(False) > max_subs:
+                    continue
+                for p in range(start, end):
+                    if agree[p-start]:
+                        coverage[p] += abundance
+
+    return coverage
+
+
+#----------------------------------------------------
+# get_read_support function
+#----------------------------------------------------
+def get_read_support(coverage):
+    """To get the read support of a gap-filled sequence: smallest read coverage of one of its positions (see 'get_read_coverage()')."""
+    return min(coverage) if coverage else 0
+
+
+#----------------------------------------------------
+# is_error_variant function
+#----------------------------------------------------
+# Maximal ratio between the read coverage of a sequencing error and the read coverage of the base it replaces.
+ERROR_RATIO = 0.2
+
+def is_error_variant(seq, coverage, other_seq, other_coverage):
+    """
+    To know if a gap-filled sequence is a sequencing error variant of another one: both sequences have the same length and differ by substitutions only,
+    and at each position where they differ, the read coverage of the sequence is lower than 'ERROR_RATIO' times the read coverage of the other sequence
+    (e.g. an allele is supported by a large fraction of the reads, while a sequencing error is shared by a few reads only)
+
+    Args:
+        - seq: str
+            gap-filled sequence
+        - coverage: list
+            read coverage of each position of 'seq' (see 'get_read_coverage()')
+        - other_seq: str
+            other gap-filled sequence
+        - other_coverage: list
+            read coverage of each position of 'other_seq'
+
+    Returns:
+        - Boolean
+            True if 'seq' is a sequencing error variant of 'other_seq'
+    """
+    if len(seq) != len(other_seq) or seq == other_seq:
+        return False
+    return all(coverage[p] < ERROR_RATIO * other_coverage[p] for p in range(len(seq)) if seq[p] != other_seq[p])
+
+
+#----------------------------------------------------
+# join_assemblies function
+#----------------------------------------------------
+def join_assemblies(fwd_assemblies, bwd_assemblies):
+    """
+    To join a forward assembly (extended from the kmer START) with a backward assembly (extended from the reverse complement of the kmer STOP) when they overlap
+    The backward assemblies are indexed by the first 'min_overlap' bp of their reverse complement, and the end of each forward assembly is scanned for these prefixes
+    NB: only the ends of the assemblies are compared (see the class 'Assembly'), so the overlap is at most 'TAIL_SIZE' bp
+
+    Args:
+        - fwd_assemblies: list
+            list of the forward assemblies (Assembly objects)
+        - bwd_assemblies: list
+            list of the backward assemblies (Assembly objects, reverse complement orientation)
+
+    Returns:
+        - assembly: str
+            the sequence of the first forward assembly joined with a backward assembly (overlap of at least 'min_overlap' bp, with 'max_subs' substitutions maximum,
+            the joined sequence being at most 'max_length' bp long), or None if no forward assembly overlaps with a backward assembly
+    """
+    # Index the backward assemblies (in forward orientation) by their prefix.
+    prefixDict = {}
+    max_len_bwd = 0
+    for bwd_assembly in bwd_assemblies:
+        bwd_head = str(Seq(bwd_assembly.tail).reverse_complement())
+        prefixDict.setdefault(bwd_head[:min_overlap], []).append([bwd_assembly, bwd_head])
+        max_len_bwd = max(max_len_bwd, len(bwd_head))
+
+    # Search for the suffix of each forward assembly that is a prefix of a backward assembly (largest overlap first).
+    for fwd_assembly in fwd_assemblies:
+        fwd_tail = fwd_assembly.tail
+        for i in range(max(0, len(fwd_tail)-max_len_bwd), len(fwd_tail)-min_overlap+1):
+            if fwd_tail[i:i+min_overlap] not in prefixDict:
+                continue
+            len_overlap = len(fwd_tail) - i
+            for (bwd_assembly, bwd_head) in prefixDict[fwd_tail[i:i+min_overlap]]:
+                # The joined assembly must not be longer than 'max_length'.
+                if len(bwd_head) < len_overlap or len(fwd_assembly) + len(bwd_assembly) - len_overlap > max_length:
+                    continue
+                # Inexact overlap between both assemblies ([max_subs] substitutions maximum).
+                nb_substitutions = sum(1 for (a, b) in zip(fwd_tail[i+min_overlap:], bwd_head[min_overlap:len_overlap]) if a != b)
+                if nb_substitutions <= max_subs:
+                    return fwd_assembly.sequence() + str(Seq(bwd_assembly.sequence()).reverse_complement())[len_overlap:]
+
+    return None
+
+
+#----------------------------------------------------
+# extend_bidirectional function
+#----------------------------------------------------
+def extend_bidirectional(fwd_reads, bwd_reads, seedDict):
+    """
+    To extend both the reads containing the kmer START (forward frontier) and the reads containing the reverse complement of the kmer STOP (backward frontier)
+    The frontiers are extended level by level (the smallest frontier first), until a forward assembly and a backward assembly overlap,
+    so that each frontier only has to cover about half of the gap
+    At each level, the assemblies ending with the same region (e.g. the last 70 bp) are pruned, only the shortest one being kept,
+    so that the size of a frontier is bounded by the number of distinct regions
+    The Boolean value it returns represents the success of the gap-filling
+
+    Args:
+        - fwd_reads: list
+            list of the positions in readList of the reads containing the whole kmer START's sequence ('-pos' if reverse complement of the read)
+        - bwd_reads: list
+            list of the positions in readList of the reads containing the whole reverse complement of the kmer STOP's sequence ('-pos' if reverse complement of the read)
+        - seedDict: dict
+            dictionary of reads indexed by their seed: key = seed's sequence ; value = list of positions of reads having this seed in readList
+
+    Returns:
+        str, Boolean
+            - the gap-filled sequence (assembly) and a Boolean variable equal to True if a solution is found (e.g. both frontiers overlap, or one of them arrived to the opposite kmer)
+            OR
+            - the reason why the gap-filling failed and a Boolean variable equal to False if no solution is found
+    """
+    START_rc = str(Seq(START).reverse_complement())
+
+    # Frontiers: lists of [assembly (Assembly object), length of the last read of the assembly, length of the last extension].
+    fwd_frontier = []
+    for pos_read in fwd_reads:
+        read = get_read_sequence(pos_read)
+        fwd_frontier.append([Assembly(pos_read, read), len(read), len(read)])
+    bwd_frontier = []
+    for pos_read in bwd_reads:
+        read = get_read_sequence(pos_read)
+        bwd_frontier.append([Assembly(pos_read, read), len(read), len(read)])
+    fwdHash = {}
+    bwdHash = {}
+
+    # The new assemblies of one frontier are compared with all the assemblies of the other frontier.
+    new_fwd = fwd_frontier
+    new_bwd = bwd_frontier
+
+    while fwd_frontier or bwd_frontier:
+
+        # Base cases: one frontier arrived to the opposite kmer.
+        for (assembly, len_read, len_extension) in new_fwd:
+            if kmer_in_extension(assembly.tail, STOP, len_extension):
+                return assembly.sequence(), True
+        for (assembly, len_read, len_extension) in new_bwd:
+            if kmer_in_extension(assembly.tail, START_rc, len_extension):
+                return str(Seq(assembly.sequence()).reverse_complement()), True
+
+        # Both frontiers overlap.
+        if new_fwd is fwd_frontier:
+            joined_assembly = join_assemblies([a[0] for a in new_fwd], [a[0] for a in bwd_frontier])
+        else:
+            joined_assembly = join_assemblies([a[0] for a in fwd_frontier], [a[0] for a in new_bwd])
+        if joined_assembly is not None:
+            return joined_assembly, True
+
+        # Extend the smallest (non-empty) frontier by one level.
+        if fwd_frontier and (not bwd_frontier or len(fwd_frontier) <= len(bwd_frontier)):
+            frontier, frontierHash = fwd_frontier, fwdHash
+        else:
+            frontier, frontierHash = bwd_frontier, bwdHash
+
+        # Assemblies of the next level, indexed by their region (e.g. the last 70 bp of their sequence).
+        nextFrontier = {}
+        for (assembly, len_read, len_extension) in frontier:
+            tail = assembly.tail
+            # Check that we didn't already search for overlapping reads on this region (e.g. on the last 70 bp of the current assembly's sequence) with a larger or equal length budget.
+            budget = max_length - len(assembly)
+            if tail[-70:] in frontierHash and frontierHash[tail[-70:]] >= budget:
+                continue
+            frontierHash[tail[-70:]] = budget
+
+            # Search for reads overlapping with the current assembly's sequence, and group them by their extension.
+            overlapping_reads = find_overlapping_reads(tail, len_read, seedDict, assembly.segment[0])
+            if not overlapping_reads:
+                continue
+            extGroup_filtered = filter_extension_groups(get_extension_groups(tail, overlapping_reads))
+            for extension in extGroup_filtered:
+                if len(assembly) + len(extension) <= max_length:
+                    (read_seq, index, pos_read) = extGroup_filtered[extension][0]
+                    new_assembly = assembly.extend(pos_read, len(tail)-index, extension)
+                    region = new_assembly.tail[-70:]
+                    if region not in nextFrontier or len(new_assembly) < len(nextFrontier[region][0]):
+                        nextFrontier[region] = [new_assembly, len(read_seq), len(extension)]
+        next_frontier = list(nextFrontier.values())
+
+        if frontier is fwd_frontier:
+            fwd_frontier = new_fwd = next_frontier
+            new_bwd = []
+        else:
+            bwd_frontier = new_bwd = next_frontier
+            new_fwd = []
+
+    return "\nNo extension: both frontiers are exhausted", False
@@ -2,10 +2,23 @@
 import os
 import sys
 import re
+import atexit
+import collections
+import functools
+import gzip
+import itertools
+import mmap
+import multiprocessing.pool
+import shelve
 import subprocess
 import gfapy
 from gfapy.sequence import rc
+try:
+    import pysam
+except ImportError:
+    pysam = None
 from Bio import SeqIO
+from stats_alignment_pipeline import stats_alignments
 from datetime import datetime
 
 
@@ -133,23 +146,21 @@ class Scaffold(Gap):
         '''We can't delete an attribute, we raise the exception AttributeError'''
         raise AttributeError("You can't delete attributes from this class")
 
-    #Method "sequence"
-    def sequence(self):
-        '''Method to get the sequence of the scaffold'''
+    #Method "seq_link"
+    def seq_link(self):
+        '''Method to get the path of the FASTA file containing the sequence of the scaffold'''
         #if relative path
         if not str(self.seq_path).startswith('/'):
-            seq_link = str('/'.join(str(self.gfa_file).split('/')[:-1])) +"/"+ str(self.seq_path)
+            return str('/'.join(str(self.gfa_file).split('/')[:-1])) +"/"+ str(self.seq_path)
         #if absolute path
         else:
-            seq_link = self.seq_path
-            
-        #get the sequence of the scaffold
-        for record in SeqIO.parse(seq_link, "fasta"):
-            if re.match(self.name, record.id):
-                if self.orient == "+":
-                    return record.seq
-                elif self.orient == "-":
-                    return rc(record.seq)
+            return str(self.seq_path)
+
+    #Method "sequence"
+    def sequence(self, start=None, end=None):
+        '''Method to get the sequence of the scaffold, or only its region [start, end[ (positions on the scaffold in its orientation)'''
+        #get the sequence of the scaffold, from the indexed FASTA file
+        return get_scaffold_sequence(self.seq_link(), str(self.name), str(self.orient), start, end)
 
     #Method "chunk"
     def chunk(self, c):
@@ -189,49 +200,541 @@ class Scaffold(Gap):
     
 
 
+#----------------------------------------------------
+# IndexedFasta class
+#----------------------------------------------------
+class IndexedFasta:
+    '''
+    Class defining a FASTA file with random access to its sequences, characterized by:
+    - the path of the FASTA file
+    - its offset index ('.fai' format: name, length, offset, bases per line, bytes per line), reused if the '.fai' file is up to date and valid, otherwise built and saved
+    - its memory-mapped content, from which only the requested regions are read (released with 'close()', or when leaving a 'with' block)
+    '''
+
+    #Constructor
+    def __init__(self, fasta_file):
+        self._fasta_file = fasta_file
+        self._index = self._load_index()
+        self._file = open(fasta_file, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta_file) > 0 else b""
+
+    #Accessors
+    def _get_fasta_file(self):
+        '''Method to be call when we want to access the attribute "fasta_file"'''
+        return self._fasta_file
+
+    #Properties
+    fasta_file = property(_get_fasta_file)
+
+    #Method "_load_index"
+    def _load_index(self):
+        '''Method to load the offset index of the FASTA file from its '.fai' file if it is up to date and valid, otherwise to build it (and save it if possible)'''
+        index = collections.OrderedDict()
+        fai_file = self._fasta_file + ".fai"
+        if os.path.exists(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(self._fasta_file):
+            try:
+                with open(fai_file, "r") as fai:
+                    for line in fai:
+                        fields = line.rstrip("\n").split("\t")
+                        index[fields[0]] = [int(field) for field in fields[1:5]]
+                        if len(index[fields[0]]) != 4:
+                            raise ValueError("Truncated line in {}".format(fai_file))
+                if len(index) > 0 or os.path.getsize(self._fasta_file) == 0:
+                    return index
+            except ValueError:
+                pass
+            index = collections.OrderedDict()
+
+        #Build the index in one pass over the FASTA file
+        with open(self._fasta_file, "rb") as fasta:
+            name = None
+            offset = 0
+            for line in fasta:
+                if line.startswith(b">"):
+                    name = line[1:].split()[0].decode()
+                    index[name] = [0, offset + len(line), 0, 0]
+                elif name is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if index[name][2] == 0:
+                        index[name][2] = bases
+                        index[name][3] = len(line)
+                    index[name][0] += bases
+                offset += len(line)
+
+        #Save the index to a temporary file first, then rename it, so that the '.fai' file is never read partially written
+        tmp_fai_file = "{}.{}.tmp".format(fai_file, os.getpid())
+        try:
+            with open(tmp_fai_file, "w") as fai:
+                for (name, entry) in index.items():
+                    fai.write(name + "\t" + "\t".join(str(field) for field in entry) + "\n")
+            os.replace(tmp_fai_file, fai_file)
+        except OSError:
+            if os.path.exists(tmp_fai_file):
+                os.remove(tmp_fai_file)
+
+        return index
+
+    #Method "find_name"
+    def find_name(self, name):
+        '''Method to get the name of the sequence matching 'name' in the FASTA file (exact name, otherwise the first sequence's name matching it as a regular expression)'''
+        if name in self._index:
+            return name
+        for seq_name in self._index:
+            if re.match(name, seq_name):
+                return seq_name
+        return None
+
+    #Method "length"
+    def length(self, name):
+        '''Method to get the length of a sequence of the FASTA file'''
+        return self._index[name][0]
+
+    #Method "fetch"
+    def fetch(self, name, start=0, end=None):
+        '''Method to get the region [start, end[ of a sequence of the FASTA file, by reading only the corresponding bytes'''
+        (length, offset, line_bases, line_width) = self._index[name]
+        start = max(0, start)
+        end = length if end is None else min(length, end)
+        if start >= end:
+            return ""
+        beg = offset + (start // line_bases) * line_width + start % line_bases
+        stop = offset + ((end-1) // line_bases) * line_width + (end-1) % line_bases + 1
+        return self._mmap[beg:stop].decode().replace("\n", "").replace("\r", "")
+
+    #Method "close"
+    def close(self):
+        '''Method to release the memory-mapped content and the file of the FASTA file'''
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._mmap = b""
+        self._file.close()
+
+    #Methods "__enter__" and "__exit__"
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #Method "__repr__"
+    def __repr__(self):
+        return "IndexedFasta: file ({}), sequences ({})".format(self._fasta_file, len(self._index))
+
+
+#Indexed FASTA files already opened (one per file)
+indexedFastas = {}
+
+#----------------------------------------------------
+# index_fasta_files function
+#----------------------------------------------------
+'''
+To build (or validate) the '.fai' offset index of FASTA files once, before the gap-filling processes use them concurrently:
+    - it takes as input the paths of the FASTA files
+    - it writes the missing or outdated '.fai' files
+'''
+def index_fasta_files(seq_files):
+    for seq_file in set(seq_files):
+        with IndexedFasta(seq_file):
+            pass
+
+#----------------------------------------------------
+# close_fasta_files function
+#----------------------------------------------------
+'''
+To close the indexed FASTA files opened by get_scaffold_sequence:
+    - it releases their memory-mapped contents, and empties the cache of the regions' sequences
+'''
+def close_fasta_files():
+    get_sequence_name.cache_clear()
+    regionCache.clear()
+    regionCacheBytes[0] = 0
+    for fasta in indexedFastas.values():
+        fasta.close()
+    indexedFastas.clear()
+
+atexit.register(close_fasta_files)
+
+#----------------------------------------------------
+# get_scaffold_sequence function
+#----------------------------------------------------
+'''
+To get the sequence of a scaffold from its FASTA file, using the offset index of the file:
+    - it takes as input the path of the FASTA file, the scaffold's name and orientation, and the region [start, end[ to get in the orientation of the scaffold (whole sequence if None)
+    - it outputs the sequence of the region, read from the FASTA file with only the corresponding bytes (see 'IndexedFasta.fetch()')
+    - the recently used regions are kept in a cache bounded in size (SEQUENCE_CACHE_BYTES bp), keyed by their positions on the forward strand, so that both orientations of a region share their entry
+'''
+SEQUENCE_CACHE_BYTES = 64 * 1024 * 1024
+
+#Cache of the regions: key = (FASTA file, sequence's name, start, end) on the forward strand ; value = sequence of the region
+regionCache = collections.OrderedDict()
+regionCacheBytes = [0]
+
+@functools.lru_cache(maxsize=None)
+def get_sequence_name(seq_file, name):
+    if seq_file not in indexedFastas:
+        indexedFastas[seq_file] = IndexedFasta(seq_file)
+    fasta = indexedFastas[seq_file]
+
+    seq_name = fasta.find_name(name)
+    if seq_name is None:
+        return None
+    return seq_name, fasta.length(seq_name)
+
+def get_scaffold_sequence(seq_file, name, orient, start=None, end=None):
+    resolved = get_sequence_name(seq_file, name)
+    if resolved is None:
+        return None
+    (seq_name, length) = resolved
+    start = 0 if start is None else max(0, start)
+    end = length if end is None else min(length, end)
+
+    #Region on the forward strand
+    if orient == "+":
+        key = (seq_file, seq_name, start, end)
+    elif orient == "-":
+        key = (seq_file, seq_name, length - end, length - start)
+    else:
+        return None
+
+    if key in regionCache:
+        regionCache.move_to_end(key)
+        sequence = regionCache[key]
+    else:
+        sequence = indexedFastas[seq_file].fetch(seq_name, key[2], key[3])
+        regionCache[key] = sequence
+        regionCacheBytes[0] += len(sequence)
+        #Evict the least recently used regions
+        while regionCacheBytes[0] > SEQUENCE_CACHE_BYTES and len(regionCache) > 1:
+            regionCacheBytes[0] -= len(regionCache.popitem(last=False)[1])
+
+    if orient == "+":
+        return sequence
+    return rc(sequence)
+
+
+#----------------------------------------------------
+# GfaReader class
+#----------------------------------------------------
+class SegmentRecord:
+    '''
+    Class defining a compact segment record (S line of a GFA 2.0 file), characterized by:
+    - its name
+    - its length
+    - the path of its sequence (UR tag, None if absent)
+    '''
+    __slots__ = ("name", "slen", "UR", "raw")
+
+    #Constructor
+    def __init__(self, raw):
+        fields = raw.rstrip("\n").split("\t")
+        self.raw = raw.rstrip("\n")
+        self.name = fields[1]
+        self.slen = int(fields[2])
+        self.UR = None
+        for tag in fields[4:]:
+            if tag.startswith("UR:Z:"):
+                self.UR = tag[5:]
+
+    #Method "__str__"
+    def __str__(self):
+        return self.raw
+
+    #Method "__repr__"
+    def __repr__(self):
+        return "SegmentRecord: name ({}), length ({}), sequence's file ({})".format(self.name, self.slen, self.UR)
+
+
+class SegmentRef:
+    '''
+    Class defining an oriented reference to a segment (e.g. 'sid1' or 'sid2' of a G line), characterized by:
+    - the segment's name
+    - its orientation
+    - the segment record it refers to ('line'), looked up lazily by name in the GFA file
+    '''
+    __slots__ = ("name", "orient", "_reader", "_line")
+
+    #Constructor
+    def __init__(self, ref, reader):
+        self.name = ref[:-1]
+        self.orient = ref[-1]
+        self._reader = reader
+        self._line = None
+
+    #Accessors
+    def _get_line(self):
+        '''Method to be call when we want to access the attribute "line"'''
+        if self._line is None:
+            self._line = self._reader.segment(self.name)
+        return self._line
+
+    #Properties
+    line = property(_get_line)
+
+    #Method "__eq__"
+    def __eq__(self, other):
+        return isinstance(other, SegmentRef) and (self.name, self.orient) == (other.name, other.orient)
+
+    #Method "__hash__"
+    def __hash__(self):
+        return hash((self.name, self.orient))
+
+    #Method "__str__"
+    def __str__(self):
+        return self.name + self.orient
+
+    #Method "__repr__"
+    def __repr__(self):
+        return "SegmentRef: {}".format(str(self))
+
+
+class GapRecord:
+    '''
+    Class defining a compact gap record (G line of a GFA 2.0 file), characterized by:
+    - its ID ('gid'), its length ('disp') and its variance ('var')
+    - its left and right flanking segments ('sid1' and 'sid2', see the class 'SegmentRef')
+    - its line number in the GFA file
+    '''
+    __slots__ = ("gid", "sid1", "sid2", "disp", "var", "line_number", "raw")
+
+    #Constructor
+    def __init__(self, raw, reader, line_number=None):
+        fields = raw.rstrip("\n").split("\t")
+        self.raw = raw.rstrip("\n")
+        self.gid = fields[1]
+        self.sid1 = SegmentRef(fields[2], reader)
+        self.sid2 = SegmentRef(fields[3], reader)
+        self.disp = int(fields[4])
+        self.var = fields[5] if len(fields) > 5 else "*"
+        self.line_number = line_number
+
+    #Method "__str__"
+    def __str__(self):
+        return self.raw
+
+    #Method "__repr__"
+    def __repr__(self):
+        return "GapRecord: id ({}), length ({}), left flanking seq ({}), right flanking seq ({})".format(self.gid, self.disp, self.sid1, self.sid2)
+
+
+class GfaReader:
+    '''
+    Class defining a streaming reader of a GFA 2.0 file, without loading it in memory, characterized by:
+    - the path of the GFA file
+    - the offset index of its segments (S lines), built at the first lookup of a segment by name
+    - the segment records already looked up
+    The gaps are yielded as compact records (see the class 'GapRecord'), whose flanking segments are looked up lazily.
+    '''
+
+    #Constructor
+    def __init__(self, gfa_file):
+        self._gfa_file = gfa_file
+        self._segment_offsets = None
+        self._segments = {}
+
+    #Accessors
+    def _get_gfa_file(self):
+        '''Method to be call when we want to access the attribute "gfa_file"'''
+        return self._gfa_file
+
+    #Properties
+    gfa_file = property(_get_gfa_file)
+
+    #Method "lines"
+    def lines(self):
+        '''Method to iterate over the (non-empty) lines of the GFA file, as [line number, line]'''
+        with open(self._gfa_file, "r") as gfa:
+            for (line_number, line) in enumerate(gfa, 1):
+                line = line.rstrip("\n")
+                if line:
+                    yield line_number, line
+
+    #Method "segment_lines"
+    def segment_lines(self):
+        '''Method to iterate over the segments' lines (S lines) of the GFA file'''
+        for (line_number, line) in self.lines():
+            if line.startswith("S\t"):
+                yield line
+
+    #Method "gaps"
+    def gaps(self):
+        '''Method to iterate over the gaps (G lines) of the GFA file, as compact records'''
+        for (line_number, line) in self.lines():
+            if line.startswith("G\t"):
+                yield GapRecord(line, self, line_number)
+
+    #Method "parse_gap"
+    def parse_gap(self, line):
+        '''Method to get the compact record of a gap from its G line'''
+        return GapRecord(line, self)
+
+    #Method "index_segments"
+    def index_segments(self):
+        '''Method to build the offset index of the segments (S lines), in one pass over the GFA file'''
+        self._segment_offsets = {}
+        with open(self._gfa_file, "rb") as gfa:
+            offset = 0
+            for line in gfa:
+                if line.startswith(b"S\t"):
+                    self._segment_offsets[line.split(b"\t", 2)[1].decode()] = offset
+                offset += len(line)
+
+    #Method "segment"
+    def segment(self, name):
+        '''Method to get the record of a segment from its name, by reading only its S line (using the offset index of the segments)'''
+        if name not in self._segments:
+            if self._segment_offsets is None:
+                self.index_segments()
+            if name not in self._segment_offsets:
+                return None
+            with open(self._gfa_file, "rb") as gfa:
+                gfa.seek(self._segment_offsets[name])
+                self._segments[name] = SegmentRecord(gfa.readline().decode())
+        return self._segments[name]
+
+    #Method "__repr__"
+    def __repr__(self):
+        return "GfaReader: GFA file ({})".format(self._gfa_file)
+
+
+#----------------------------------------------------
+# parse_region function
+#----------------------------------------------------
+'''
+To parse a region 'name:start-end' (e.g. obtained with the method 'chunk()' of the class 'Scaffold'), given as for samtools/BamExtractor (1-based, end included):
+    - it takes as input the region
+    - it outputs the name of the sequence, and the start and end positions of the region, 0-based and end excluded (as for pysam)
+'''
+def parse_region(region):
+    name, positions = region.rsplit(':', 1)
+    start, end = positions.split('-')
+    return name, max(0, int(start) - 1), int(end)
+
+
 #----------------------------------------------------
 # extract_barcodes function
 #----------------------------------------------------
 '''
-To extract the barcodes of reads mapping on chunks, with BamExtractor:
-    - it takes as input the BAM file, the gap label, the chunk region on which to extract the barcodes, and the dictionary 'barcodes_occ'
-    - it outputs the updated dictionary 'barcodes_occ' containing the occurences for each barcode extracted on the chunk region
+To extract the barcodes of reads mapping on chunks, in process with pysam if it is installed (and the BAM file is indexed), otherwise with BamExtractor:
+    - it takes as input the BAM file, the gap label, the chunk region on which to extract the barcodes, and the Counter 'barcodes_occ'
+    - it outputs the updated Counter 'barcodes_occ' containing the occurences for each barcode extracted on the chunk region
+    - the output of BamExtractor is streamed through a pipe, without temporary file
 '''
 def extract_barcodes(bam, gap_label, region, barcodes_occ):
+    #In process extraction with pysam: barcodes of the reads mapping on the region (BX tag)
+    if pysam is not None:
+        with pysam.AlignmentFile(bam, "rb") as bamFile:
+            if bamFile.has_index():
+                name, start, end = parse_region(region)
+                for read in bamFile.fetch(name, start, end):
+                    if read.has_tag("BX"):
+                        #remove the '-1' at the end of the sequence
+                        barcodes_occ[str(read.get_tag("BX")).split('-')[0]] += 1
+                return barcodes_occ
+
     command = ["BamExtractor", bam, region]
     bamextractorLog = str(gap_label) + "_bamextractor.log"
-    tmp_barcodes_file = str(gap_label) + "_bam-extractor-stdout.txt"
 
     #BamExtractor
-    with open(tmp_barcodes_file, "w+") as f, open(bamextractorLog, "a") as log:
-        subprocess.run(command, stdout=f, stderr=log)
-        f.seek(0)
-
-        #Save the barcodes and their occurences in the dict 'barcodes_occ'
-        for line in f.readlines():
-            #remove the '-1' at the end of the sequence
-            barcode_seq = line.split('-')[0]
-            #count occurences of each barcode and save them in the dict 'barcodes_occ'
-            if barcode_seq in barcodes_occ:
-                barcodes_occ[barcode_seq] += 1
-            else:
-                barcodes_occ[barcode_seq] = 1
-
-    #remove the raw files obtained from BamExtractor
-    subprocess.run(["rm", tmp_barcodes_file])
+    with open(bamextractorLog, "a") as log:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log, universal_newlines=True)
+
+        #Count the occurences of each barcode in the Counter 'barcodes_occ', as the output of BamExtractor arrives
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            if line:
+                #remove the '-1' at the end of the sequence
+                barcodes_occ[line.split('-')[0]] += 1
+        process.wait()
+
+    #remove the empty log file
     if os.path.getsize(bamextractorLog) <= 0:
-        subprocess.run(["rm", bamextractorLog])
+        os.remove(bamextractorLog)
 
     return barcodes_occ
 
 
+#----------------------------------------------------
+# extract_barcodes_batch function
+#----------------------------------------------------
+'''
+To extract the barcodes of reads mapping on several chunk regions (e.g. the chunk regions of all gaps), in one sorted sweep over the BAM file:
+    - it takes as input the BAM file, the list of chunk regions, and the path of the shelve file used as a cache of the barcodes' occurences per region, across gaps and runs (optional)
+    - it outputs the dictionary 'regionBarcodes' containing the region as key, and the Counter of the occurences for each barcode extracted on the region as value
+    - with pysam, the overlapping regions of each sequence are merged and fetched once, in the order of the BAM file, each read being counted in all regions it overlaps;
+      otherwise, each distinct region is extracted once with BamExtractor (see 'extract_barcodes()'), 'processes' extractions at once (default: number of CPUs)
+'''
+def extract_barcodes_batch(bam, regions, cache_file=None, processes=None):
+    regionBarcodes = {}
+
+    #The regions cached for another version of the BAM file are not reused
+    bam_stat = os.stat(bam)
+    cache_prefix = "{}:{}:{}:".format(bam, bam_stat.st_size, int(bam_stat.st_mtime))
+    cache = shelve.open(cache_file) if cache_file is not None else {}
+
+    try:
+        #Get the regions already extracted
+        new_regions = []
+        for region in sorted(set(regions)):
+            if cache_prefix + region in cache:
+                regionBarcodes[region] = collections.Counter(cache[cache_prefix + region])
+            else:
+                regionBarcodes[region] = collections.Counter()
+                new_regions.append(region)
+
+        bamFile = pysam.AlignmentFile(bam, "rb") if (pysam is not None and new_regions) else None
+        if bamFile is not None and bamFile.has_index():
+            #Merge the overlapping regions of each sequence
+            regionsPerSeq = collections.defaultdict(list)
+            for region in new_regions:
+                name, start, end = parse_region(region)
+                regionsPerSeq[name].append([start, end, region])
+
+            #Sweep over the sequences in the order of the BAM file
+            for name in bamFile.references:
+                merged = []
+                for (start, end, region) in sorted(regionsPerSeq.get(name, [])):
+                    if merged and start <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], end)
+                        merged[-1][2].append([start, end, region])
+                    else:
+                        merged.append([start, end, [[start, end, region]]])
+
+                for (start, end, members) in merged:
+                    for read in bamFile.fetch(name, start, end):
+                        if read.has_tag("BX"):
+                            #remove the '-1' at the end of the sequence
+                            barcode = str(read.get_tag("BX")).split('-')[0]
+                            read_end = read.reference_end if read.reference_end is not None else read.reference_start + 1
+                            for (region_start, region_end, region) in members:
+                                if read.reference_start < region_end and read_end > region_start:
+                                    regionBarcodes[region][barcode] += 1
+        elif new_regions:
+            # NB: threads are enough to wait for the BamExtractor processes (one log file per region).
+            nb_processes = min(processes or multiprocessing.cpu_count(), len(new_regions))
+            with multiprocessing.pool.ThreadPool(nb_processes) as pool:
+                pool.starmap(extract_barcodes, [(bam, "{}.{}".format(os.path.basename(bam), region), region, regionBarcodes[region]) for region in new_regions])
+        if bamFile is not None:
+            bamFile.close()
+
+        #Save the new regions in the cache
+        if cache_file is not None:
+            for region in new_regions:
+                cache[cache_prefix + region] = dict(regionBarcodes[region])
+
+    finally:
+        if cache_file is not None:
+            cache.close()
+
+    return regionBarcodes
+
+
 #----------------------------------------------------
 # get_reads function
 #----------------------------------------------------
 '''
 To extract the the reads associated to the barcodes:
-    - it takes as input the reads file, the barcodes index file, the gap label, the file containing the barcodes of the union, and the name of the output file containing the reads of the union
-    - it outputs the file containing the reads of the union
+    - it takes as input the reads file, the barcodes index file, the gap label, the file containing the barcodes of the union, and the output file object for the reads of the union
+      (or 'subprocess.PIPE' to keep them in memory)
+    - it outputs the output file object, or the reads of the union (FASTQ string) if they are kept in memory
 '''
 def get_reads(reads, index, gap_label, barcodes, out_reads):
     command = ["reads_bx_sqlite3.py", "--fastq", reads, "--idx", index, "--bdx", barcodes, "--mode", "shelve"]
@@ -239,31 +742,101 @@ def get_reads(reads, index, gap_label, barcodes, out_reads):
 
     #reads_bx_sqlite3.py
     with open(getreadsLog, "a") as log:
-        subprocess.run(command, stdout=out_reads, stderr=log)
+        result = subprocess.run(command, stdout=out_reads, stderr=log, universal_newlines=True)
 
+    if out_reads == subprocess.PIPE:
+        return result.stdout
     return out_reads
 
 
 #----------------------------------------------------
-# stats_align function
+# get_reads_batch function
 #----------------------------------------------------
 '''
-To perform statistics on the alignment between a reference sequence and query sequences
-    - it takes as input the gap label, the file containing the gap-filled sequences obtained from MindTheGap, the file containing either the reference sequence or the flanking contigs' sequences, 
-      the size of the extension of the gap, the prefix name of the output files, the name of the output directory for saving the results
+To extract the reads associated to the barcodes of several gaps, in a single pass over the reads file:
+    - it takes as input the reads file (FASTQ, barcode of each read in the 'BX:Z:' tag of its header), the dictionary 'gapBarcodes' containing the gap label as key
+      and the set of barcodes of its union as value, and the dictionary 'outReadsFiles' containing the gap label as key and the name of the output file for the reads of its union as value
+      (optional: if None, the reads are kept in memory: the reads of the unions of all gaps are then held at once, so this is only suited to small datasets)
+    - it outputs the dictionary 'nbReads' containing the gap label as key, and the number of reads of its union as value,
+      or if the reads are kept in memory, the dictionary 'gapReads' containing the gap label as key, and the list of the reads' records (FASTQ) of its union as value
+    - an inverted index (barcode -> gaps) routes each read to all the gaps needing it; the reads are buffered and appended to the output files by batches of 'buffer_size' reads
+    - the blank lines of the reads file are skipped, and a ValueError is raised on a malformed or truncated FASTQ record
 '''
-def stats_align(gap_label, qry_file, ref_file, ext, prefix, out_dir):
-    scriptPath = sys.path[0]
-    stats_align_command = os.path.join(scriptPath, "stats_alignment_pipeline.py")
-    command = [stats_align_command, "-qry", qry_file, "-ref", ref_file, "-ext", ext, "-p", prefix, "-out", out_dir]
-    statsLog = str(gap_label) + "_stats_align.log"
+def get_reads_batch(reads, gapBarcodes, outReadsFiles=None, buffer_size=100000):
+    #Inverted index: barcode -> gaps
+    barcodeGaps = collections.defaultdict(list)
+    for (gap_label, barcodes) in gapBarcodes.items():
+        for barcode in barcodes:
+            barcodeGaps[barcode].append(gap_label)
+
+    nbReads = {gap_label: 0 for gap_label in gapBarcodes}
+    buffers = collections.defaultdict(list)
+    nb_buffered = 0
+    #Reads kept in memory: the buffers are never flushed
+    if outReadsFiles is None:
+        buffer_size = float("inf")
+    else:
+        for out_file in outReadsFiles.values():
+            open(out_file, "w").close()
+
+    def flush_buffers():
+        if outReadsFiles is None:
+            return
+        for (gap_label, records) in buffers.items():
+            with open(outReadsFiles[gap_label], "a") as out_reads:
+                out_reads.writelines(records)
+        buffers.clear()
+
+    #Stream the reads file once, and route each read to the gaps needing its barcode
+    with (gzip.open(reads, "rt") if reads.endswith(".gz") else open(reads, "r")) as reads_file:
+        lines = (line for line in reads_file if line.strip())
+        for record in itertools.zip_longest(*[lines] * 4):
+            if record[3] is None:
+                raise ValueError("Truncated FASTQ record in {}: {}".format(reads, record[0].rstrip()))
+            if not record[0].startswith("@") or not record[2].startswith("+"):
+                raise ValueError("Malformed FASTQ record in {}: {}".format(reads, record[0].rstrip()))
+            record = list(record)
+            if not record[3].endswith("\n"):
+                record[3] += "\n"
+            header = record[0]
+            tag = re.search(r'BX:Z:(\S+)', header)
+            if tag is None:
+                continue
+            #remove the '-1' at the end of the barcode
+            for gap_label in barcodeGaps.get(tag.group(1).split('-')[0], []):
+                buffers[gap_label].append("".join(record))
+                nbReads[gap_label] += 1
+                nb_buffered += 1
+            if nb_buffered >= buffer_size:
+                flush_buffers()
+                nb_buffered = 0
+    flush_buffers()
+
+    if outReadsFiles is None:
+        return {gap_label: buffers.get(gap_label, []) for gap_label in gapBarcodes}
+    return nbReads
+
 
-    with open(statsLog, "a") as log:
-        subprocess.run(command, stderr=log)
+#----------------------------------------------------
+# stats_align function
+#----------------------------------------------------
+'''
+To perform statistics on the alignments between the reference sequences and the query sequences of several gaps, in process (see 'stats_alignments()' in 'stats_alignment_pipeline.py'):
+    - it takes as input the list of alignments to perform, each one as [gap label, file containing the gap-filled sequences, file containing either the reference sequence or the flanking contigs' sequences,
+      size of the extension of the gap, prefix name of the output files], the name of the output directory for saving the results, the aligner used ('nucmer' or 'pairwise'),
+      and the format of the alignment stats' files ('tsv' or 'npz')
+    - it outputs the dictionary 'alignmentStats' containing the prefix of each alignment as key, and the list of its stats' rows as value
+'''
+def stats_align(alignments, out_dir, aligner="nucmer", stats_format="tsv"):
+    try:
+        return stats_alignments([alignment[1:] for alignment in alignments], out_dir, aligner, stats_format=stats_format)
 
-    #remove the raw file obtained from statistics
-    if os.path.getsize(statsLog) <= 0:
-        subprocess.run(["rm", statsLog])
+    #The gaps without alignment stats are evaluated as without alignment
+    except Exception as e:
+        for alignment in alignments:
+            with open(str(alignment[0]) + "_stats_align.log", "a") as log:
+                log.write("Exception- {}\n".format(e))
+        return {}
 
 
 #----------------------------------------------------
@@ -331,54 +904,89 @@ def get_output_for_gfa(record, ext, seed_size, min_overlap, s1, s2, left_scaffol
 
 
 #----------------------------------------------------
-# update_gfa_with_solution function
+# GfaWriter class
 #----------------------------------------------------
-#Function to update the GFA when a solution is found for a gap
-def update_gfa_with_solution(outDir, gfa_name, output_for_gfa, gfa_output_file):
-
-    #Variables input
-    sol_name = output_for_gfa[0]
-    length_seq = output_for_gfa[1]
-    seq = output_for_gfa[2]
-    solution = output_for_gfa[3]
-    pos_1 = output_for_gfa[4]
-    pos_2 = output_for_gfa[5]
-    s1 = sol_name.split(':')[0]
-    s2 = (sol_name.split(':')[1]).split('_gf')[0]
-    quality = output_for_gfa[6]
-
-    print("Updating the GFA file with the solution: " + sol_name)
+class GfaWriter:
+    '''
+    Class defining a writer of the output GFA file, characterized by:
+    - the path of the output GFA file
+    - the path of the FASTA file containing all gap-filled sequences
+    - the buffers of the new GFA lines and of the gap-filled sequences' records, appended to their files by batches of 'batch_size' lines
+    Each line is validated once with gfapy when it is added, without reloading the output GFA file.
+    '''
 
-    #Save the found seq to a file containing all gapfill seq
-    gapfill_file = gfa_name + ".gapfill_seq.fasta"
-    with open(gapfill_file, "a") as seq_fasta:
-        seq_fasta.write(">{} _ len_{}_qual_{} ".format(sol_name, length_seq, quality))
-        seq_fasta.write("\n" + seq + "\n")
+    #Constructor
+    def __init__(self, gfa_output_file, gapfill_file, batch_size=1000):
+        self._gfa_output_file = gfa_output_file
+        self._gapfill_file = gapfill_file
+        self._batch_size = batch_size
+        self._lines = []
+        self._records = []
 
-    with open(gfa_output_file, "a") as f:
-        '''
-        #Not used anymore, as I check in the gapfilling pipeline that the length of the solution found is > 2*ext to stop searching for a gapfilled seq
-        if length_seq < 2*ext:
-            print("Query length is too short (<2*ext): overlap of source and destination read")
-            print("Rewriting the gap line to the GFA output file...")
+    #Accessors
+    def _get_gfa_output_file(self):
+        '''Method to be call when we want to access the attribute "gfa_output_file"'''
+        return self._gfa_output_file
+    def _get_gapfill_file(self):
+        '''Method to be call when we want to access the attribute "gapfill_file"'''
+        return self._gapfill_file
 
-            #Rewrite the current G line into GFA output
-            with open("tmp.gap", "r") as tmp_gap, open(gfa_output_file, "a") as f:
-                out_gfa = gfapy.Gfa.from_file(gfa_output_file)
-                for line in tmp_gap.readlines():
-                    out_gfa.add_line(line)
-                out_gfa.to_file(gfa_output_file)
+    #Properties
+    gfa_output_file = property(_get_gfa_output_file)
+    gapfill_file = property(_get_gapfill_file)
+
+    #Method "add_line"
+    def add_line(self, line):
+        '''Method to validate a GFA line (GFA 2.0) and add it to the buffer of the output GFA file'''
+        self._lines.append(str(gfapy.Line(str(line), version="gfa2")))
+        if len(self._lines) >= self._batch_size:
+            self.flush()
+
+    #Method "add_solution"
+    def add_solution(self, outDir, output_for_gfa):
+        '''Method to add a solution found for a gap: its record to the FASTA file containing all gap-filled sequences, its S line and the two corresponding E lines to the output GFA file'''
+        #Variables input
+        sol_name = output_for_gfa[0]
+        length_seq = output_for_gfa[1]
+        seq = output_for_gfa[2]
+        solution = output_for_gfa[3]
+        pos_1 = output_for_gfa[4]
+        pos_2 = output_for_gfa[5]
+        s1 = sol_name.split(':')[0]
+        s2 = (sol_name.split(':')[1]).split('_gf')[0]
+        quality = output_for_gfa[6]
+
+        print("Updating the GFA file with the solution: " + sol_name)
+
+        #Save the found seq to the file containing all gapfill seq
+        self._records.append(">{} _ len_{}_qual_{} \n{}\n".format(sol_name, length_seq, quality, seq))
 
-        else:
-        '''
         #Add the found seq (query seq) to GFA output (S line)
-        out_gfa = gfapy.Gfa.from_file(gfa_output_file)
-        out_gfa.add_line("S\t{}\t{}\t*\tUR:Z:{}".format(sol_name, length_seq, os.path.join(outDir, gapfill_file)))
+        self.add_line("S\t{}\t{}\t*\tUR:Z:{}".format(sol_name, length_seq, os.path.join(outDir, self._gapfill_file)))
 
         #Write the two corresponding E lines into GFA output
-        out_gfa.add_line("E\t*\t{}\t{}\t{}\t{}\t{}\t{}\t*".format(s1, solution, pos_1[0], pos_1[1], pos_1[2], pos_1[3]))
-        out_gfa.add_line("E\t*\t{}\t{}\t{}\t{}\t{}\t{}\t*".format(solution, s2, pos_2[0], pos_2[1], pos_2[2], pos_2[3]))
+        self.add_line("E\t*\t{}\t{}\t{}\t{}\t{}\t{}\t*".format(s1, solution, pos_1[0], pos_1[1], pos_1[2], pos_1[3]))
+        self.add_line("E\t*\t{}\t{}\t{}\t{}\t{}\t{}\t*".format(solution, s2, pos_2[0], pos_2[1], pos_2[2], pos_2[3]))
+
+        return self._gapfill_file
+
+    #Method "flush"
+    def flush(self):
+        '''Method to append the buffered lines and records to the output GFA file and to the FASTA file containing all gap-filled sequences'''
+        if self._records:
+            with open(self._gapfill_file, "a") as seq_fasta:
+                seq_fasta.writelines(self._records)
+            self._records = []
+        if self._lines:
+            with open(self._gfa_output_file, "a") as f:
+                f.writelines(line + "\n" for line in self._lines)
+            self._lines = []
+
+    #Method "close"
+    def close(self):
+        '''Method to write the remaining buffered lines and records'''
+        self.flush()
 
-        out_gfa.to_file(gfa_output_file)
-
-        return gapfill_file
\ No newline at end of file
+    #Method "__repr__"
+    def __repr__(self):
+        return "GfaWriter: GFA output file ({}), gap-filled sequences' file ({}), buffered lines ({})".format(self._gfa_output_file, self._gapfill_file, len(self._lines))
@@ -2,7 +2,7 @@
 """Module 'main.py': initialization of the script OLC
 
 The module 'main.py' enables to get the input parameters and creates the file and directory in which to save the results.
-It creates as well the list 'readList' containing all reads' sequences.
+It creates as well the list 'readList' containing all reads' sequences, and the list 'readAbundance' containing the number of reads of the dataset each read stands for.
 """
 
 from __future__ import print_function
@@ -11,6 +11,7 @@ import os
 import re
 import sys
 from Bio import SeqIO
+from preprocessing import correct_reads, collapse_duplicate_reads, normalize_reads
 
 
 #----------------------------------------------------
@@ -21,21 +22,43 @@ parser = argparse.ArgumentParser(prog="olc.py", usage="%(prog)s -in <input_seque
                                 description=("Gapfilling, using an Overlap-Layout-Consensus (OLC) method"))
 
 parser.add_argument('-in', action="store", dest="input", help="Input sequences to gapfill (for example, kmers start and stop)", required=True)
-parser.add_argument('-reads', action="store", dest="reads", help="File of reads", required=True)
+parser.add_argument('-reads', action="store", dest="reads", help="File of reads ('-': reads given on the standard input, in FASTA or FASTQ format)", required=True)
 parser.add_argument('-s', action="store", dest="seed_size", type=int, help="Seed size used for indexing the reads (bp)", required=True)
+parser.add_argument('-backend', action="store", dest="overlap_backend", choices=["seed", "sa"], default="seed", help="Index used for searching the overlapping reads: 'seed' (dictionary of the reads' prefix seeds) or 'sa' (sorted array of the reads and of their reverse complement, built with NumPy ;\nthe options '-s_fallback', '-spaced' and '-max_seed_freq' apply to the 'seed' index only).\nNB: the search with 'sa' is slower than with 'seed', as it is performed at each position of the assembly [default: seed]")
+parser.add_argument('-s_fallback', action="store", dest="seed_fallback", nargs='+', type=int, default=[], help="Smaller seed size(s) also used for indexing the reads: at each extension step, the smaller seeds are used (largest first) only if the larger ones give no overlapping read (bp)")
+parser.add_argument('-spaced', action="store", dest="spaced_seeds", nargs='+', help="Spaced seed mask(s) used for indexing the reads instead of the contiguous seed of size '-s', as strings of '1' (care positions) and '0' (don't care positions),\nfor example 1101101101101101101101 ; the mismatches at the don't care positions are counted as substitutions of the overlap (the span of a mask should not exceed seed_size + min_overlap) [default: contiguous seed of size '-s']")
 parser.add_argument('-o', action="store", dest="min_overlap", type=int, help="Minimum overlapping size (bp)", required=True)
 parser.add_argument('-a', action="store", dest="abundance_min", nargs='*', type=int, default=2, help="Minimal abundance(s) of reads used for gapfilling ; extension's groups having less than this number of reads are discarded from the graph")
 parser.add_argument('-l', action="store", dest="max_length", type=int, help="Maximum assembly length (bp) (it could correspond to the length of the gap to fill (+length input sequences) OR it could be a very high length to prevent for searching indefinitely", required=True)
 parser.add_argument('-subs', action="store", dest="max_subs", type=int, default=2, help="Maximum number of substitutions allowed in the inexact overlap between reads")
 parser.add_argument('-out', action="store", dest="outdir", default="./olc_results", help="Output directory for the results' files")
 parser.add_argument('-assembly', action="store", dest="assembly_file", help="Name for the output assembly file")
+parser.add_argument('-n', action="store", dest="nb_solutions", type=int, default=1, help="Maximal number of distinct gap-filled sequences to output, ranked by read support [default: 1]")
+parser.add_argument('-bidir', action="store_true", dest="bidirectional", help="Extend both from the reads containing the kmer start and from the reads containing the reverse complement of the kmer stop,\nand join both extensions when they overlap (at least 'min_overlap' bp)")
+parser.add_argument('-reach', action="store", dest="reach_hops", type=int, default=0, help="Maximum number of overlaps from the reads containing the kmer stop used to rank the extension's groups by their proximity to the kmer stop,\nand to discard the ones that cannot reach it within the maximum assembly length [default: 0 (disabled)]")
+parser.add_argument('-max_seed_freq', action="store", dest="max_seed_freq", type=int, help="Maximal number of reads per seed: the seeds indexing more reads are only used when no other seed gives a putative overlapping read\n(0: set automatically to 10 times the median number of reads per seed) [default: no limit]")
+parser.add_argument('-overlap_cache', action="store", dest="overlap_cache_size", type=int, default=100000, help="Maximal number of read-to-read overlaps kept in the cache shared by all branches of the extension (0: no cache) [default: 100000]")
+parser.add_argument('-ec', action="store_true", dest="error_correction", help="Correct the sequencing errors of the reads based on their kmer spectrum (solid kmers), before indexing them")
+parser.add_argument('-ec_k', action="store", dest="ec_k", type=int, default=21, help="Kmer size used for the error correction of the reads (<= 31) [default: 21]")
+parser.add_argument('-ec_solid', action="store", dest="ec_solid", type=int, default=3, help="Minimal number of occurrences of a solid kmer, for the error correction of the reads [default: 3]")
+parser.add_argument('-ec_threads', action="store", dest="ec_threads", type=int, default=1, help="Number of worker processes used for the error correction of the reads (0: number of CPUs) [default: 1]")
+parser.add_argument('-norm', action="store", dest="norm_coverage", type=int, default=0, help="Target coverage of the digital normalization of the reads: reads whose median kmer coverage already reaches this value are discarded,\ntheir abundance being kept for the '-a' filter [default: 0 (disabled)]")
+parser.add_argument('-norm_k', action="store", dest="norm_k", type=int, default=20, help="Kmer size used for the digital normalization of the reads [default: 20]")
 
 args = parser.parse_args()
 
 if not re.match('^.*.fasta$', args.input) and not re.match('^.*.fa$', args.input):
     parser.error("The input file should be a FASTA file.")
-if not re.match('^.*.fasta$', args.reads) and not re.match('^.*.fa$', args.reads) and not re.match('^.*.fastq$', args.reads) and not re.match('^.*.fq$', args.reads):
+if args.reads != "-" and not re.match('^.*.fasta$', args.reads) and not re.match('^.*.fa$', args.reads) and not re.match('^.*.fastq$', args.reads) and not re.match('^.*.fq$', args.reads):
     parser.error("The reads file should be a FASTA or FASTQ file.")
+if args.spaced_seeds is not None and not all(re.match('^1[01]*1$|^1$', mask) for mask in args.spaced_seeds):
+    parser.error("The spaced seed masks should be strings of '0' and '1', beginning and ending with '1'.")
+if not all(0 < size < args.seed_size for size in args.seed_fallback):
+    parser.error("The fallback seed sizes should be smaller than the seed size.")
+if args.error_correction and not 0 < args.ec_k <= 31:
+    parser.error("The kmer size used for the error correction of the reads should be between 1 and 31.")
+if args.bidirectional and (args.nb_solutions > 1 or args.reach_hops > 0):
+    parser.error("The bidirectional mode ('-bidir') outputs a single gap-filled sequence and doesn't use the proximity to the kmer stop: it can't be combined with '-n' or '-reach'.")
 
 #----------------------------------------------------
 # Input files
@@ -47,10 +70,11 @@ if not os.path.exists(input_file):
 print("\nInput file: " + input_file)
 
 # Get the reads file (FASTA or FASTQ).
-reads_file = os.path.abspath(args.reads)
-if not os.path.exists(reads_file):
+# (or read them from the standard input, e.g. handed over in memory by the pipeline)
+reads_file = os.path.abspath(args.reads) if args.reads != "-" else "-"
+if reads_file != "-" and not os.path.exists(reads_file):
     parser.error("The path of the reads' file doesn't exist.")
-print("Reads' file: " + reads_file)
+print("Reads' file: " + (reads_file if reads_file != "-" else "standard input"))
 
 # Get the inputs' sequences.
 with open(input_file, "r") as inputFile:
@@ -84,10 +108,18 @@ print("\nThe results are saved in " + outDir)
 # Parameters
 #----------------------------------------------------
 seed_size = args.seed_size
+overlap_backend = args.overlap_backend
+seed_fallback = sorted(set(args.seed_fallback), reverse=True)
+seed_masks = args.spaced_seeds if args.spaced_seeds is not None else ["1"*seed_size]
 min_overlap = args.min_overlap
 list_of_abundance_min = args.abundance_min
 max_length = args.max_length
 max_subs = args.max_subs
+nb_solutions = args.nb_solutions
+bidirectional = args.bidirectional
+reach_hops = args.reach_hops
+max_seed_freq = args.max_seed_freq
+overlap_cache_size = args.overlap_cache_size
 
 #----------------------------------------------------
 # Output file for saving results
@@ -101,8 +133,30 @@ assembly_file = os.path.abspath(outDir +"/"+ args.assembly_file)
 # Create the list 'readList' containing all reads' sequences.
 readList = []
 
-with open(reads_file, "r") as readsFile:
-    if re.match('^.*.fasta$', reads_file) or re.match('^.*.fa$', reads_file):
-        readList = [str(read.seq) for read in SeqIO.parse(readsFile, "fasta")]
-    elif re.match('^.*.fastq$', reads_file) or re.match('^.*.fq$', reads_file):
-        readList = [str(read.seq) for read in SeqIO.parse(readsFile, "fastq")]
+if reads_file == "-":
+    # Format of the reads given on the standard input, from their first record (peeked, the standard input is parsed as a stream)
+    reads_format = "fastq" if sys.stdin.buffer.peek(1).lstrip().startswith(b"@") else "fasta"
+    readList = [str(read.seq) for read in SeqIO.parse(sys.stdin, reads_format)]
+else:
+    with open(reads_file, "r") as readsFile:
+        if re.match('^.*.fasta$', reads_file) or re.match('^.*.fa$', reads_file):
+            readList = [str(read.seq) for read in SeqIO.parse(readsFile, "fasta")]
+        elif re.match('^.*.fastq$', reads_file) or re.match('^.*.fq$', reads_file):
+            readList = [str(read.seq) for read in SeqIO.parse(readsFile, "fastq")]
+
+# Correct the sequencing errors of the reads, so that they do not create spurious extension's groups.
+if args.error_correction:
+    corrected_reads = correct_reads(readList, args.ec_k, args.ec_solid, args.ec_threads or None)
+    print("\nError correction: {} reads corrected out of {}".format(sum(read != corrected for (read, corrected) in zip(readList, corrected_reads)), len(readList)))
+    readList = corrected_reads
+
+# Collapse the exact duplicate reads, and create the list 'readAbundance' containing the number of reads of the dataset each read of 'readList' stands for.
+nb_reads = len(readList)
+readList, readAbundance = collapse_duplicate_reads(readList)
+print("\n{} unique reads out of {}".format(len(readList), nb_reads))
+
+# Digital normalization of the reads, to bound the number of reads indexed per locus.
+if args.norm_coverage > 0:
+    nb_unique_reads = len(readList)
+    readList, readAbundance = normalize_reads(readList, readAbundance, args.norm_k, args.norm_coverage)
+    print("Digital normalization: {} reads kept out of {}".format(len(readList), nb_unique_reads))
@@ -7,7 +7,12 @@ Three main variables are used in this pipeline:
 - seedDict = dictionary containing the seed's sequence as key, and the list of positions (i) of reads having this seed in readList as value (-pos if revcomp of read)
 - readWithStart = list of all reads containing the full sequence of the kmer start, along with the index of the beginning of the kmer start's subsequence,
                 referenced as a sublist of the readWithStart list: [position of the read in readList, index of beginning of kmer start's subsequence]
-- assemblyHash = hashtable/dictionary containing the last 70 bp of the current assembly's sequence as key, and a Boolean value (indicating if the search for overlapping reads was already performed) as value
+- readWithStop = list of all reads containing the full sequence of the reverse complement of the kmer stop (bidirectional mode or proximity to the kmer stop only), referenced as the readWithStart list
+- stopDistDict = dictionary containing the position of the reads close to the kmer stop as key, and the minimal number of bp to append after this read before reaching the kmer stop as value (proximity to the kmer stop only)
+- assemblyHash = hashtable/dictionary containing the last 70 bp of the current assembly's sequence as key, and the largest remaining length budget (max_length - assembly's length)
+                with which the search for overlapping reads was already performed as value (a region explored again with a smaller or equal budget cannot lead to a solution ;
+                infinite budget if its search failed without being cut by max_length)
+                (top-N mode: along with the list of the completions found from this region, reused by the other paths arriving to it, and whether its search was cut by max_length, see 'extend_solutions()')
 """
 
 from __future__ import print_function
@@ -15,56 +20,88 @@ import os
 import sys
 from operator import itemgetter
 from Bio.Seq import Seq
-from main import START, STOP, input_seqName, readList, assembly_file
-from helpers import index_read, extend
+from main import START, STOP, input_seqName, seed_size, readList, assembly_file, overlap_backend, nb_solutions, bidirectional, reach_hops, max_seed_freq
+from helpers import overlapCache, Assembly, ReadSuffixArray, find_anchor_reads, index_read, mask_frequent_seeds, get_read_sequence, compute_stop_proximity, extend, extend_solutions, get_completion_sequence, get_read_coverage, get_read_support, is_error_variant, extend_bidirectional
 
 # Increase the maximum recursion depth in Python.
 sys.setrecursionlimit(50000)
 
+# Number of completions collected per read containing the kmer start, relative to the number of solutions to output (top-N mode).
+SOLUTIONS_OVERSAMPLING = 4
+
+
+#----------------------------------------------------
+# save_solution function
+#----------------------------------------------------
+def save_solution(res, description=""):
+    """To save the gap-filled sequence (from the beginning of the kmer START to the end of the kmer STOP) in the output assembly file, with an optional 'description' appended to its name."""
+    with open(assembly_file, "a") as assemblyFile:
+        assembly_startbeg = res.index(START)
+        assembly_stopbeg = res.index(STOP)
+        seq = res[assembly_startbeg:assembly_stopbeg+len(STOP)]
+        seq_name = "assembly." + input_seqName + " len_" + str(len(seq)) + description
+        assemblyFile.write(">" + seq_name)
+        assemblyFile.write("\n" + seq + "\n")
+
 
 #----------------------------------------------------
 # Gapfilling with Seed-and-Extend approach
 #----------------------------------------------------
 try:
-    # Initiate the four main variables.
+    # Initiate the main variables.
     seedDict = {}
-    readWithStart = []
+    STOP_rc = str(Seq(STOP).reverse_complement())
     pos_read_in_readList = 0
     assemblyHash = {}
 
-    # Iterate over the reads of 'readList' to obtain the 'seedDict' dictionary and the 'readWithStart' list.
-    for read in readList:
-        # Get the reverse complement of the current read.
-        read_rc = str(Seq(read).reverse_complement())
-        # Seed the read and update the 'seedDict' dictionary.
-        index_read(read, pos_read_in_readList, read_rc, seedDict)
-        # Search if the read contains the whole kmer START's sequence and update the 'readWithStart' list.
-        if START in read:
-            readWithStart.append([str(pos_read_in_readList), read.index(START)])
-        elif START in read_rc:
-            readWithStart.append(["-"+str(pos_read_in_readList), read_rc.index(START)])
-        # Increment the position of the current read in 'readList'
-        pos_read_in_readList += 1
+    # Suffix array backend: the suffix array of the reads replaces the 'seedDict' dictionary.
+    if overlap_backend == "sa":
+        seedDict = ReadSuffixArray(readList)
+        print("\nSuffix array of the reads: {} sequences (reads and reverse complements)".format(seedDict.size))
+
+    # Iterate over the reads of 'readList' to obtain the 'seedDict' dictionary.
+    else:
+        for read in readList:
+            # Get the reverse complement of the current read.
+            read_rc = str(Seq(read).reverse_complement())
+            # Seed the read and update the 'seedDict' dictionary.
+            index_read(read, pos_read_in_readList, read_rc, seedDict)
+            # Increment the position of the current read in 'readList'
+            pos_read_in_readList += 1
+
+    # Search, in a single pass over the reads, the reads containing the whole kmer START's sequence ('readWithStart' list)
+    # and the ones containing the whole reverse complement of the kmer STOP's sequence ('readWithStop' list, bidirectional mode or proximity to the kmer STOP).
+    anchors = {"start": START}
+    if bidirectional or reach_hops > 0:
+        anchors["stop_rc"] = STOP_rc
+    readWithAnchor = find_anchor_reads(readList, anchors)
+    readWithStart = readWithAnchor["start"]
+    readWithStop = readWithAnchor.get("stop_rc", [])
+
+    # Mark the high-frequency seeds of 'seedDict'.
+    if max_seed_freq is not None and overlap_backend == "seed":
+        seed_freq_cutoff = mask_frequent_seeds(seedDict, max_seed_freq)
+        print("\nSeeds indexing more than {} reads are used as fallback only".format(seed_freq_cutoff))
 
     # Sort the 'readWithStart' list by the minimum extension size (e.g. by the maximum index).
     readWithStart = sorted(readWithStart, key=itemgetter(1), reverse=True)
+    readWithStop = sorted(readWithStop, key=itemgetter(1), reverse=True)
     # If there is no read containing the kmer start, raise an exception.
     if not readWithStart:
         print("\nNo read in the dataset provided contains the kmer start... \nHence, tentative of gapfilling aborted...")
         sys.exit(1)
 
-    # Extend the reads containing the whole kmer start's sequence.
-    for (pos_read, index) in readWithStart:
-
-        # Get the sequence of the read.
-        if '-' in str(pos_read):
-            read = str(Seq(readList[int(pos_read.split('-')[1])]).reverse_complement())
-        else:
-            read = readList[int(pos_read)]
+    # Compute the proximity of the reads to the kmer STOP (the reverse complement of the reads of 'readWithStop' contain the kmer STOP).
+    stopDistDict = None
+    if reach_hops > 0:
+        stop_reads = [pos_read[1:] if pos_read.startswith('-') else "-" + pos_read for (pos_read, index) in readWithStop]
+        stopDistDict = compute_stop_proximity(stop_reads, seedDict, reach_hops)
 
-        # Extend the assembly sequence (e.g. the current read containing the whole kmer start's sequence) using the function 'extend()'
-        assemblyHash[read[-70:]] = 0
-        res, success = extend(read, len(read), seedDict, assemblyHash)
+    # Bidirectional mode: extend simultaneously the reads containing the whole kmer start's sequence and the reads containing the whole reverse complement of the kmer stop's sequence.
+    if bidirectional:
+        fwd_reads = [pos_read for (pos_read, index) in readWithStart]
+        bwd_reads = [pos_read for (pos_read, index) in readWithStop]
+        res, success = extend_bidirectional(fwd_reads, bwd_reads, seedDict)
 
         # Case of unsuccessful gap-filling.
         if not success:
@@ -73,14 +110,61 @@ try:
         if success:
             print("\nSuccessful Gapfilling !")
             # Save the gap-filled sequence in the output_file.
-            with open(assembly_file, "a") as assemblyFile:
-                assembly_startbeg = res.index(START)
-                assembly_stopbeg = res.index(STOP)
-                seq = res[assembly_startbeg:assembly_stopbeg+len(STOP)]
-                seq_name = "assembly." + input_seqName + " len_" + str(len(seq))
-                assemblyFile.write(">" + seq_name)
-                assemblyFile.write("\n" + seq + "\n")
-            break
+            save_solution(res)
+
+    # Top-N mode: collect up to 'nb_solutions' distinct gap-filled sequences, sharing the regions explored (and their completions) between the reads containing the whole kmer start's sequence.
+    # NB: more completions than 'nb_solutions' are collected per read, as the sequencing error variants of a solution are collapsed into it (see 'is_error_variant()').
+    elif nb_solutions > 1:
+        solutions = []
+        for (pos_read, index) in readWithStart:
+            read = get_read_sequence(pos_read)
+            completions = extend_solutions(Assembly(pos_read, read), len(read), seedDict, assemblyHash, SOLUTIONS_OVERSAMPLING * nb_solutions, stopDistDict)[0]
+            for (chain, needed_budget, length) in completions:
+                res = read + get_completion_sequence(chain)
+                seq = res[res.index(START):res.index(STOP)+len(STOP)]
+                if any(seq == other_seq for (other_seq, other_coverage) in solutions):
+                    continue
+                coverage = get_read_coverage(seq)
+                if any(is_error_variant(seq, coverage, other_seq, other_coverage) for (other_seq, other_coverage) in solutions):
+                    continue
+                solutions = [[other_seq, other_coverage] for (other_seq, other_coverage) in solutions if not is_error_variant(other_seq, other_coverage, seq, coverage)]
+                solutions.append([seq, coverage])
+            if len(solutions) >= nb_solutions:
+                break
+
+        # Case of unsuccessful gap-filling.
+        if not solutions:
+            print("\nNo extension reaching the kmer STOP within max_length")
+        # Case of successful gap-filling: save the solutions, ranked by decreasing read support.
+        else:
+            print("\nSuccessful Gapfilling ! ({} solutions)".format(min(len(solutions), nb_solutions)))
+            solutions = sorted([[seq, get_read_support(coverage)] for (seq, coverage) in solutions], key=itemgetter(1), reverse=True)[:nb_solutions]
+            for (rank, (seq, support)) in enumerate(solutions, 1):
+                save_solution(seq, " sol_" + str(rank) + " support_" + str(support))
+
+    # Extend the reads containing the whole kmer start's sequence.
+    else:
+        for (pos_read, index) in readWithStart:
+
+            # Get the sequence of the read.
+            read = get_read_sequence(pos_read)
+
+            # Extend the assembly sequence (e.g. the current read containing the whole kmer start's sequence) using the function 'extend()'
+            res, success = extend(Assembly(pos_read, read), len(read), seedDict, assemblyHash, stopDistDict)
+
+            # Case of unsuccessful gap-filling.
+            if not success:
+                print(res)
+            # Case of successful gap-filling.
+            if success:
+                print("\nSuccessful Gapfilling !")
+                # Save the gap-filled sequence in the output_file.
+                save_solution(res)
+                break
+
+    # Report the hit rate of the overlap cache.
+    if overlapCache.max_size > 0:
+        print("\n" + overlapCache.stats())
 
 
 except Exception as exc:
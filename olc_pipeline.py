@@ -3,15 +3,14 @@ from __future__ import print_function
 import os
 import sys
 import argparse
-import csv
+import collections
 import re
 import subprocess
 from pathos.multiprocessing import ProcessingPool as Pool
 #from multiprocessing import Pool
-import gfapy
 from gfapy.sequence import rc
 from Bio import SeqIO, Align
-from helpers_pipeline import Gap, Scaffold, extract_barcodes, get_reads, stats_align, get_position_for_edges, get_output_for_gfa, update_gfa_with_solution
+from helpers_pipeline import Gap, Scaffold, GfaReader, index_fasta_files, extract_barcodes_batch, get_reads, get_reads_batch, stats_align, get_position_for_edges, get_output_for_gfa, GfaWriter
 
 
 #----------------------------------------------------
@@ -32,6 +31,11 @@ parserMain.add_argument('-f', dest="freq", action="store", type=int, default=2,
 parserMain.add_argument('-out', dest="outDir", action="store", default="./olc_gapfilling", help="Output directory for the result's files [default './olc_gapfilling']")
 parserMain.add_argument('-refDir', dest="refDir", action="store", help="Directory containing the reference sequences if any")
 parserMain.add_argument('-line', dest="line", action="store", type=int, help="Line of GFA file input from which to start analysis (if not provided, start analysis from first line of GFA file input) [optional]")
+parserMain.add_argument('-bxcache', dest="bxcache", action="store", help="Shelve file used as a cache of the barcodes extracted on each chunk region, reused across runs [optional]")
+parserMain.add_argument('-retrieval', dest="retrieval", action="store", choices=["index", "batch"], default="index", help="Retrieval of the reads of the union of each gap: 'index' (one call to reads_bx_sqlite3.py per gap, using the barcodes index)\nor 'batch' (reads of all gaps retrieved in a single pass over the reads file, using their 'BX:Z:' tag) [default: index]")
+parserMain.add_argument('-reads_in_memory', dest="reads_in_memory", action="store_true", help="Hand the reads of the union of each gap over to the OLC module in memory (standard input), instead of writing one FASTQ file per gap;\nwith '-retrieval batch', the reads of the unions of all gaps are then held by the main process and copied to the gap-filling processes, so only use it for small datasets [optional]")
+parserMain.add_argument('-aligner', dest="aligner", action="store", choices=["nucmer", "pairwise"], default="nucmer", help="Aligner used for the qualitative evaluation of the gap-filled sequences: 'nucmer' (external NUCmer, one run for all gaps)\nor 'pairwise' (in process, Biopython's PairwiseAligner, for short gap-filled sequences) [default: nucmer]")
+parserMain.add_argument('-stats_format', dest="stats_format", action="store", choices=["tsv", "npz"], default="tsv", help="Format of the alignment stats' files: 'tsv' or 'npz' (compressed NumPy arrays, one per column) [default: tsv]")
 parserMain.add_argument('-rbxu', dest="rbxu", action="store", help="Files containing the reads of the union of the corresponding gaps (if already extracted) [optional]")
 
 parserOLC.add_argument('-s', dest="seed_size", action="store", type=int, help="Seed size used for indexing the reads (bp)", required=True)
@@ -40,6 +44,9 @@ parserOLC.add_argument('-a', dest="abundance_min", action="store", nargs='*', ty
 parserOLC.add_argument('-ext', dest="extension", action="store", type=int, default=500, help="Extension size of the gap on both sides (bp); determine start/end of gapfilling [default: '500']")
 parserOLC.add_argument('-l', dest="max_length", action="store", type=int, help="Maximum assembly length (bp) (it could correspond to the length of the gap to fill (+ length START/STOP + 2*ext) OR it could be a very high length to prevent for searching indefinitely", required=True)
 parserOLC.add_argument('-subs', dest="max_subs", action="store", type=int, default=2, help="Maximum number of substitutions allowed in the inexact overlap between reads")
+parserOLC.add_argument('-ec', dest="error_correction", action="store_true", help="Correct the sequencing errors of the reads of each gap based on their kmer spectrum (solid kmers), before indexing them\n(in the OLC process of the gap, as the gaps are already filled in parallel)")
+parserOLC.add_argument('-ec_k', dest="ec_k", action="store", type=int, default=21, help="Kmer size used for the error correction of the reads (<= 31) [default: 21]")
+parserOLC.add_argument('-ec_solid', dest="ec_solid", action="store", type=int, default=3, help="Minimal number of occurrences of a solid kmer, for the error correction of the reads [default: 3]")
 
 args = parser.parse_args()
 
@@ -87,6 +94,9 @@ if args.rbxu is not None:
     if not os.path.exists(rbxuDir):
         parser.error("Warning: The path of the directory containing the union' reads files doesn't exist")
 
+#Cache of the barcodes extracted per chunk region if any
+bxcache_file = os.path.abspath(args.bxcache) if args.bxcache is not None else None
+
 #variable 'ext' is the size of the extension of the gap, on both sides [by default 500]
 ext = args.extension
 
@@ -131,19 +141,17 @@ statsDir = outDir + "/alignments_stats"
 To perform the gap-filling on a specific gap:
     - it takes as input the current gap on which we want to perform the gap-filling
     - it outputs the list 'union_summary' containing the gap ID, the names of the left and right flanking sequences, the gap size, the chunk size, and the number of barcodes and reads extracted on the chunks to perform the gap-filling
-    - it outputs as well the list 'output_for_gfa' containing the gap-filled sequence's name, as well as its length, its sequence, the number of solution found, the beginning and ending positions of the overlap and the quality of the sequence
+    - it outputs as well the list 'gap_evaluation' containing the current gap, and if one solution is found, the file containing the gap-filled sequence(s), the reference file
+      and the prefix of the alignment stats' file, for the qualitative evaluation (see 'evaluation()')
 '''
 def gapfilling(current_gap):
 
     os.chdir(outDir)
 
-    #Open the input GFA file to get the corresponding Gap line ('G' line)
-    gfa = gfapy.Gfa.from_file(gfa_file)
-    for _gap_ in gfa.gaps:
-        if str(_gap_) == current_gap:
-            current_gap = _gap_
-            #Create the object 'gap' from the class 'Gap'
-            gap = Gap(current_gap)
+    #Get the record of the corresponding Gap line ('G' line), its flanking segments being looked up lazily in the input GFA file
+    current_gap = gfaReader.parse_gap(current_gap)
+    #Create the object 'gap' from the class 'Gap'
+    gap = Gap(current_gap)
 
     #Get some information on the current gap we are working on
     gap.info()
@@ -173,16 +181,16 @@ def gapfilling(current_gap):
     #Union output directory
     os.chdir(unionDir)
     
-    #Initiate a dictionary to count the occurences of each barcode
-    barcodes_occ = {}
+    #Initiate a Counter to count the occurences of each barcode
+    barcodes_occ = collections.Counter()
     
-    #Obtain the left barcodes that are extracted on the left region and store the barcodes and their occurences in the dict 'barcodes_occ'
+    #Obtain the left barcodes that are extracted on the left region (see 'regionBarcodes') and store the barcodes and their occurences in the Counter 'barcodes_occ'
     left_region = left_scaffold.chunk(chunk_L)
-    extract_barcodes(bam_file, gap_label, left_region, barcodes_occ)
+    barcodes_occ.update(regionBarcodes[left_region])
 
-    #Obtain the right barcodes that are extracted on the right region and store the barcodes and their occurences in the dict 'barcodes_occ'
+    #Obtain the right barcodes that are extracted on the right region (see 'regionBarcodes') and store the barcodes and their occurences in the Counter 'barcodes_occ'
     right_region = right_scaffold.chunk(chunk_R)
-    extract_barcodes(bam_file, gap_label, right_region, barcodes_occ)
+    barcodes_occ.update(regionBarcodes[right_region])
 
     #Do the union of the barcodes on both left and right regions
     union_barcodes_file = "{}.{}.g{}.c{}.bxu".format(gfa_name, str(gap_label), gap.length, args.chunk)
@@ -195,6 +203,9 @@ def gapfilling(current_gap):
     #----------------------------------------------------
     # GetReads
     #----------------------------------------------------
+    #Reads of the union handed over to the OLC module in memory (FASTQ string) with '-reads_in_memory', instead of being written to a file
+    union_reads = None
+
     #If the reads of the union are already extracted, use the corresponding file
     if args.rbxu is not None:
         for file_ in os.listdir(rbxuDir):
@@ -203,17 +214,29 @@ def gapfilling(current_gap):
         if not os.path.isfile(union_reads_file):
             print("Warning: No union' reads file was found for this gap...")
     
+    #Union: the reads associated with the barcodes are already extracted for all gaps (see 'get_reads_batch()')
+    elif args.retrieval == "batch":
+        union_reads_file = "{}.{}.g{}.c{}.rbxu.fastq".format(gfa_name, str(gap_label), gap.length, args.chunk)
+        if args.reads_in_memory:
+            union_reads = "".join(gapReads[gap_label])
+
     #Union: extract the reads associated with the barcodes
     else:
         union_reads_file = "{}.{}.g{}.c{}.rbxu.fastq".format(gfa_name, str(gap_label), gap.length, args.chunk)
-        with open(union_reads_file, "w") as union_reads:
-            get_reads(reads_file, index_file, gap_label, union_barcodes_file, union_reads)
+        if args.reads_in_memory:
+            union_reads = get_reads(reads_file, index_file, gap_label, union_barcodes_file, subprocess.PIPE)
+        else:
+            with open(union_reads_file, "w") as out_reads:
+                get_reads(reads_file, index_file, gap_label, union_barcodes_file, out_reads)
 
     #----------------------------------------------------
     # Summary of union (barcodes and reads)
     #----------------------------------------------------
     bxu = sum(1 for line in open(union_barcodes_file, "r"))
-    rbxu = sum(1 for line in open(union_reads_file, "r"))/4
+    if union_reads is not None:
+        rbxu = union_reads.count("\n")/4
+    else:
+        rbxu = sum(1 for line in open(union_reads_file, "r"))/4
     union_summary = [str(gap.identity), str(gap.left), str(gap.right), gap.length, args.chunk, bxu, rbxu]
 
     #Remove the barcodes files
@@ -222,9 +245,9 @@ def gapfilling(current_gap):
     #----------------------------------------------------
     # OLC Gap-Filling
     #----------------------------------------------------        
-    #Get flanking contigs sequences
-    seq_L = str(left_scaffold.sequence())
-    seq_R = str(right_scaffold.sequence())
+    #Get flanking contigs sequences (only the regions used: the last 'ext'+31 bp of the left scaffold and the first 'ext'+31 bp of the right scaffold)
+    seq_L = str(left_scaffold.sequence(left_scaffold.slen - ext - 31, left_scaffold.slen))
+    seq_R = str(right_scaffold.sequence(0, ext + 31))
 
     #Execute the OLC module on the union
     os.chdir(olcDir)
@@ -238,11 +261,11 @@ def gapfilling(current_gap):
 
         #Start sequence
         line1 = ">ctg{}_start _ len_31_bp (left)\n".format(left_scaffold.scaffold)
-        line2 = seq_L[(left_scaffold.slen - ext - 31):(left_scaffold.slen - ext)]
+        line2 = seq_L[:len(seq_L)-ext]
         
         #Stop sequence
         line3 = "\n>ctg{}_stop _ len_31_bp (right)\n".format(right_scaffold.scaffold)
-        line4 = seq_R[ext:(ext + 31)]
+        line4 = seq_R[ext:]
 
         input_olc.writelines([line1, line2, line3, line4])
 
@@ -252,7 +275,7 @@ def gapfilling(current_gap):
     print("\nGap-filling of {} (union)".format(str(gap_label)))
 
     #Input arguments for OLC
-    input_reads_file = os.path.join(unionDir, union_reads_file)
+    input_reads_file = os.path.join(unionDir, union_reads_file) if union_reads is None else "-"
     seed_size = args.seed_size
     min_overlap = args.min_overlap
     list_of_abundance_min = args.abundance_min
@@ -264,13 +287,16 @@ def gapfilling(current_gap):
 
     #Perform the gap-filling with OLC
     olc_command = str(sys.path[0]) + "/olc.py -in " + input_file + " -reads " + input_reads_file + " -s " + str(seed_size) + " -o " + str(min_overlap) + " -a " + str_of_abundance_min + " -l " + str(max_length) + " -subs " + str(max_subs) + " -out " + olc_outDir + " -assembly " + output_file
+    if args.error_correction:
+        olc_command += " -ec -ec_k " + str(args.ec_k) + " -ec_solid " + str(args.ec_solid)
     olcLog = str(gap_label) + "_olc.log"
 
     with open(olcLog, "a") as log:
-        subprocess.run(olc_command, shell=True, stderr=log, stdout=log)
+        subprocess.run(olc_command, shell=True, stderr=log, stdout=log, input=union_reads, universal_newlines=True)
 
-    #If one solution is found, perform qualitative evaluation of the gap-filled sequence(s)
+    #If one solution is found, prepare the qualitative evaluation of the gap-filled sequence(s) (performed for all gaps at once, see 'evaluation()')
     assembly_file = os.path.abspath(olcDir +"/"+ olc_outDir +"/"+ output_file)
+    gap_evaluation = [str(current_gap)]
     if os.path.exists(assembly_file):
         
         #----------------------------------------------------
@@ -294,20 +320,20 @@ def gapfilling(current_gap):
                 #Left scaffold oriented '+'
                 if left_scaffold.orient == "+":
                     ref_fasta.write(">" + left_scaffold.name + "_region:" + str(left_scaffold.slen-ext) + "-" + str(left_scaffold.slen) + "\n")
-                    ref_fasta.write(seq_L[(left_scaffold.slen - ext):left_scaffold.slen])
+                    ref_fasta.write(seq_L[len(seq_L)-ext:])
                 #Left scaffold oriented '-' ~ Right scaffold oriented '+'
                 elif left_scaffold.orient == "-":
                     ref_fasta.write(">" + left_scaffold.name + "_region:0-" + str(ext) + "\n")
-                    ref_fasta.write(str(rc(seq_L)[0:ext]))
+                    ref_fasta.write(str(rc(seq_L[len(seq_L)-ext:])))
 
                 #Right scaffold oriented '+'
                 if right_scaffold.orient == "+":
                     ref_fasta.write("\n>" + right_scaffold.name + "_region:0-" + str(ext) + "\n")
-                    ref_fasta.write(seq_R[0:ext])
+                    ref_fasta.write(seq_R[:ext])
                 #Right scaffold oriented '-' ~ Left scaffold oriented '+'
                 elif right_scaffold.orient == "-":
                     ref_fasta.write("\n>" + right_scaffold.name + "_region:" + str(right_scaffold.slen-ext) + "-" + str(right_scaffold.slen) + "\n")
-                    ref_fasta.write(str(rc(seq_R)[(right_scaffold.slen - ext):right_scaffold.slen]))
+                    ref_fasta.write(str(rc(seq_R[:ext])))
 
         if not os.path.isfile(ref_file):
             print("Warning: Something wrong with the specified reference file. Exception-", sys.exc_info())
@@ -315,29 +341,56 @@ def gapfilling(current_gap):
         #Do statistics on the alignments of query_seq (found gapfill seq) vs reference
         else:
             prefix = "{}.s{}.o{}".format(str(gap_label), seed_size, min_overlap)
-            stats_align(gap_label, assembly_file, ref_file, str(ext), prefix, statsDir)
+            gap_evaluation = [str(current_gap), assembly_file, ref_file, prefix]
+
+
+    #TODO: remove the flanking_contig.fasta files
+
+    os.chdir(outDir)
+
 
+    return union_summary, gap_evaluation
+
+
+#----------------------------------------------------
+# evaluation function - Pipeline
+#----------------------------------------------------
+'''
+To perform the qualitative evaluation of the gap-filled sequence(s) of a specific gap, once the statistics on the alignments of all gaps are obtained (see 'stats_align()'):
+    - it takes as input the list 'gap_evaluation' obtained from 'gapfilling' (the current gap, and if one solution is found, the file containing the gap-filled sequence(s),
+      the reference file and the prefix of the alignment stats' file), and the dictionary 'alignmentStats' containing the prefix as key and the list of the stats' rows as value
+    - it outputs the list 'output_for_gfa' containing the gap-filled sequence's name, as well as its length, its sequence, the number of solution found, the beginning and ending positions of the overlap and the quality of the sequence
+'''
+def evaluation(gap_evaluation, alignmentStats):
+
+    os.chdir(outDir)
+
+    #Get the record of the corresponding Gap line ('G' line), and the objects 'gap', 'left_scaffold' and 'right_scaffold'
+    current_gap = gfaReader.parse_gap(gap_evaluation[0])
+    gap = Gap(current_gap)
+    left_scaffold = Scaffold(current_gap, gap.left, gfa_file)
+    right_scaffold = Scaffold(current_gap, gap.right, gfa_file)
+    seed_size = args.seed_size
+    min_overlap = args.min_overlap
+
+    #If one solution is found, perform qualitative evaluation of the gap-filled sequence(s)
+    output_for_gfa = []
+    if len(gap_evaluation) > 1:
+        assembly_file, ref_file, prefix = gap_evaluation[1:]
 
         #----------------------------------------------------
         # Estimate quality of gapfilled sequence
         #----------------------------------------------------
-        #Reader for alignment stats' files
-        ref_qry_file = statsDir + "/" + prefix + ".ref_qry.alignment.stats"
-
-        if not os.path.exists(ref_qry_file):
-            print("Warning: The '{}' file doesn't exits".format(ref_qry_file))
+        #Rows of the alignment stats (typed records, see 'StatsRow' in 'stats_alignment_pipeline.py')
+        if prefix not in alignmentStats:
+            print("Warning: No alignment stats were obtained for '{}'".format(prefix))
 
         else:
-            ref_qry_output = open(ref_qry_file)
-
-            reader_ref_stats = csv.DictReader(ref_qry_output, \
-                                            fieldnames=("Gap", "Len_gap", "Chunk", "Seed_size", "Min_overlap", "Len_Q", "Ref", "Len_R", \
-                                                        "Start_ref", "End_ref", "Start_qry", "End_qry", "Len_alignR", "Len_alignQ", "%_Id", "%_CovR", "%_CovQ", "Frame_R", "Frame_Q", "Quality"), \
-                                            delimiter='\t')
+            stats_rows = alignmentStats[prefix]
 
             #Obtain a quality score for each gapfilled seq
             output_for_gfa = []
-            assembly_quality_file = os.path.abspath(olcDir +"/"+ olc_outDir +"/"+ output_file.split('.fasta')[0] + ".quality.fasta")
+            assembly_quality_file = assembly_file.split('.fasta')[0] + ".quality.fasta"
             bad_solutions_file = os.path.abspath(outDir + "/bad_solutions.fasta")
 
             with open(assembly_file, "r") as query, open(assembly_quality_file, "w") as qualified:
@@ -351,15 +404,13 @@ def gapfilling(current_gap):
                     if args.refDir is not None:
                         #quality score for stats about the ref
                         quality_ref = []
-                        for row in reader_ref_stats:
-                            if (row["Gap"] == record_label):
-                                quality_ref.append(row["Quality"])
+                        for row in stats_rows:
+                            if (row.gap == record_label):
+                                quality_ref.append(row.quality)
                         
                         if quality_ref == []:
                             quality_ref.append('D')
 
-                        ref_qry_output.seek(0)
-
                         #global quality score
                         quality_gapfilled_seq = min(quality_ref)
                         
@@ -384,18 +435,16 @@ def gapfilling(current_gap):
                         #quality score for stats about the extension
                         quality_ext_left = []
                         quality_ext_right = []
-                        for row in reader_ref_stats:
-                            if (row["Gap"] == record_label) and (row["Ref"] == left_scaffold.name):
-                                quality_ext_left.append(row["Quality"])
-                            elif (row["Gap"] == record_label) and (row["Ref"] == right_scaffold.name):
-                                quality_ext_right.append(row["Quality"])
+                        for row in stats_rows:
+                            if (row.gap == record_label) and (row.ref == left_scaffold.name):
+                                quality_ext_left.append(row.quality)
+                            elif (row.gap == record_label) and (row.ref == right_scaffold.name):
+                                quality_ext_right.append(row.quality)
                         if quality_ext_left == []:
                             quality_ext_left.append('D')
                         if quality_ext_right == []:
                             quality_ext_right.append('D')
 
-                        ref_qry_output.seek(0)
-
                         #global quality score
                         quality_gapfilled_seq = min(quality_ext_left) + min(quality_ext_right)
 
@@ -416,10 +465,6 @@ def gapfilling(current_gap):
                 qualified.seek(0)
 
 
-    #If no solution found, set 'output_for_gfa' to empty list
-    else:
-        output_for_gfa = []
-
     #----------------------------------------------------
     # GFA output: case gap, no solution
     #----------------------------------------------------
@@ -427,84 +472,124 @@ def gapfilling(current_gap):
     if len(output_for_gfa) == 0:
         output_for_gfa.append([str(current_gap)])
 
-
-    #TODO: remove the flanking_contig.fasta files
-
-    os.chdir(outDir)
-
-
-    return union_summary, output_for_gfa
+    return output_for_gfa
 
 
 #----------------------------------------------------
 # Gapfilling with MindTheGap
 #----------------------------------------------------
 try:
-    #Open the input GFA file
-    gfa = gfapy.Gfa.from_file(gfa_file)
+    #Open the input GFA file (streaming reader, and offset index of its segments shared by the gap-filling processes)
+    gfaReader = GfaReader(gfa_file)
+    gfaReader.index_segments()
+    input_gaps = list(gfaReader.gaps())
     #Create the output GFA file
     out_gfa_file = str(gfa_name).split('.gfa')[0] + "_olc.gfa"
+    #Writer of the output GFA file and of the file containing all gapfill seq (lines buffered and appended by batches)
+    gfaWriter = GfaWriter(out_gfa_file, gfa_name + ".gapfill_seq.fasta")
 
     #----------------------------------------------------
     # GFA output: case no gap
     #----------------------------------------------------
     #If no gap, rewrite all the lines into GFA output
-    if len(gfa.gaps) == 0:
-        with open(out_gfa_file, "w") as f:
-            out_gfa = gfapy.Gfa()
-            for line in gfa.lines:
-                out_gfa.add_line(str(line))
-            out_gfa.to_file(out_gfa_file)
+    if len(input_gaps) == 0:
+        open(out_gfa_file, "w").close()
+        for (line_number, line) in gfaReader.lines():
+            gfaWriter.add_line(line)
+        gfaWriter.flush()
 
     #----------------------------------------------------   
     # Fill the gaps
     #----------------------------------------------------
     #If gap, rewrite the H and S lines into GFA output
-    if args.line is None:
-        with open(out_gfa_file, "w") as f:
-            out_gfa = gfapy.Gfa()
-            out_gfa.add_line("H\tVN:Z:2.0")
-            for line in gfa.segments:
-                out_gfa.add_line(str(line))
-            out_gfa.to_file(out_gfa_file)
+    elif args.line is None:
+        open(out_gfa_file, "w").close()
+        gfaWriter.add_line("H\tVN:Z:2.0")
+        for line in gfaReader.segment_lines():
+            gfaWriter.add_line(line)
+        gfaWriter.flush()
         
     gaps = []
     gaps_label = []
     #If '-line' argument provided, start analysis from this line in GFA file input
     if args.line is not None:
-        for _gap_ in gfa.gaps[(args.line - (len(gfa.segments)+2)):]:
-            _gap_ = str(_gap_)
-            gaps.append(_gap_)
+        for _gap_ in input_gaps:
+            if _gap_.line_number >= args.line:
+                gaps.append(str(_gap_))
     else:
-        #Convert Gfapy gap line to a string to be able to use it with multiprocessing
-        for _gap_ in gfa.gaps:
+        #Convert the gap record to its G line (string) to be able to use it with multiprocessing
+        for _gap_ in input_gaps:
             _gap_ = str(_gap_)
             gaps.append(_gap_)
 
+    #Extract the barcodes of the chunk regions of all gaps in one sweep over the BAM file (each region shared by several gaps is extracted once)
+    regions = []
+    seq_files = []
+    for _gap_ in gaps:
+        gap_record = gfaReader.parse_gap(_gap_)
+        for scaffold in [Scaffold(gap_record, gap_record.sid1, gfa_file), Scaffold(gap_record, gap_record.sid2, gfa_file)]:
+            regions.append(scaffold.chunk(min(args.chunk, scaffold.slen)))
+            seq_files.append(scaffold.seq_link())
+    regionBarcodes = extract_barcodes_batch(bam_file, regions, bxcache_file)
+
+    #Batch retrieval: extract the reads of the union of all gaps in a single pass over the reads file
+    gapReads = {}
+    if args.retrieval == "batch" and args.rbxu is None:
+        gapBarcodes = {}
+        outReadsFiles = {}
+        for (i, _gap_) in enumerate(gaps):
+            gap = Gap(gfaReader.parse_gap(_gap_))
+            barcodes_occ = collections.Counter(regionBarcodes[regions[2*i]]) + collections.Counter(regionBarcodes[regions[2*i+1]])
+            gapBarcodes[gap.label()] = set(barcode for (barcode, occurences) in barcodes_occ.items() if occurences >= args.freq)
+            outReadsFiles[gap.label()] = os.path.join(unionDir, "{}.{}.g{}.c{}.rbxu.fastq".format(gfa_name, str(gap.label()), gap.length, args.chunk))
+        #Reads written to one file per gap, unless they are kept in memory (dictionary 'gapReads', shared with the gap-filling processes) for small datasets
+        if args.reads_in_memory:
+            gapReads = get_reads_batch(reads_file, gapBarcodes)
+        else:
+            get_reads_batch(reads_file, gapBarcodes, outReadsFiles)
+
+    #Build the offset index of the scaffolds' FASTA files once, before the gap-filling processes read them concurrently
+    index_fasta_files(seq_files)
+
     p = Pool()
 
     with open("{}.union.sum".format(gfa_name), "w") as union_sum:
         legend = ["Gap_ID", "Left_scaffold", "Right_scaffold", "Gap_size", "Chunk_size", "Nb_barcodes", "Nb_reads"]
         union_sum.write('\t'.join(j for j in legend))
 
-        for union_summary, output_for_gfa in p.map(gapfilling, gaps):
+        results = p.map(gapfilling, gaps)
+        p.close()
+
+        #Do statistics on the alignments of query_seq (found gapfill seq) vs reference, for all gaps at once
+        alignments = []
+        for (union_summary, gap_evaluation) in results:
+            if len(gap_evaluation) > 1:
+                gap_label = Gap(gfaReader.parse_gap(gap_evaluation[0])).label()
+                alignments.append([gap_label, gap_evaluation[1], gap_evaluation[2], str(ext), gap_evaluation[3]])
+        os.chdir(olcDir)
+        alignmentStats = stats_align(alignments, statsDir, args.aligner, args.stats_format) if alignments else {}
+        os.chdir(outDir)
+
+        for (union_summary, gap_evaluation) in results:
             #Write all union_summary (obtained for each gap) from 'gapfilling' into the 'union_sum' file
             union_sum.write("\n" + '\t'.join(str(i) for i in union_summary))
 
+            #Qualitative evaluation of the gap-filled sequence(s) of the current gap
+            output_for_gfa = evaluation(gap_evaluation, alignmentStats)
+
             #Output the 'output_for_gfa' results (obtained for each gap) from 'gapfilling' in the output GFA file
             print("\nCreating the output GFA file...")
             if len(output_for_gfa[0]) > 1:          #solution found for the current gap
                 for output in output_for_gfa:
-                    gapfill_file = update_gfa_with_solution(outDir, gfa_name, output, out_gfa_file)
+                    gapfill_file = gfaWriter.add_solution(outDir, output)
                     success = True
             else:                                   #no solution found for the current gap
-                out_gfa = gfapy.Gfa.from_file(out_gfa_file)
-                out_gfa.add_line(output_for_gfa[0][0])
-                out_gfa.to_file(out_gfa_file)
+                gfaWriter.add_line(output_for_gfa[0][0])
                 success = False
 
 
-        p.close()
+    #Write the remaining lines of the output GFA file
+    gfaWriter.close()
 
     #Remove the raw files obtained from MindTheGap
     os.chdir(olcDir)
@@ -530,11 +615,11 @@ if success == True:
 #----------------------------------------------------
 #Summary output
 #----------------------------------------------------
-gfa_output = gfapy.Gfa.from_file(outDir +"/"+ str(out_gfa_file))
+gfa_output = GfaReader(outDir +"/"+ str(out_gfa_file))
 
 #Total initials gaps
 total_gaps = []
-for g_line in gfa.gaps:
+for g_line in input_gaps:
     gap_start = str(g_line.sid1) +"_"+ str(g_line.sid2) 
     total_gaps.append(gap_start)
 nb_total_gaps = len(total_gaps)
@@ -543,7 +628,7 @@ print("Attempt to gap-fill {} gaps \n".format(nb_total_gaps))
 
 #Gap(s) not gap-filled
 no_gapfill = []
-for g_line in gfa_output.gaps:
+for g_line in gfa_output.gaps():
     gap_end = str(g_line.sid1) +"_"+ str(g_line.sid2) 
     no_gapfill.append(gap_end)
     print("The gap {} was not successfully gap-filled".format(gap_end))
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Module 'preprocessing.py': preprocessing of the reads of the script OLC
+
+The module 'preprocessing.py' contains the functions used to preprocess the reads' sequences of 'readList', before indexing them.
+The error correction of the reads is performed first, on the raw reads (see 'correct_reads()').
+Each function then returns the list of the reads' sequences kept, along with the list 'readAbundance' containing the number of reads of the dataset
+each kept read stands for (so that the filter on the number of reads sharing an extension ('abundance_min') is not biased by the preprocessing).
+"""
+
+import collections
+import multiprocessing
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+#----------------------------------------------------
+# reverse_complement function
+#----------------------------------------------------
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+def reverse_complement(seq):
+    """To get the reverse complement of a sequence (str)."""
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+#----------------------------------------------------
+# get_canonical_kmers function
+#----------------------------------------------------
+def get_canonical_kmers(read, k):
+    """To get the list of the canonical kmers (smallest of the kmer and its reverse complement) of a read.
+
+    Args:
+        - read: str
+            sequence of the read
+        - k: int
+            size of the kmers
+
+    Returns:
+        - kmers: list
+            list of the canonical kmers of the read, in the order of the read
+    """
+    read_rc = reverse_complement(read)
+    len_read = len(read)
+    return [min(read[i:i+k], read_rc[len_read-i-k:len_read-i]) for i in range(len_read-k+1)]
+
+
+#----------------------------------------------------
+# median function
+#----------------------------------------------------
+def median(values):
+    """To get the median of a non-empty list of values."""
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+#----------------------------------------------------
+# collapse_duplicate_reads function
+#----------------------------------------------------
+def collapse_duplicate_reads(readList):
+    """
+    To collapse the exact duplicate reads (e.g. PCR and optical duplicates) into unique sequences, along with their multiplicity
+    The order of the first occurrence of each sequence in 'readList' is kept
+
+    Args:
+        - readList: list
+            list of all reads' sequences
+
+    Returns:
+        - unique_reads: list
+            list of the unique reads' sequences
+        - readAbundance: list
+            list of the multiplicity of each unique read (number of reads of the dataset having this sequence)
+    """
+    readIndex = {}
+    unique_reads = []
+    readAbundance = []
+    for read in readList:
+        if read in readIndex:
+            readAbundance[readIndex[read]] += 1
+        else:
+            readIndex[read] = len(unique_reads)
+            unique_reads.append(read)
+            readAbundance.append(1)
+
+    return unique_reads, readAbundance
+
+
+#----------------------------------------------------
+# normalize_reads function
+#----------------------------------------------------
+def normalize_reads(readList, readAbundance, k, coverage):
+    """
+    To perform a digital normalization of the reads: a read is discarded if the median coverage of its kmers, among the reads already kept, reaches 'coverage'
+    The abundance of each kept read is the smallest ratio, over its kmers, between the kmer's count in the whole dataset (duplicates included) and in the reads kept,
+    so that the number of reads supporting an extension is preserved after normalization (a kmer containing a sequencing error keeps the abundance of the read to its multiplicity)
+
+    Args:
+        - readList: list
+            list of all reads' sequences
+        - readAbundance: list
+            list of the abundance of each read of 'readList' (e.g. its multiplicity)
+        - k: int
+            size of the kmers used to estimate the coverage of the reads
+        - coverage: int
+            target coverage of the reads kept
+
+    Returns:
+        - normalized_reads: list
+            list of the reads' sequences kept
+        - normalized_abundance: list
+            list of the abundance of each read kept (number of reads of the dataset it stands for)
+    """
+    # Count the kmers of the whole dataset.
+    readKmers = [get_canonical_kmers(read, k) for read in readList]
+    allCounts = collections.Counter()
+    for (kmers, abundance) in zip(readKmers, readAbundance):
+        for kmer in kmers:
+            allCounts[kmer] += abundance
+
+    # Keep the reads whose median kmer coverage (among the reads already kept) is below the target coverage.
+    keptCounts = collections.Counter()
+    kept_reads = []
+    for (read, kmers, abundance) in zip(readList, readKmers, readAbundance):
+        if not kmers:
+            kept_reads.append((read, kmers, abundance))
+            continue
+        if median([keptCounts[kmer] for kmer in kmers]) < coverage:
+            keptCounts.update(kmers)
+            kept_reads.append((read, kmers, abundance))
+
+    # Get the abundance of each read kept.
+    normalized_reads = []
+    normalized_abundance = []
+    for (read, kmers, abundance) in kept_reads:
+        normalized_reads.append(read)
+        if not kmers:
+            normalized_abundance.append(abundance)
+        else:
+            normalized_abundance.append(max(abundance, min(allCounts[kmer] // keptCounts[kmer] for kmer in kmers)))
+
+    return normalized_reads, normalized_abundance
+
+
+#----------------------------------------------------
+# encode_kmers function
+#----------------------------------------------------
+# Maximal number of substitutions performed in a read by the error correction.
+MAX_CORRECTIONS = 4
+
+def encode_kmers(read, k):
+    """
+    To encode the canonical kmers of a read as 2-bit integers (A=0, C=1, G=2, T=3), using NumPy (k <= 31)
+
+    Args:
+        - read: str
+            sequence of the read
+        - k: int
+            size of the kmers
+
+    Returns:
+        - codes: numpy array
+            array of the codes of the canonical kmers of the read (smallest code of the kmer and its reverse complement), in the order of the read
+        - valid: numpy array
+            boolean array indicating the kmers without ambiguous base (e.g. 'N')
+    """
+    seq = NUC_CODES[np.frombuffer(read.encode(), dtype=np.uint8)]
+    if len(seq) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    windows = np.lib.stride_tricks.sliding_window_view(seq, k)
+    valid = (windows < 4).all(axis=1)
+    windows = windows.astype(np.uint64) & np.uint64(3)
+    shifts = np.arange(2*(k-1), -1, -2, dtype=np.uint64)
+    fwd = (windows << shifts).sum(axis=1, dtype=np.uint64)
+    rev = ((np.uint64(3) - windows)[:, ::-1] << shifts).sum(axis=1, dtype=np.uint64)
+    return np.minimum(fwd, rev), valid
+
+if np is not None:
+    NUC_CODES = np.full(256, 4, dtype=np.uint8)
+    for (code, nucs) in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+        for nuc in nucs:
+            NUC_CODES[ord(nuc)] = code
+
+
+#----------------------------------------------------
+# count_kmers function
+#----------------------------------------------------
+def count_kmers(params):
+    """To count the canonical kmers of a chunk of reads, with 'params' = (list of reads' sequences, size of the kmers). Returns the sorted array of the kmers' codes and the array of their counts."""
+    (reads, k) = params
+    codes = [codes[valid] for (codes, valid) in (encode_kmers(read, k) for read in reads)]
+    if not codes:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(codes), return_counts=True)
+
+
+#----------------------------------------------------
+# is_solid function
+#----------------------------------------------------
+def is_solid(codes, solidKmers):
+    """To get the boolean array indicating the kmers (codes) present in the sorted array of the solid kmers' codes."""
+    if not len(solidKmers):
+        return np.zeros(len(codes), dtype=bool)
+    indexes = np.minimum(np.searchsorted(solidKmers, codes), len(solidKmers)-1)
+    return solidKmers[indexes] == codes
+
+
+#----------------------------------------------------
+# correct_read function
+#----------------------------------------------------
+# Parameters of the error correction (size of the kmers, sorted array of the solid kmers' codes), set in each worker process.
+correctionParams = None
+
+def init_correction(k, solidKmers):
+    """To set the parameters of the error correction in a worker process."""
+    global correctionParams
+    correctionParams = (k, solidKmers)
+
+def correct_read(read):
+    """
+    To correct the sequencing errors of a read, using the solid kmers (e.g. kmers occurring at least 'min_count' times in the dataset, see 'correct_reads()')
+    A base covered only by non-solid kmers is untrusted: for each run of untrusted bases, the substitution making solid all kmers covering the substituted base is applied,
+    if it is the only one doing so (at most 'MAX_CORRECTIONS' substitutions per read)
+
+    Args:
+        - read: str
+            sequence of the read
+
+    Returns:
+        - corrected: str
+            sequence of the corrected read
+    """
+    (k, solidKmers) = correctionParams
+    corrected = read
+    skipped = set()
+    for _ in range(MAX_CORRECTIONS):
+
+        # Get the untrusted bases (e.g. the bases covered by no solid kmer).
+        codes, valid = encode_kmers(corrected, k)
+        if not len(codes):
+            break
+        solid = is_solid(codes, solidKmers) & valid
+        if solid.all():
+            break
+        untrusted = np.flatnonzero(np.convolve(solid, np.ones(k, dtype=int))[:len(corrected)] == 0)
+
+        # Get the first run of untrusted bases not already tried.
+        runs = np.split(untrusted, np.flatnonzero(np.diff(untrusted) > 1) + 1)
+        runs = [run for run in runs if len(run) and run[0] not in skipped]
+        if not runs:
+            break
+        run = runs[0]
+
+        # Search for the substitution making solid all kmers covering the substituted base.
+        fixes = []
+        for i in run:
+            for nuc in "ACGT":
+                if nuc == corrected[i]:
+                    continue
+                window = corrected[max(0, i-k+1):i] + nuc + corrected[i+1:i+k]
+                window_codes, window_valid = encode_kmers(window, k)
+                if len(window_codes) and window_valid.all() and is_solid(window_codes, solidKmers).all():
+                    fixes.append((i, nuc))
+
+        # Apply the substitution only if it is unambiguous.
+        if len(fixes) == 1:
+            (i, nuc) = fixes[0]
+            corrected = corrected[:i] + nuc + corrected[i+1:]
+        else:
+            skipped.add(run[0])
+
+    return corrected
+
+
+#----------------------------------------------------
+# correct_reads function
+#----------------------------------------------------
+def correct_reads(readList, k, min_count, processes=1):
+    """
+    To correct the sequencing errors of the reads, based on the kmer spectrum of the dataset: a kmer occurring at least 'min_count' times is solid,
+    and a read's base covered only by non-solid kmers is substituted so that all kmers covering it are solid (see 'correct_read()')
+    The kmers are counted and the reads corrected in parallel with 'processes' worker processes, or in the current process if 'processes' is 1
+
+    Args:
+        - readList: list
+            list of all reads' sequences
+        - k: int
+            size of the kmers (k <= 31)
+        - min_count: int
+            minimal number of occurrences of a solid kmer
+        - processes: int
+            number of worker processes (default: 1, e.g. no worker process, as the OLC module is already run in parallel on several gaps by the pipeline ; None: number of CPUs)
+
+    Returns:
+        - corrected_reads: list
+            list of the corrected reads' sequences, in the order of 'readList'
+    """
+    if np is None:
+        raise ImportError("NumPy is required for the error correction of the reads")
+
+    # NB: 'fork' start method, as the worker processes must not import the calling script again.
+    context = multiprocessing.get_context("fork")
+    nb_processes = processes or multiprocessing.cpu_count()
+    chunk_size = max(1, -(-len(readList) // nb_processes))
+    chunks = [(readList[i:i+chunk_size], k) for i in range(0, len(readList), chunk_size)]
+
+    # Count the kmers of each chunk of reads, and merge the counts.
+    if nb_processes == 1:
+        chunkCounts = [count_kmers(chunk) for chunk in chunks]
+    else:
+        with context.Pool(nb_processes) as pool:
+            chunkCounts = pool.map(count_kmers, chunks)
+    codes = np.concatenate([chunk_codes for (chunk_codes, chunk_counts) in chunkCounts] + [np.empty(0, dtype=np.uint64)])
+    counts = np.concatenate([chunk_counts for (chunk_codes, chunk_counts) in chunkCounts] + [np.empty(0, dtype=np.int64)])
+    order = np.argsort(codes, kind="stable")
+    codes, counts = codes[order], counts[order]
+    if len(codes):
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        codes, counts = codes[starts], np.add.reduceat(counts, starts)
+
+    # Get the solid kmers, and correct the reads.
+    solidKmers = codes[counts >= min_count]
+    if nb_processes == 1:
+        init_correction(k, solidKmers)
+        corrected_reads = [correct_read(read) for read in readList]
+    else:
+        with context.Pool(nb_processes, initializer=init_correction, initargs=(k, solidKmers)) as pool:
+            corrected_reads = pool.map(correct_read, readList, chunksize=chunk_size)
+
+    return corrected_reads
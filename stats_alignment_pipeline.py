@@ -4,12 +4,19 @@ import os
 import sys
 import re
 import csv
+import collections
+import multiprocessing
+import multiprocessing.pool
 import argparse
 import subprocess
 import gfapy
 from gfapy.sequence import rc
 from Bio import SeqIO, Align
 from Bio.Seq import Seq
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 #PairwiseAligner object
@@ -22,298 +29,479 @@ aligner.internal_extend_gap_score = -0.5
 aligner.target_end_open_gap_score = -1
 aligner.target_end_extend_gap_score = -0.5
 
+#Columns of the alignment stats' files, and of the coords files obtained with show-coords (-rcdlT)
+stats_legend = ["Gap", "Len_gap", "Chunk", "Seed_size", "Min_overlap", "Len_Q", "Ref", "Len_R", \
+                "Start_ref", "End_ref", "Start_qry", "End_qry", "Len_alignR", "Len_alignQ", "%_Id", "%_CovR", "%_CovQ", "Frame_R", "Frame_Q", "Quality"]
+#Typed record of a row of the alignment stats' files (one field per column of 'stats_legend')
+StatsRow = collections.namedtuple("StatsRow", ["gap", "len_gap", "chunk", "seed_size", "min_overlap", "len_q", "ref", "len_r", \
+                                               "start_ref", "end_ref", "start_qry", "end_qry", "len_align_r", "len_align_q", "identity", "cov_r", "cov_q", "frame_r", "frame_q", "quality"])
+coords_fields = ("S1", 'E1', "S2", "E2", "LEN_1", "LEN_2", "%_IDY", "LEN_R", "LEN_Q", "COV_R", "COV_Q", "FRM_R", "FRM_Q", "TAG_1", "TAG_2")
+
+#Minimal identity (%) of the alignments reported by the 'pairwise' aligner
+MIN_IDENTITY = 80.0
+
 
 #----------------------------------------------------
-# Arg parser
+# get_query_info function
 #----------------------------------------------------
-parser = argparse.ArgumentParser(prog="stats_alignment.py", usage="%(prog)s -qry <query_sequences_file> -ref <reference_sequence> -ext <extension_size> -p <output_file_prefix> [options]", \
-                                formatter_class=argparse.RawTextHelpFormatter, \
-                                description=(''' \
-                                Statistics about the inserted sequence obtained from MindTheGap (-qry)
-                                Note: there are kmer flanking regions on the edges of the inserted sequence (which are included in '-ext' bp flanking regions)
-                                '''))
+'''
+To get the information on the gap-filling from the name of the query file (format: 'xxx.g<gap_size>.c<chunk_size>.s<seed_size>.o<min_overlap>.olc_gapfilling.fasta'):
+    - it takes as input the query file
+    - it outputs the gap's ID, the gap size, the chunk size, the seed size and the minimal overlap size
+'''
+def get_query_info(qry_file):
+    gap_size = qry_file.split('.')[-6]
+    g = int("".join(list(gap_size)[1:]))
+    chunk_size = qry_file.split('.')[-5]
+    c = int("".join(list(chunk_size)[1:]))
+    seed_size = qry_file.split('.')[-4]
+    s = int("".join(list(seed_size)[1:]))
+    min_overlap = qry_file.split('.')[-3]
+    o = int("".join(list(min_overlap)[1:]))
+    qry_id = qry_file.split('/')[-1].split('.')[0]
+    return qry_id, g, c, s, o
 
-parser.add_argument("-qry", "--query", action="store", help="File containing the inserted sequences obtained from MindTheGap (format: 'xxx.insertions.fasta')", required=True)
-parser.add_argument("-ref", "--reference", action="store", help="File containing either the reference sequence or the flanking contigs sequences of the gap (format: 'xxx.fasta')", required=True)
-parser.add_argument("-ext", "--ext", action="store", type=int, help="Extension size of the gap, on both sides; determine start/end of gapfilling", required=True)
-parser.add_argument("-p", "--prefix", action="store", help="Prefix of output file to save the statistical results", required=True)
-parser.add_argument("-out", "--outDir", action="store", default="./mtglink_results/alignments_stats", help="Output directory for saving results")
 
-args = parser.parse_args()
+#----------------------------------------------------
+# quality_ref function
+#----------------------------------------------------
+'''
+To estimate the quality of a gap-filled sequence aligned to the reference sequence of the gap:
+    - it takes as input the length of the query, the length of the reference, the lengths of the alignment on the reference and on the query, and the size of the extension of the gap
+    - it outputs the quality score of the alignment ('A', 'B', 'C' or 'D')
+'''
+def quality_ref(len_q, len_r, len_align_r, len_align_q, ext):
+    ref_len = int(len_r)
+    error_10_perc = int(0.1 * ref_len)
+    qry_len = int(len_q) - 2*ext - 2*31
+
+    #length of query sequence is equal +-10% of ref length
+    if qry_len in range((ref_len - error_10_perc), (ref_len + error_10_perc)):
+        #the gapfilled seq matches to the whole ref seq
+        if int(len_align_q) == ref_len:
+            return 'A'
+        #the gapfilled seq matches to the ref seq +-10% of ref length
+        elif int(len_align_q) in range((ref_len - error_10_perc), (ref_len + error_10_perc)):
+            return 'B'
+        #the gapfilled seq matches to the ref seq, but not along all their length (>= 50% of their length align)
+        elif int(len_align_q) >= int(0.5*ref_len) and int(len_align_r) >= int(0.5*qry_len):
+            return 'C'
+        else:
+            return 'D'
+
+    else:
+        return 'D'
+
 
-if re.match('^.*.fasta$', args.query) is None:
-    parser.error("Warning: Qualitative evaluation _ The suffix of the inserted sequences (query sequences) file should be: '.fasta'")
+#----------------------------------------------------
+# quality_ext function
+#----------------------------------------------------
+'''
+To estimate the quality of a gap-filled sequence aligned to the extension portion of one of the flanking contigs:
+    - it takes as input the gap's ID, the name of the flanking contig, the length of the query, the start and end positions of the alignment on the query, and the size of the extension of the gap
+    - it outputs the quality score of the alignment ('A', 'B', 'C' or 'D')
+'''
+def quality_ext(qry_id, ref, len_q, start_q, end_q, ext):
+    left = str(qry_id).split('_')[0]
+    left_scaffold = left[:-1]
+    right = str(qry_id).split('_')[1]
+    right_scaffold = right[:-1]
+    error_10_perc = int(0.1 * ext)
+    error_50_perc = int(0.5 * ext)
+    len_q = int(len_q)
+    start_q = int(start_q)
+    end_q = int(end_q)
+
+    #ref = Left scaffold
+    if ref == left_scaffold:
+        #extension of qry match perfectly as expected to ref
+        if ('+' in left and start_q == 32 and end_q == (ext + 31)) or ('-' in left and start_q == (ext + 31) and end_q == 32):
+            return 'A'
+        #extension of qry almost match as expected to ref (+-10% of extension size)
+        elif ('+' in left and start_q in range(32, (32 + error_10_perc + 1)) and end_q in range((ext + 31 - error_10_perc), (ext + 31 + error_10_perc + 1))) or ('-' in left and start_q in range((ext + 31 - error_10_perc), (ext + 31 + error_10_perc + 1)) and end_q in range(32, (32 + error_10_perc + 1))):
+            return 'B'
+        #extension of qry almost match as expected to ref (+-50% of extension size)
+        elif ('+' in left and start_q in range(32, (32 + error_50_perc + 1)) and end_q in range((ext + 31 - error_50_perc), (ext + 31 + error_50_perc + 1))) or ('-' in left and start_q in range((ext + 31 - error_50_perc), (ext + 31 + error_50_perc + 1)) and end_q in range(32, (32 + error_50_perc + 1))):
+            return 'C'
+        else:
+            return 'D'
+
+    #ref = Right scaffold
+    elif ref == right_scaffold:
+        #extension of qry match perfectly as expected to ref
+        if ('+' in right and start_q == (len_q - 31 - ext + 1) and end_q == (len_q - 31)) or ('-' in right and start_q == (len_q - 31) and end_q == (len_q - 31 - ext + 1)):
+            return 'A'
+        #extension of qry almost match as expected to ref (+-10% of extension size)
+        elif ('+' in right and start_q in range((len_q - 31 - ext + 1 - error_10_perc), (len_q - 31 - ext + 1 + error_10_perc + 1)) and end_q in range((len_q - 31 - error_10_perc), (len_q - 31 + 1))) or ('-' in right and start_q in range((len_q - 31 - error_10_perc), (len_q - 31 + 1)) and end_q in range((len_q - 31 - ext + 1 - error_10_perc), (len_q - 31 - ext + 1 + error_10_perc + 1))):
+            return 'B'
+        #extension of qry almost match as expected to ref (+-50% of extension size)
+        elif ('+' in right and start_q in range((len_q - 31 - ext + 1 - error_50_perc), (len_q - 31 - ext + 1 + error_50_perc + 1)) and end_q in range((len_q - 31 - error_50_perc), (len_q - 31 + 1))) or ('-' in right and start_q in range((len_q - 31 - error_50_perc), (len_q - 31 + 1)) and end_q in range((len_q - 31 - ext + 1 - error_50_perc), (len_q - 31 - ext + 1 + error_50_perc + 1))):
+            return 'C'
+        else:
+            return 'D'
+
+    return 'D'
 
-if re.match('^.*.fasta$', args.reference) is None:
-    parser.error("Warning: Qualitative evaluation _ The suffix of the reference sequence file should be: '.fasta'")
 
 #----------------------------------------------------
-# Input files
+# get_stats function
 #----------------------------------------------------
-#Query file: inserted/gap-filled sequences file
-qry_file = os.path.abspath(args.query)
-if not os.path.exists(args.query):
-    parser.error("Warning: Qualitative evaluation _ The path of the query file (inserted sequences file) doesn't exist")
+'''
+To get the statistics on the alignments between the reference sequence(s) and the gap-filled sequences of a gap:
+    - it takes as input the rows of the coords file obtained for this gap (as dictionaries, see 'coords_fields'), the query file, the size of the extension of the gap,
+      and a boolean indicating if the reference sequences are the flanking contigs' sequences
+    - it outputs the list of the stats' rows (see the typed record 'StatsRow')
+'''
+def get_stats(rows, qry_file, ext, contigs):
+    qry_id, g, c, s, o = get_query_info(qry_file)
+    stats = []
+
+    for row in rows:
+        #Ref = flanking contigs' sequences: only the contigs of the gap
+        if contigs:
+            if row["TAG_1"].split("_")[0] not in str(qry_id):
+                continue
+            ref = row["TAG_1"].split("_")[0]
+            quality_rq = quality_ext(qry_id, ref, row["LEN_Q"], row["S2"], row["E2"], ext)
+
+        #Ref = reference sequence of simulated gap
+        else:
+            ref = row["TAG_1"]
+            quality_rq = quality_ref(row["LEN_Q"], row["LEN_R"], row["LEN_1"], row["LEN_2"], ext)
+
+        stats.append(StatsRow(qry_id, g, c, s, o, int(row["LEN_Q"]), ref, int(row["LEN_R"]), \
+                            int(row["S1"]), int(row["E1"]), int(row["S2"]), int(row["E2"]), int(row["LEN_1"]), int(row["LEN_2"]), float(row["%_IDY"]), float(row["COV_R"]), float(row["COV_Q"]), int(row["FRM_R"]), int(row["FRM_Q"]), quality_rq))
+
+    return stats
 
-#Reference file: containing either the reference sequence or the flanking contigs sequences
-ref_file = os.path.abspath(args.reference)
-if not os.path.exists(ref_file):
-    parser.error("Warning: Qualitative evaluation _ The path of the reference file doesn't exist")
 
 #----------------------------------------------------
-# Directory for saving results
+# run_nucmer function
 #----------------------------------------------------
-cwd = os.getcwd()
-if not os.path.exists(args.outDir):
-    os.mkdir(args.outDir)
-try:
-    os.chdir(args.outDir)
-except:
-    print("Something wrong with specified directory. Exception-", sys.exc_info())
-    print("Restoring the path")
-    os.chdir(cwd)
-outDir = os.getcwd()
+'''
+To align query sequences against reference sequences with NUCmer:
+    - it takes as input the reference file, the query file, the prefix of the output files and a boolean indicating if the option '--maxmatch' of NUCmer is used
+    - it outputs the list of the rows of the coords file obtained with show-coords (as dictionaries, see 'coords_fields'), sorted by start position on the reference
+    - the raw files ('.delta', '.coords' and log files) are removed
+'''
+def run_nucmer(ref_file, qry_file, prefix, maxmatch):
+    nucmerLog = "{}_nucmer_ref_qry.log".format(prefix)
+    delta_file = prefix + ".delta"
+    coords_file = prefix + ".coords"
+
+    nucmer_command = ["nucmer", "-p", prefix, ref_file, qry_file]
+    if maxmatch:
+        nucmer_command.insert(1, "--maxmatch")
+    coords_command = ["show-coords", "-rcdlT", delta_file]
+
+    with open(coords_file, "w") as coords, open(nucmerLog, "a") as log:
+        subprocess.run(nucmer_command, stderr=log)
+        subprocess.run(coords_command, stdout=coords, stderr=log)
+
+    #Get output values from NUCmer (the header lines are skipped)
+    with open(coords_file) as coords:
+        reader = csv.DictReader(coords, fieldnames=coords_fields, delimiter='\t')
+        rows = [row for row in reader if row["S1"].isdigit()]
+    rows.sort(key=lambda row: int(row["S1"]))
+
+    #Remove the raw files obtained from NUCmer
+    for raw_file in [nucmerLog, delta_file, coords_file]:
+        if os.path.exists(raw_file):
+            os.remove(raw_file)
+
+    return rows
 
-try:
-    #-----------------------------------------------------------------------------
-    # Statistics about the Alignment Ref vs Qry
-    #-----------------------------------------------------------------------------
-
-    if not re.match('^.*.contigs.fasta$', args.reference):
-        #----------------------------------------------------
-        # Ref = reference sequence of simulated gap
-        #----------------------------------------------------
-        #Run NUCmer to obtain alignment of the reference sequence against the query's sequences
-        prefix = args.prefix + ".ref_qry"
-
-        log_file = str(prefix) + ".log"
-        with open(log_file, "a") as log:
-            log.write("Query file: " + str(qry_file) + "\n")
-            log.write("Reference file" + str(ref_file) + "\n")
-            log.write("The results are saved in " + outDir)
-
-        nucmerLog = "{}_nucmer_ref_qry.log".format(args.prefix)
-        delta_file = prefix + ".delta"
-        coords_file = prefix + ".coords.unsorted" 
-
-        nucmer_command = ["nucmer", "--maxmatch", "-p", prefix, ref_file, qry_file]
-        coords_command = ["show-coords", "-rcdlT", delta_file]
-
-        with open(coords_file, "w") as coords, open(nucmerLog, "a") as log:
-            subprocess.run(nucmer_command, stderr=log)
-            subprocess.run(coords_command, stdout=coords, stderr=log)
-
-        #Sort the 'xxx.coords.unsorted' file for further analysis
-        coords_sorted_file = prefix + ".coords"
-        sort_command = ["sort", "-n", coords_file]
-        with open(coords_sorted_file, "w") as coords_sorted:
-            subprocess.run(sort_command, stdout=coords_sorted)
 
-        #Output stats file of alignment query vs ref
-        ref_qry_output = outDir + "/" + args.prefix + ".ref_qry.alignment.stats.unsorted"
-        stats_legend = ["Gap", "Len_gap", "Chunk", "Seed_size", "Min_overlap", "Len_Q", "Ref", "Len_R", \
-                        "Start_ref", "End_ref", "Start_qry", "End_qry", "Len_alignR", "Len_alignQ", "%_Id", "%_CovR", "%_CovQ", "Frame_R", "Frame_Q", "Quality"]
-        
-        #Get the gap size, chunk size, seed size and overlap min values
-        gap_size = qry_file.split('.')[-6]
-        g = int("".join(list(gap_size)[1:]))
-        chunk_size = qry_file.split('.')[-5]
-        c = int("".join(list(chunk_size)[1:]))
-        seed_size = qry_file.split('.')[-4]
-        s = int("".join(list(seed_size)[1:]))
-        min_overlap = qry_file.split('.')[-3]
-        o = int("".join(list(min_overlap)[1:]))
-        qry_id = qry_file.split('/')[-1].split('.')[0]
-
-        #Get output values from NUCmer:
-        reader = csv.DictReader(open(coords_sorted_file), \
-                                    fieldnames=("S1", 'E1', "S2", "E2", "LEN_1", "LEN_2", "%_IDY", "LEN_R", "LEN_Q", "COV_R", "COV_Q", "FRM_R", "FRM_Q", "TAG_1", "TAG_2"), \
-                                    delimiter='\t')
-
-        rows = list(reader)
-        for row in rows[3:]:
-
-            len_q = row["LEN_Q"]
-            ref = row["TAG_1"]
-            len_r = row["LEN_R"]
-            start_r = row["S1"]
-            end_r = row["E1"]
-            start_q = row["S2"]
-            end_q = row["E2"]
-            len_align_r = row["LEN_1"]
-            len_align_q = row["LEN_2"]
-            identity = row["%_IDY"]
-            cov_r = row["COV_R"]
-            cov_q = row["COV_Q"]
-            frame_r = row["FRM_R"]
-            frame_q = row["FRM_Q"]
-
-            # Estimate quality of gapfilled sequence
-            ref_len = int(len_r)
-            error_10_perc = int(0.1 * ref_len)
-            qry_len = int(len_q) - 2*args.ext - 2*31
-
-            #length of query sequence is equal +-10% of ref length
-            if qry_len in range((ref_len - error_10_perc), (ref_len + error_10_perc)):
-                #the gapfilled seq matches to the whole ref seq
-                if int(len_align_q) == ref_len:
-                    quality_rq = 'A'
-                #the gapfilled seq matches to the ref seq +-10% of ref length
-                elif int(len_align_q) in range((ref_len - error_10_perc), (ref_len + error_10_perc)):
-                    quality_rq = 'B'
-                #the gapfilled seq matches to the ref seq, but not along all their length (>= 50% of their length align)
-                elif int(len_align_q) >= int(0.5*ref_len) and int(len_align_r) >= int(0.5*qry_len):
-                    quality_rq = 'C'
-                else:
-                    quality_rq = 'D'
-
-            else:
-                quality_rq = 'D'
-
-            #Write stats results in output file
-            stats = [qry_id, g, c, s, o, len_q, ref, len_r, \
-                    start_r, end_r, start_q, end_q, len_align_r, len_align_q, identity, cov_r, cov_q, frame_r, frame_q, quality_rq]
-
-            if os.path.exists(ref_qry_output):
-                with open(ref_qry_output, "a") as output:
-                    output.write('\n' + '\t'.join(str(i) for i in stats))
-            else:
-                with open(ref_qry_output, "a") as output:
-                    output.write('\t'.join(j for j in stats_legend))
-                    output.write('\n'+'\n' + '\t'.join(str(i) for i in stats))
-
-        #Sort the 'xxx.alignment.stats.unsorted' file for further analysis
-        ref_qry_sorted = outDir + "/" + args.prefix + ".ref_qry.alignment.stats"
-        order_command = ["sort", "-k6,7", "-k11,12n", "-r", ref_qry_output]
-        with open(ref_qry_sorted, "w") as r_sorted:
-            subprocess.run(order_command, stdout=r_sorted)
-
-
-    elif re.match('^.*.contigs.fasta$', args.reference):
-        #----------------------------------------------------
-        # Ref = contigs' sequences
-        #----------------------------------------------------
-        #Run NUCmer to obtain alignment of extension portions (-ext) (of the flanking contigs) against the query's sequences
-        prefix = args.prefix + ".ref_qry"
-
-        log_file = str(prefix) + ".log"
-        with open(log_file, "a") as log:
-            log.write("Query file: " + str(qry_file) + "\n")
-            log.write("Reference file" + str(ref_file) + "\n")
-            log.write("The results are saved in " + outDir)
-
-        nucmerLog = "{}_nucmer_ref_qry.log".format(args.prefix)
-        delta_file = prefix + ".delta"
-        coords_file = prefix + ".coords"
-
-        nucmer_command = ["nucmer", "-p", prefix, ref_file, qry_file]
-        coords_command = ["show-coords", "-rcdlT", delta_file]
-
-        with open(coords_file, "w") as coords, open(nucmerLog, "a") as log:
-            subprocess.run(nucmer_command, stderr=log)
-            subprocess.run(coords_command, stdout=coords, stderr=log)
+#----------------------------------------------------
+# run_nucmer_batch function
+#----------------------------------------------------
+'''
+To run NUCmer on several pairs of reference and query files, in parallel:
+    - it takes as input the list of the runs to perform, each one as [reference file, query file, prefix of the output files, boolean indicating if the option '--maxmatch' is used],
+      and the number of NUCmer runs at once (default: number of CPUs)
+    - it outputs the list of the rows of the coords files of each run (see 'run_nucmer()')
+'''
+def run_nucmer_batch(jobs, processes=None):
+    # NB: threads are enough to wait for the NUCmer processes, no Python process is started per run.
+    nb_processes = min(processes or multiprocessing.cpu_count(), max(1, len(jobs)))
+    with multiprocessing.pool.ThreadPool(nb_processes) as pool:
+        return pool.starmap(run_nucmer, jobs)
+
+
+#----------------------------------------------------
+# get_window function
+#----------------------------------------------------
+'''
+To get the region of the query where a reference sequence is expected to align, for the 'pairwise' aligner:
+    - it takes as input the gap's ID, the ID of the reference sequence, the length of the query, the size of the extension of the gap,
+      and a boolean indicating if the reference sequences are the flanking contigs' sequences
+    - it outputs the start and end positions (0-based) of the expected region on the query, extended by a margin of 'ext' bp on both sides
+      (the whole query if the reference is the reference sequence of the gap)
+'''
+def get_window(qry_id, ref_id, len_q, ext, contigs):
+    if contigs:
+        left_scaffold = str(qry_id).split('_')[0][:-1]
+        right_scaffold = str(qry_id).split('_')[1][:-1]
+        ref = ref_id.split("_")[0]
+        #extension of the left scaffold, after the kmer START
+        if ref == left_scaffold:
+            return max(0, 31 - ext), min(len_q, 31 + 2*ext)
+        #extension of the right scaffold, before the kmer STOP
+        elif ref == right_scaffold:
+            return max(0, len_q - 31 - 2*ext), min(len_q, len_q - 31 + ext)
+    return 0, len_q
+
+
+#----------------------------------------------------
+# align_pairwise function
+#----------------------------------------------------
+'''
+To align a reference sequence against a region of a query sequence with the PairwiseAligner object 'aligner' (end gaps free on the query):
+    - it takes as input the list [ID of the reference, sequence of the reference, ID of the query, sequence of the query, start position of the region, end position of the region]
+    - it outputs the best alignment on either strand of the reference as a row of a coords file (dictionary, see 'coords_fields'), with the positions on the whole query,
+      or None if its identity is lower than 'MIN_IDENTITY'
+'''
+def align_pairwise(job):
+    ref_id, ref_seq, qry_id, qry_seq, window_start, window_end = job
+    target = qry_seq[window_start:window_end]
+
+    #Best alignment of the reference (forward or reverse complement) on the region of the query
+    best = None
+    for (frame, query) in [(1, ref_seq), (-1, str(rc(ref_seq)))]:
+        alignment = aligner.align(target, query)[0]
+        if best is None or alignment.score > best[2].score:
+            best = (frame, query, alignment)
+    frame, query, alignment = best
+
+    target_blocks, query_blocks = alignment.aligned
+    if len(target_blocks) == 0:
+        return None
+    len_aligned = sum(int(t_end - t_start) for (t_start, t_end) in target_blocks)
+    matches = sum(1 for ((t_start, t_end), (q_start, q_end)) in zip(target_blocks, query_blocks) for i in range(int(t_end - t_start)) if target[t_start+i] == query[q_start+i])
+    t_start, t_end = int(target_blocks[0][0]), int(target_blocks[-1][1])
+    q_start, q_end = int(query_blocks[0][0]), int(query_blocks[-1][1])
+    identity = 100 * matches / ((t_end - t_start) + (q_end - q_start) - len_aligned)
+    if identity < MIN_IDENTITY:
+        return None
+
+    #Positions (1-based) on the reference and on the whole query (on the reverse strand of the reference, the positions on the query are given from end to start)
+    len_r = len(ref_seq)
+    len_q = len(qry_seq)
+    if frame == 1:
+        s1, e1, s2, e2 = q_start + 1, q_end, window_start + t_start + 1, window_start + t_end
+    else:
+        s1, e1, s2, e2 = len_r - q_end + 1, len_r - q_start, window_start + t_end, window_start + t_start + 1
+    len_1 = e1 - s1 + 1
+    len_2 = abs(e2 - s2) + 1
+
+    return dict(zip(coords_fields, [str(s1), str(e1), str(s2), str(e2), str(len_1), str(len_2), "{:.2f}".format(identity), str(len_r), str(len_q), \
+                                    "{:.2f}".format(100 * len_1 / len_r), "{:.2f}".format(100 * len_2 / len_q), "1", str(frame), ref_id, qry_id]))
+
+
+#----------------------------------------------------
+# run_pairwise function
+#----------------------------------------------------
+'''
+To align reference sequences against query sequences in process with the PairwiseAligner object 'aligner', in parallel:
+    - it takes as input the list of alignments to perform (see 'align_pairwise()'), and the number of worker processes (default: number of CPUs)
+    - it outputs the list of the rows of the coords file (as dictionaries, see 'coords_fields'), None for the alignments not reported
+'''
+def run_pairwise(jobs, processes=None):
+    # NB: 'fork' start method, as the worker processes must not import the calling script again.
+    context = multiprocessing.get_context("fork")
+    nb_processes = min(processes or multiprocessing.cpu_count(), max(1, len(jobs)))
+    with context.Pool(nb_processes) as pool:
+        return pool.map(align_pairwise, jobs, chunksize=max(1, len(jobs) // (4*nb_processes)))
+
+
+#----------------------------------------------------
+# sort_stats function
+#----------------------------------------------------
+'''
+To sort the stats' rows of a gap by the length of the query and the reference (decreasing), then by the start position on the query (increasing), as 'sort -k6,7 -k11,12n -r':
+    - it takes as input the list of stats' rows
+    - it outputs the sorted list of stats' rows (the ties are sorted by decreasing order of their line in the stats' file)
+'''
+def sort_stats(stats):
+    stats = sorted(stats, key=format_stats, reverse=True)
+    stats.sort(key=lambda row: row.start_qry)
+    stats.sort(key=lambda row: (str(row.len_q), row.ref), reverse=True)
+    return stats
+
+
+#----------------------------------------------------
+# format_stats function
+#----------------------------------------------------
+'''
+To format a stats' row as a line of the alignment stats' file (TSV):
+    - it takes as input the stats' row
+    - it outputs the line (without end of line)
+'''
+def format_stats(row):
+    return '\t'.join("{:.2f}".format(i) if isinstance(i, float) else str(i) for i in row)
+
+
+#----------------------------------------------------
+# write_stats function
+#----------------------------------------------------
+'''
+To write the stats' rows of a gap to its alignment stats' file, at once:
+    - it takes as input the list of stats' rows, the output file, and the format of the output file: 'tsv' (with the legend as first line) or 'npz' (one NumPy array per column, named as in the legend)
+    - it outputs the output file ('.npz' extension added for the 'npz' format)
+'''
+def write_stats(stats, ref_qry_output, stats_format="tsv"):
+    if stats_format == "npz":
+        if np is None:
+            raise ImportError("NumPy is required for the 'npz' format of the alignment stats' files")
+        ref_qry_output += ".npz"
+        np.savez_compressed(ref_qry_output, **{legend: np.array([row[i] for row in stats]) for (i, legend) in enumerate(stats_legend)})
+
+    else:
+        with open(ref_qry_output, "w") as output:
+            output.write('\t'.join(stats_legend) + "\n")
+            output.writelines(format_stats(row) + "\n" for row in stats)
+
+    return ref_qry_output
+
+
+#----------------------------------------------------
+# stats_alignments function
+#----------------------------------------------------
+'''
+To perform statistics on the alignments between the reference sequence(s) and the gap-filled sequences of several gaps:
+    - it takes as input the list of alignments to perform, each one as [query file (gap-filled sequences), reference file (either the reference sequence or the flanking contigs' sequences,
+      'xxx.contigs.fasta'), size of the extension of the gap, prefix of the output files], the output directory for saving the results, the aligner used ('nucmer' or 'pairwise'),
+      the number of worker processes of the 'pairwise' aligner or of NUCmer runs at once (default: number of CPUs), and the format of the alignment stats' files ('tsv' or 'npz', see 'write_stats()')
+    - it outputs the dictionary 'alignmentStats' containing the prefix of each alignment as key, and the list of its stats' rows as value (if at least one alignment was found),
+      the rows obtained with the reference sequence of the gap being sorted (see 'sort_stats()')
+    - with NUCmer, the query file of each gap is aligned against its own reference file only (one run of NUCmer per gap, so that the anchors' uniqueness is the one of the gap),
+      the runs of all gaps being started at once from this process (see 'run_nucmer_batch()')
+    - with the 'pairwise' aligner, each reference sequence is aligned in process against the region of the query where it is expected (see 'get_window()')
+'''
+def stats_alignments(alignments, out_dir, backend="nucmer", processes=None, stats_format="tsv"):
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    alignmentStats = {}
+
+    #Ref = reference sequence of simulated gap (NUCmer with '--maxmatch') / Ref = contigs' sequences
+    for contigs in [False, True]:
+        batch = [(i, alignment) for (i, alignment) in enumerate(alignments) if bool(re.match('^.*.contigs.fasta$', alignment[1])) == contigs]
+        if batch == []:
+            continue
+
+        for (i, (qry_file, ref_file, ext, prefix)) in batch:
+            log_file = os.path.join(out_dir, str(prefix) + ".ref_qry.log")
+            with open(log_file, "a") as log:
+                log.write("Query file: " + str(os.path.abspath(qry_file)) + "\n")
+                log.write("Reference file" + str(os.path.abspath(ref_file)) + "\n")
+                log.write("The results are saved in " + out_dir)
+
+        alignmentRows = {i: [] for (i, alignment) in batch}
+
+        #Align each reference sequence against each query sequence of the gap, on the region where it is expected
+        if backend == "pairwise":
+            jobs = []
+            jobAlignments = []
+            for (i, (qry_file, ref_file, ext, prefix)) in batch:
+                qry_id = get_query_info(qry_file)[0]
+                for qry_record in SeqIO.parse(qry_file, "fasta"):
+                    qry_seq = str(qry_record.seq)
+                    for ref_record in SeqIO.parse(ref_file, "fasta"):
+                        if contigs and ref_record.id.split("_")[0] not in str(qry_id):
+                            continue
+                        window_start, window_end = get_window(qry_id, ref_record.id, len(qry_seq), int(ext), contigs)
+                        jobs.append([ref_record.id, str(ref_record.seq), qry_record.id, qry_seq, window_start, window_end])
+                        jobAlignments.append(i)
+            for (i, row) in zip(jobAlignments, run_pairwise(jobs, processes) if jobs else []):
+                if row is not None:
+                    alignmentRows[i].append(row)
+            for i in alignmentRows:
+                alignmentRows[i].sort(key=lambda row: int(row["S1"]))
+
+        #One run of NUCmer per gap (query file vs its own reference file), all runs started at once
+        else:
+            jobs = [[ref_file, qry_file, os.path.join(out_dir, str(prefix) + ".ref_qry"), not contigs] for (i, (qry_file, ref_file, ext, prefix)) in batch]
+            for ((i, alignment), rows) in zip(batch, run_nucmer_batch(jobs, processes)):
+                alignmentRows[i] = rows
 
         #Output stats file of alignment query vs ref
-        ref_qry_output = outDir + "/" + args.prefix + ".ref_qry.alignment.stats"
-        stats_legend = ["Gap", "Len_gap", "Chunk", "Seed_size", "Min_overlap", "Len_Q", "Ref", "Len_R", \
-                        "Start_ref", "End_ref", "Start_qry", "End_qry", "Len_alignR", "Len_alignQ", "%_Id", "%_CovR", "%_CovQ", "Frame_R", "Frame_Q", "Quality"]
-        
-        #Get the gap size, chunk size, seed size and overlap min values
-        gap_size = qry_file.split('.')[-6]
-        g = int("".join(list(gap_size)[1:]))
-        chunk_size = qry_file.split('.')[-5]
-        c = int("".join(list(chunk_size)[1:]))
-        seed_size = qry_file.split('.')[-4]
-        s = int("".join(list(seed_size)[1:]))
-        min_overlap = qry_file.split('.')[-3]
-        o = int("".join(list(min_overlap)[1:]))
-        qry_id = qry_file.split('/')[-1].split('.')[0]
-
-        #Get output values from NUCmer:
-        reader = csv.DictReader(open(coords_file), \
-                                    fieldnames=("S1", 'E1', "S2", "E2", "LEN_1", "LEN_2", "%_IDY", "LEN_R", "LEN_Q", "COV_R", "COV_Q", "FRM_R", "FRM_Q", "TAG_1", "TAG_2"), \
-                                    delimiter='\t')
-
-        rows = list(reader)
-        for row in rows[3:]:
-            if row["TAG_1"].split("_")[0] in str(qry_id):
-
-                len_q = row["LEN_Q"]
-                ref = row["TAG_1"].split("_")[0]
-                len_r = row["LEN_R"]
-                start_r = row["S1"]
-                end_r = row["E1"]
-                start_q = row["S2"]
-                end_q = row["E2"]
-                len_align_r = row["LEN_1"]
-                len_align_q = row["LEN_2"]
-                identity = row["%_IDY"]
-                cov_r = row["COV_R"]
-                cov_q = row["COV_Q"]
-                frame_r = row["FRM_R"]
-                frame_q = row["FRM_Q"]
-
-                # Estimate quality of gapfilled sequence
-                left = str(qry_id).split('_')[0]
-                left_scaffold = left[:-1]
-                right = str(qry_id).split('_')[1]
-                right_scaffold = right[:-1]
-                error_10_perc = int(0.1 * args.ext)
-                error_50_perc = int(0.5 * args.ext)
-
-                #ref = Left scaffold
-                if ref == left_scaffold:
-                    #extension of qry match perfectly as expected to ref
-                    if ('+' in left and int(start_q) == 32 and int(end_q) == (args.ext + 31)) or ('-' in left and int(start_q) == (args.ext + 31) and int(end_q) == 32):
-                        quality_rq = 'A'
-                    #extension of qry almost match as expected to ref (+-10% of extension size) 
-                    elif ('+' in left and int(start_q) in range(32, (32 + error_10_perc + 1)) and int(end_q) in range((args.ext + 31 - error_10_perc), (args.ext + 31 + error_10_perc + 1))) or ('-' in left and int(start_q) in range((args.ext + 31 - error_10_perc), (args.ext + 31 + error_10_perc + 1)) and int(end_q) in range(32, (32 + error_10_perc + 1))):
-                        quality_rq = 'B'
-                    #extension of qry almost match as expected to ref (+-50% of extension size) 
-                    elif ('+' in left and int(start_q) in range(32, (32 + error_50_perc + 1)) and int(end_q) in range((args.ext + 31 - error_50_perc), (args.ext + 31 + error_50_perc + 1))) or ('-' in left and int(start_q) in range((args.ext + 31 - error_50_perc), (args.ext + 31 + error_50_perc + 1)) and int(end_q) in range(32, (32 + error_50_perc + 1))):
-                        quality_rq = 'C'
-                    else:
-                        quality_rq = 'D'
-
-                #ref = Right scaffold
-                elif ref == right_scaffold:
-                    #extension of qry match perfectly as expected to ref
-                    if ('+' in right and int(start_q) == (int(len_q) - 31 - args.ext + 1) and int(end_q) == (int(len_q) - 31)) or ('-' in right and int(start_q) == (int(len_q) - 31) and int(end_q) == (int(len_q) - 31 - args.ext + 1)):
-                        quality_rq = 'A'
-                    #extension of qry almost match as expected to ref (+-10% of extension size) 
-                    elif ('+' in right and int(start_q) in range((int(len_q) - 31 - args.ext + 1 - error_10_perc), (int(len_q) - 31 - args.ext + 1 + error_10_perc + 1)) and int(end_q) in range((int(len_q) - 31 - error_10_perc), (int(len_q) - 31 + 1))) or ('-' in right and int(start_q) in range((int(len_q) - 31 - error_10_perc), (int(len_q) - 31 + 1)) and int(end_q) in range((int(len_q) - 31 - args.ext + 1 - error_10_perc), (int(len_q) - 31 - args.ext + 1 + error_10_perc + 1))):
-                        quality_rq = 'B'
-                    #extension of qry almost match as expected to ref (+-50% of extension size) 
-                    elif ('+' in right and int(start_q) in range((int(len_q) - 31 - args.ext + 1 - error_50_perc), (int(len_q) - 31 - args.ext + 1 + error_50_perc + 1)) and int(end_q) in range((int(len_q) - 31 - error_50_perc), (int(len_q) - 31 + 1))) or ('-' in right and int(start_q) in range((int(len_q) - 31 - error_50_perc), (int(len_q) - 31 + 1)) and int(end_q) in range((int(len_q) - 31 - args.ext + 1 - error_50_perc), (int(len_q) - 31 - args.ext + 1 + error_50_perc + 1))):
-                        quality_rq = 'C'
-                    else:
-                        quality_rq = 'D'
-                
-                #Write stats results in output file
-                stats = [qry_id, g, c, s, o, len_q, ref, len_r, \
-                        start_r, end_r, start_q, end_q, len_align_r, len_align_q, identity, cov_r, cov_q, frame_r, frame_q, quality_rq]
-
-                if os.path.exists(ref_qry_output):
-                    with open(ref_qry_output, "a") as output:
-                        output.write('\n' + '\t'.join(str(i) for i in stats))
-                else:
-                    with open(ref_qry_output, "a") as output:
-                        output.write('\t'.join(j for j in stats_legend))
-                        output.write('\n'+'\n' + '\t'.join(str(i) for i in stats))
-
-
-    #Remove the raw file obtained from statistics ('.log', '.delta', '.coords', '.unsorted' files)
-    subprocess.run(["rm", nucmerLog])
-    subprocess.run(["rm", delta_file])
-    subprocess.run(["rm", coords_file])
-    if not re.match('^.*.contigs.fasta$', args.reference):
-        subprocess.run(["rm", coords_sorted_file])  #only when refDir
-
-
-except Exception as e:
-    print("\nException-")
-    print(e)
-    exc_type, exc_obj, exc_tb = sys.exc_info()
-    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-    print(exc_type, fname, exc_tb.tb_lineno)
-    sys.exit(1)
\ No newline at end of file
+        for (i, (qry_file, ref_file, ext, prefix)) in batch:
+            ref_qry_output = os.path.join(out_dir, prefix + ".ref_qry.alignment.stats")
+            stats = get_stats(alignmentRows[i], qry_file, int(ext), contigs)
+            if stats == []:
+                continue
+            if not contigs:
+                stats = sort_stats(stats)
+            write_stats(stats, ref_qry_output, stats_format)
+            alignmentStats[prefix] = stats
+
+    return alignmentStats
+
+if __name__ == "__main__":
+
+    #----------------------------------------------------
+    # Arg parser
+    #----------------------------------------------------
+    parser = argparse.ArgumentParser(prog="stats_alignment.py", usage="%(prog)s -qry <query_sequences_file> -ref <reference_sequence> -ext <extension_size> -p <output_file_prefix> [options]", \
+                                    formatter_class=argparse.RawTextHelpFormatter, \
+                                    description=(''' \
+                                    Statistics about the inserted sequence obtained from MindTheGap (-qry)
+                                    Note: there are kmer flanking regions on the edges of the inserted sequence (which are included in '-ext' bp flanking regions)
+                                    '''))
+
+    parser.add_argument("-qry", "--query", action="store", help="File containing the inserted sequences obtained from MindTheGap (format: 'xxx.insertions.fasta')", required=True)
+    parser.add_argument("-ref", "--reference", action="store", help="File containing either the reference sequence or the flanking contigs sequences of the gap (format: 'xxx.fasta')", required=True)
+    parser.add_argument("-ext", "--ext", action="store", type=int, help="Extension size of the gap, on both sides; determine start/end of gapfilling", required=True)
+    parser.add_argument("-p", "--prefix", action="store", help="Prefix of output file to save the statistical results", required=True)
+    parser.add_argument("-out", "--outDir", action="store", default="./mtglink_results/alignments_stats", help="Output directory for saving results")
+    parser.add_argument("-format", "--format", action="store", choices=["tsv", "npz"], default="tsv", help="Format of the output file: 'tsv' or 'npz' (compressed NumPy arrays, one per column) [default: tsv]")
+    parser.add_argument("-aligner", "--aligner", action="store", choices=["nucmer", "pairwise"], default="nucmer", help="Aligner used: 'nucmer' (external NUCmer) or 'pairwise' (in process, Biopython's PairwiseAligner, for short gap-filled sequences) [default: nucmer]")
+
+    args = parser.parse_args()
+
+    if re.match('^.*.fasta$', args.query) is None:
+        parser.error("Warning: Qualitative evaluation _ The suffix of the inserted sequences (query sequences) file should be: '.fasta'")
+
+    if re.match('^.*.fasta$', args.reference) is None:
+        parser.error("Warning: Qualitative evaluation _ The suffix of the reference sequence file should be: '.fasta'")
+
+    #----------------------------------------------------
+    # Input files
+    #----------------------------------------------------
+    #Query file: inserted/gap-filled sequences file
+    qry_file = os.path.abspath(args.query)
+    if not os.path.exists(args.query):
+        parser.error("Warning: Qualitative evaluation _ The path of the query file (inserted sequences file) doesn't exist")
+
+    #Reference file: containing either the reference sequence or the flanking contigs sequences
+    ref_file = os.path.abspath(args.reference)
+    if not os.path.exists(ref_file):
+        parser.error("Warning: Qualitative evaluation _ The path of the reference file doesn't exist")
+
+    #----------------------------------------------------
+    # Directory for saving results
+    #----------------------------------------------------
+    cwd = os.getcwd()
+    if not os.path.exists(args.outDir):
+        os.mkdir(args.outDir)
+    try:
+        os.chdir(args.outDir)
+    except:
+        print("Something wrong with specified directory. Exception-", sys.exc_info())
+        print("Restoring the path")
+        os.chdir(cwd)
+    outDir = os.getcwd()
+
+    try:
+        #-----------------------------------------------------------------------------
+        # Statistics about the Alignment Ref vs Qry
+        #-----------------------------------------------------------------------------
+        stats_alignments([[qry_file, ref_file, args.ext, args.prefix]], outDir, args.aligner, stats_format=args.format)
+
+    except Exception as e:
+        print("\nException-")
+        print(e)
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        print(exc_type, fname, exc_tb.tb_lineno)
+        sys.exit(1)